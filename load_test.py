@@ -0,0 +1,198 @@
+"""
+This module runs an open-loop load test of the Marketplace on a given testfile:
+new carts arrive at a target rate, whether the previous ones finished or not.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+import random
+from threading import Lock
+from time import perf_counter, sleep
+
+from tema.config import load_market_config
+from tema.producer import Producer
+from tema.marketplace import Marketplace
+
+
+def main():
+    """
+        Starts the producers from the market_configuration input file, then sends the
+        carts of its consumers to the Marketplace, one arrival rate after the other,
+        and reports the latency percentiles and the throughput of each rate.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="market configuration (.in file)")
+    parser.add_argument("--rates", default="1,2,5,10,20,50",
+                        help="comma separated arrival rates (carts per second)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="number of seconds each rate is sent")
+    parser.add_argument("--trace", help="file with one arrival time (seconds) per line, "
+                                        "replaces --rates and --duration")
+    parser.add_argument("--workers", type=int, default=256,
+                        help="maximum number of carts served at the same time")
+    parser.add_argument("--execute-cart", action="store_true",
+                        help="buy each cart with a single execute_cart() call")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the arrivals")
+    args = parser.parse_args()
+
+    market_config = load_market_config(args.filename)
+    carts = [(cart, c_market_config['retry_wait_time'])
+             for c_market_config in market_config['consumers']
+             for cart in c_market_config['carts']]
+    if not carts:
+        print("no carts in the input file")
+        raise SystemExit
+
+    # build the marketplace and start the producers
+    marketplace = Marketplace(**market_config['marketplace'])
+    for p_market_config in market_config['producers']:
+        Producer(**p_market_config, marketplace=marketplace, daemon=True).start()
+
+    if args.trace:
+        with open(args.trace, encoding="utf-8") as trace_file:
+            steps = [("trace", sorted(float(line) for line in trace_file if line.strip()))]
+    else:
+        rng = random.Random(args.seed)
+        steps = [(rate, poisson_arrivals(rng, float(rate), args.duration))
+                 for rate in args.rates.split(",")]
+
+    load_test = LoadTest(marketplace, carts, args.execute_cart)
+    print("{0:>8} {1:>8} {2:>8} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10}".format(
+        "rate", "carts", "done", "thr/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "resp p99"))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for rate, arrivals in steps:
+            report = load_test.run_step(executor, arrivals)
+            print("{0:>8} {1:>8} {2:>8} {3:>10.2f} {4:>10.1f} {5:>10.1f} {6:>10.1f} "
+                  "{7:>10.1f}".format(rate, len(arrivals), report["done"],
+                                      report["throughput"], *report["service"],
+                                      report["response"][2]), flush=True)
+            if report["done"] < len(arrivals):
+                print("saturated: {0} carts still waiting after the step"
+                      .format(len(arrivals) - report["done"]))
+                break
+        # don't wait for the carts that can't be served anymore
+        load_test.stopped = True
+        executor.shutdown(cancel_futures=True)
+
+
+def poisson_arrivals(rng, rate, duration):
+    """
+    Draws the arrival times of a Poisson process.
+
+    :returns the sorted list of arrival times, in seconds from the beginning
+    """
+    arrivals = []
+    moment = rng.expovariate(rate)
+    while moment < duration:
+        arrivals.append(moment)
+        moment += rng.expovariate(rate)
+    return arrivals
+
+
+def percentiles(values, fractions=(0.5, 0.95, 0.99)):
+    """
+    Computes percentiles with the nearest-rank method.
+
+    :returns a list with a percentile for each fraction (0 if there are no values)
+    """
+    values = sorted(values)
+    if not values:
+        return [0 for _ in fractions]
+    return [values[min(len(values), max(1, ceil(fraction * len(values)))) - 1]
+            for fraction in fractions]
+
+
+class LoadTest:
+    """
+    Sends carts to a Marketplace and measures how long they take.
+    """
+
+    def __init__(self, marketplace, carts, use_execute_cart):
+        """
+        Constructor.
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace under test
+
+        :type carts: List
+        :param carts: list of (cart operations, retry_wait_time), used in a loop
+
+        :type use_execute_cart: Bool
+        :param use_execute_cart: True to buy each cart with execute_cart()
+        """
+        self.marketplace = marketplace
+        self.carts = carts
+        self.use_execute_cart = use_execute_cart
+        self.next_cart = 0
+        # (arrival, service start, service end) of the finished carts of the current step
+        self.results = []
+        self.results_lock = Lock()
+        # Set when the test ends, the waiting carts give up
+        self.stopped = False
+
+    def run_step(self, executor, arrivals, drain_timeout=10):
+        """
+        Sends carts at the given arrival times and waits for them to finish.
+
+        :returns a dictionary with the number of finished carts, the throughput
+        and the service and response time percentiles (in milliseconds)
+        """
+        with self.results_lock:
+            self.results = []
+        start = perf_counter()
+        for arrival in arrivals:
+            delay = start + arrival - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            cart, retry_wait_time = self.carts[self.next_cart % len(self.carts)]
+            self.next_cart += 1
+            executor.submit(self.buy, cart, retry_wait_time, start + arrival)
+        # wait for the carts of this step
+        end = start + (arrivals[-1] if arrivals else 0) + drain_timeout
+        while len(self.results) < len(arrivals) and perf_counter() < end:
+            sleep(0.01)
+        with self.results_lock:
+            results = list(self.results)
+        if not results:
+            return {"done": 0, "throughput": 0, "service": [0, 0, 0], "response": [0, 0, 0]}
+        elapsed = max(finished for _, _, finished in results) - start
+        return {"done": len(results),
+                "throughput": len(results) / elapsed if elapsed > 0 else 0,
+                "service": [1000 * latency for latency in
+                            percentiles(finished - started for _, started, finished in results)],
+                "response": [1000 * latency for latency in
+                             percentiles(finished - arrival for arrival, _, finished in results)]}
+
+    def buy(self, cart, retry_wait_time, arrival):
+        """
+        Buys a cart, from new_cart() to place_order(), like a Consumer does.
+        """
+        started = perf_counter()
+        if self.use_execute_cart:
+            while self.marketplace.execute_cart(cart, timeout=retry_wait_time) is None:
+                if self.stopped:
+                    return
+        else:
+            cart_id = self.marketplace.new_cart()
+            for operation in cart:
+                for _ in range(operation["quantity"]):
+                    if operation["type"] == "add":
+                        while not self.marketplace.add_to_cart(cart_id, operation["product"]):
+                            if self.stopped:
+                                return
+                            sleep(retry_wait_time)
+                    else:
+                        self.marketplace.remove_from_cart(cart_id, operation["product"])
+            self.marketplace.place_order(cart_id)
+        finished = perf_counter()
+        with self.results_lock:
+            self.results.append((arrival, started, finished))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+This module replays a recording of Marketplace calls (made with test.py --record)
+as fast as possible, against any Marketplace implementation, and checks that the
+results are the recorded ones.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import importlib
+
+from tema.recorder import read_recording, replay_sequential, replay_threads
+
+
+def main():
+    """
+        Reads the recording and replays it, single-threaded or with one thread for
+        each recorded thread, and reports the throughput and the mismatches.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="file written by test.py --record")
+    parser.add_argument("--threads", action="store_true",
+                        help="replay the calls of each recorded thread from its own thread "
+                             "(default: all the calls from a single thread, in order)")
+    parser.add_argument("--marketplace", default="tema.marketplace:Marketplace",
+                        help="module:class of the Marketplace implementation")
+    parser.add_argument("--repeat", type=int, default=1, help="number of replays")
+    parser.add_argument("--wait-timeout", type=float,
+                        help="timeout of the replayed execute_cart() calls "
+                             "(default: 0, or 1 with --threads)")
+    args = parser.parse_args()
+
+    module_name, _, class_name = args.marketplace.partition(":")
+    marketplace_class = getattr(importlib.import_module(module_name), class_name)
+    header, thread_names, calls = read_recording(args.recording)
+    print("{0} calls from {1} threads".format(len(calls), len(thread_names)))
+
+    replay = replay_threads if args.threads else replay_sequential
+    timeout = {} if args.wait_timeout is None else {"wait_timeout": args.wait_timeout}
+    for _ in range(args.repeat):
+        marketplace = marketplace_class(header["queue_size_per_producer"], **header["options"])
+        elapsed, mismatches = replay(marketplace, calls, **timeout)
+        print("{0:.3f} s, {1:.0f} calls/s, {2} different results {3}".format(
+            elapsed, len(calls) / elapsed, sum(mismatches.values()), mismatches or ""),
+              flush=True)
+        # Each Marketplace adds a handler to the shared logger
+        handler = getattr(marketplace, "handler", None)
+        if handler is not None:
+            marketplace.logger.removeHandler(handler)
+            handler.close()
+
+
+if __name__ == '__main__':
+    main()
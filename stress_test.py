@@ -0,0 +1,388 @@
+"""
+This module hammers a single Marketplace with random producer and consumer operations
+from many threads, records the history of the calls and checks it against a
+sequential model of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+from collections import Counter
+import random
+from threading import Barrier, Thread
+from time import perf_counter, perf_counter_ns
+
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+
+# Relative frequency of the operations made by a stress thread
+OPERATION_WEIGHTS = {"publish": 40, "add_to_cart": 40, "remove_from_cart": 10,
+                     "place_order": 10, "execute_cart": 10}
+
+
+def main():
+    """
+        Runs the stress test once for each number of threads and reports the
+        throughput and the result of the checks.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", default="1,2,4,8,16",
+                        help="comma separated numbers of threads")
+    parser.add_argument("--operations", type=int, default=2000,
+                        help="number of operations made by each thread")
+    parser.add_argument("--products", type=int, default=8, help="number of products")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="queue_size_per_producer of the Marketplace")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the operations")
+    parser.add_argument("--execute-timeout", type=float, default=0.01,
+                        help="seconds an execute_cart call waits for its product")
+    parser.add_argument("--inventory-matrix", action="store_true",
+                        help="also keep (and check) the NumPy inventory matrix")
+    parser.add_argument("--no-check", action="store_true",
+                        help="only measure the throughput")
+    args = parser.parse_args()
+
+    products = make_products(args.products)
+    print("{0:>8} {1:>10} {2:>12} {3:>10}  {4}".format(
+        "threads", "calls", "calls/s", "check (s)", "result"))
+    failed = False
+    for thread_count in [int(count) for count in args.threads.split(",")]:
+        marketplace = Marketplace(args.queue_size, inventory_matrix=args.inventory_matrix)
+        histories, elapsed = run_stress(marketplace, thread_count, args.operations,
+                                        products, args.seed, args.execute_timeout)
+        calls = sum(len(history) for history in histories)
+        errors, check_time = [], 0
+        if not args.no_check:
+            start = perf_counter()
+            errors = check_history(marketplace, histories)
+            check_time = perf_counter() - start
+        print("{0:>8} {1:>10} {2:>12.0f} {3:>10.2f}  {4}".format(
+            thread_count, calls, calls / elapsed, check_time,
+            "skipped" if args.no_check else ("ok" if not errors else "FAILED")), flush=True)
+        for error in errors[:20]:
+            print("    " + error)
+        failed = failed or bool(errors)
+        # Each Marketplace adds a handler to the shared logger
+        marketplace.logger.removeHandler(marketplace.handler)
+        marketplace.handler.close()
+    if failed:
+        raise SystemExit(1)
+
+
+def make_products(count):
+    """
+    :returns a list of distinct products, half coffee and half tea
+    """
+    return [Coffee(name="Coffee{0}".format(i), acidity="5.0{0}".format(i % 10),
+                   roast_level="MEDIUM", price=1 + i % 10) if i % 2 == 0 else
+            Tea(name="Tea{0}".format(i), type="Herbal", price=1 + i % 10)
+            for i in range(count)]
+
+
+class StressThread(Thread):
+    """
+    Registers as a producer, opens a cart and makes random calls, recording each one
+    as (call time, return time, method, argument, result), times in nanoseconds.
+    """
+
+    def __init__(self, marketplace, products, operations, seed, barrier, execute_timeout):
+        """
+        Constructor.
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace under test
+
+        :type products: List
+        :param products: the products that are published and bought
+
+        :type operations: Int
+        :param operations: the number of random calls to make
+
+        :type seed: Int
+        :param seed: the seed of the random calls
+
+        :type barrier: Barrier
+        :param barrier: makes all the threads start together
+
+        :type execute_timeout: Float
+        :param execute_timeout: the number of seconds an execute_cart call waits
+        for its product
+        """
+        Thread.__init__(self)
+        self.marketplace = marketplace
+        self.products = products
+        self.operations = operations
+        self.rng = random.Random(seed)
+        self.barrier = barrier
+        self.execute_timeout = execute_timeout
+        self.history = []
+
+    def call(self, method, argument, *arguments):
+        """
+        Calls a method of the Marketplace and records the call.
+
+        :returns the result of the call
+        """
+        start = perf_counter_ns()
+        result = getattr(self.marketplace, method)(*arguments)
+        self.history.append((start, perf_counter_ns(), method, argument, result))
+        return result
+
+    def run(self):
+        producer_id = self.call("register_producer", None)
+        cart_id = self.call("new_cart", None)
+        names = list(OPERATION_WEIGHTS)
+        weights = list(OPERATION_WEIGHTS.values())
+        self.barrier.wait()
+        for method in self.rng.choices(names, weights, k=self.operations):
+            product = self.rng.choice(self.products)
+            if method == "publish":
+                self.call(method, product, producer_id, product)
+            elif method == "place_order":
+                self.call(method, cart_id, cart_id)
+                cart_id = self.call("new_cart", None)
+            elif method == "execute_cart":
+                # A whole cart of one unit, bought in its own cart: the call blocks
+                # until another thread publishes the product or the timeout expires
+                self.call(method, product, [{"type": "add", "product": product,
+                                             "quantity": 1}], self.execute_timeout)
+            else:
+                self.call(method, product, cart_id, product)
+
+
+def run_stress(marketplace, thread_count, operations, products, seed, execute_timeout):
+    """
+    Runs the stress threads until they all finish.
+
+    :returns a tuple (list of the histories of the threads, elapsed seconds)
+    """
+    barrier = Barrier(thread_count + 1)
+    threads = [StressThread(marketplace, products, operations, seed * 1000 + index, barrier,
+                            execute_timeout)
+               for index in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    return [thread.history for thread in threads], perf_counter() - start
+
+
+def check_history(marketplace, histories):
+    """
+    Checks a history against the sequential model of the Marketplace:
+    - each cart, used by a single thread, orders what it added minus what it removed,
+      and execute_cart orders its unit or nothing
+    - the stock of each product is linearizable: there is an order of the calls,
+      compatible with their real-time order, in which no unit is sold twice and
+      add_to_cart fails only when the product is out of stock
+    - after the threads finished, no unit was created or lost and the queue of each
+      producer counts its units from the shelves and from the carts
+
+    :returns the list of errors found
+    """
+    errors = check_carts(histories)
+    stock_operations = {}
+    for history in histories:
+        for start, end, method, product, result in history:
+            if method in ("publish", "remove_from_cart") and result:
+                stock_operations.setdefault(product, []).append((start, end, "put"))
+            elif method == "add_to_cart":
+                stock_operations.setdefault(product, []).append(
+                    (start, end, "take" if result else "empty"))
+            elif method == "execute_cart":
+                stock_operations.setdefault(product, []).append(
+                    (start, end, "take" if result is not None else "empty"))
+    for product, operations in stock_operations.items():
+        if not is_linearizable(operations, 0, apply_stock_operation):
+            errors.append("the stock of {0} is not linearizable".format(product))
+    return errors + check_final_state(marketplace, histories)
+
+
+def check_carts(histories):
+    """
+    Replays the calls of each thread on a sequential model of its carts.
+
+    :returns the list of errors found
+    """
+    errors = []
+    for index, history in enumerate(histories):
+        cart = Counter()
+        for _, _, method, argument, result in history:
+            if method == "add_to_cart" and result:
+                cart[argument] += 1
+            elif method == "remove_from_cart":
+                if result != (cart[argument] > 0):
+                    errors.append("thread {0}: remove_from_cart({1}) returned {2}"
+                                  .format(index, argument, result))
+                elif result:
+                    cart[argument] -= 1
+            elif method == "place_order":
+                if Counter(result) != +cart:
+                    errors.append("thread {0}: cart {1} ordered {2} instead of {3}"
+                                  .format(index, argument, dict(Counter(result)),
+                                          dict(+cart)))
+                cart = Counter()
+            elif method == "execute_cart" and result not in (None, [argument]):
+                errors.append("thread {0}: execute_cart({1}) ordered {2}"
+                              .format(index, argument, result))
+    return errors
+
+
+def apply_stock_operation(stock, operation):
+    """
+    Sequential model of the stock of a product.
+
+    :returns the stock after the operation, None if the operation can't happen now
+    """
+    if operation == "put":
+        return stock + 1
+    if operation == "take":
+        return stock - 1 if stock > 0 else None
+    return stock if stock == 0 else None
+
+
+def is_linearizable(operations, initial_state, apply):
+    """
+    Searches an order of the operations that respects their real-time order (an
+    operation that returned before another one was called comes first) and that
+    the sequential model accepts (Wing & Gong's search, with Lowe's memoisation of
+    the visited (linearized operations, state) pairs).
+
+    :type operations: List
+    :param operations: list of (call time, return time, operation)
+
+    :type initial_state:
+    :param initial_state: the state of the model before the first operation
+
+    :type apply: Callable
+    :param apply: function (state, operation) -> new state or None if not allowed
+
+    :returns True if such an order exists
+    """
+    # pylint: disable=too-many-locals
+    # Calls and returns in time order, a call comes first at equal times; the events
+    # are nodes 1..2n of a doubly linked list, node 0 is its head
+    events = sorted([(start, 0, index) for index, (start, _, _) in enumerate(operations)]
+                    + [(end, 1, index) for index, (_, end, _) in enumerate(operations)])
+    count = len(events)
+    next_node = list(range(1, count + 1)) + [None]
+    previous_node = [None] + list(range(count))
+    return_node = {}
+    for node, (_, is_return, index) in enumerate(events, 1):
+        if is_return:
+            return_node[index] = node
+
+    def lift(node):
+        for lifted in (node, return_node[events[node - 1][2]]):
+            next_node[previous_node[lifted]] = next_node[lifted]
+            if next_node[lifted] is not None:
+                previous_node[next_node[lifted]] = previous_node[lifted]
+
+    def unlift(node):
+        for lifted in (return_node[events[node - 1][2]], node):
+            next_node[previous_node[lifted]] = lifted
+            if next_node[lifted] is not None:
+                previous_node[next_node[lifted]] = lifted
+
+    state, linearized = initial_state, 0
+    stack, visited = [], set()
+    node = next_node[0]
+    while next_node[0] is not None:
+        _, is_return, index = events[node - 1]
+        if not is_return:
+            new_state = apply(state, operations[index][2])
+            if new_state is not None:
+                new_linearized = linearized | (1 << index)
+                if (new_linearized, new_state) not in visited:
+                    visited.add((new_linearized, new_state))
+                    stack.append((node, state))
+                    state, linearized = new_state, new_linearized
+                    lift(node)
+                    node = next_node[0]
+                    continue
+            node = next_node[node]
+        else:
+            # The operation returned before any order could include it: backtrack
+            if not stack:
+                return False
+            node, state = stack.pop()
+            linearized &= ~(1 << events[node - 1][2])
+            unlift(node)
+            node = next_node[node]
+    return True
+
+
+def check_final_state(marketplace, histories):
+    """
+    Checks that the units are conserved and that the counters of the Marketplace
+    agree with its lists, once all the threads finished.
+
+    :returns the list of errors found
+    """
+    errors = []
+    published, ordered = Counter(), Counter()
+    for history in histories:
+        for _, _, method, argument, result in history:
+            if method == "publish" and result:
+                published[argument] += 1
+            elif method in ("place_order", "execute_cart") and result is not None:
+                ordered.update(result)
+    on_shelves, in_carts, holders = count_units(marketplace)
+    for product in set(published) | set(on_shelves):
+        if published[product] - ordered[product] != on_shelves[product] + in_carts[product]:
+            errors.append("{0}: {1} published, {2} ordered, {3} on shelves, {4} in carts"
+                          .format(product, published[product], ordered[product],
+                                  on_shelves[product], in_carts[product]))
+    for producer_id, queue_size in marketplace.producers_queue.items():
+        if queue_size != holders[producer_id] or queue_size > marketplace.queue_size_per_producer:
+            errors.append("{0}: queue size {1}, {2} units on shelves and in carts"
+                          .format(producer_id, queue_size, holders[producer_id]))
+
+    snapshot = marketplace.inventory_snapshot()
+    if {product: count for product, count in snapshot.stock.items() if count} != +on_shelves:
+        errors.append("the inventory counters disagree with the shelves")
+    if marketplace.catalog.in_stock != set(+on_shelves):
+        errors.append("the catalog disagrees with the shelves")
+    if marketplace.matrix is not None:
+        errors += check_matrix(marketplace, on_shelves)
+    return errors
+
+
+def check_matrix(marketplace, on_shelves):
+    """
+    Checks that the inventory matrix agrees with the lists of the Marketplace.
+
+    :returns the list of errors found
+    """
+    errors = []
+    if +Counter(marketplace.matrix.stock_by_product()) != +on_shelves:
+        errors.append("the inventory matrix disagrees with the shelves")
+    if marketplace.matrix.units_by_producer() != marketplace.producers_queue:
+        errors.append("the inventory matrix disagrees with the queues")
+    return errors
+
+
+def count_units(marketplace):
+    """
+    Counts the units from the lists of the Marketplace.
+
+    :returns a tuple (Counter of units on shelves by product, Counter of units in
+    carts by product, Counter of units on shelves and in carts by producer)
+    """
+    on_shelves, in_carts, holders = Counter(), Counter(), Counter()
+    for cart_list in marketplace.carts.values():
+        for cart_element in cart_list:
+            in_carts[cart_element["product"]] += 1
+            holders[cart_element["producer_id"]] += 1
+    for product, producer_ids in marketplace.products_producers.items():
+        on_shelves[product] = len(producer_ids)
+        holders.update(producer_ids)
+    return on_shelves, in_carts, holders
+
+
+if __name__ == '__main__':
+    main()
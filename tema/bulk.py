@@ -0,0 +1,300 @@
+"""
+This module moves many units at once between the shelves of the Marketplace and
+its carts: the whole content of a cart of execute_cart(), waiting for the producers
+if needed, and the units released from several carts.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Thread, Timer
+import time
+import unittest
+
+from tema.priorities import DEFAULT_PRIORITY
+from tema.product import Coffee, Tea
+
+# Minimum number of seconds a waiting consumer sleeps between two checks for deadlocks
+MIN_WAIT_TIME = 0.01
+
+
+def net_quantities(operations):
+    """
+    Computes the quantity of each product left in a cart after applying the operations
+    in order (removing a product that is not in the cart does nothing).
+
+    :type operations: List
+    :param operations: add and remove operations, in the format used by Consumer
+
+    :returns a dictionary with key: product, value: quantity (only positive quantities)
+    """
+    quantities = {}
+    for operation in operations:
+        product = operation["product"]
+        if operation["type"] == "add":
+            quantities[product] = quantities.get(product, 0) + operation["quantity"]
+        elif operation["type"] == "remove":
+            quantities[product] = max(quantities.get(product, 0) - operation["quantity"], 0)
+    return {product: quantity for product, quantity in quantities.items() if quantity > 0}
+
+
+def reserve_all(marketplace, cart_id, quantities):
+    """
+    Moves the given quantities into a cart of the Marketplace, all of them or nothing.
+
+    :returns the first product that is not available in the needed quantity,
+    None if the reservation succeeded
+    """
+    for product in quantities:
+        if product not in marketplace.products_producers:
+            return product
+    priority = marketplace.carts_priorities.get(cart_id, DEFAULT_PRIORITY)
+    # Always acquire the locks in the same order, to avoid deadlocks
+    locks = sorted((marketplace.products_locks[product] for product in quantities), key=id)
+    with marketplace.carts_locks[cart_id]:
+        for lock in locks:
+            lock.acquire()
+        try:
+            for product, quantity in quantities.items():
+                available = len(marketplace.products_producers[product])
+                if available - marketplace.priorities.held_back(priority, product,
+                                                                available) < quantity:
+                    return product
+            cart_elements = []
+            for product, quantity in quantities.items():
+                producer_ids = marketplace.products_producers[product][:quantity]
+                del marketplace.products_producers[product][:quantity]
+                cart_elements += [{"product": product, "producer_id": producer_id}
+                                  for producer_id in producer_ids]
+            marketplace.inventory.taken_many(cart_id, cart_elements)
+        finally:
+            for lock in locks:
+                lock.release()
+        marketplace.carts[cart_id] += cart_elements
+    return None
+
+
+def wait_for_stock(marketplace, cart_id, quantities, timeout, cart_waits):
+    """
+    Retries the reservation of a cart each time units become available.
+
+    :type timeout: Float
+    :param timeout: the maximum number of seconds to wait (None waits forever)
+
+    :type cart_waits: Callable
+    :param cart_waits: function called with the cart_id and the missing product
+    before each wait (it raises MarketplaceStalled if the consumer must give up)
+
+    :returns the product that is still missing, None if the reservation succeeded
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    progress = marketplace.progress
+    with marketplace.stock_condition:
+        marketplace.stock_waiters += 1
+        marketplace.priorities.start_waiting(cart_id, marketplace.carts_priorities.get(
+            cart_id, DEFAULT_PRIORITY), quantities)
+        marketplace.demand.notify()
+        try:
+            # Units published after the failed attempt of the caller and before
+            # this waiter was counted were not notified, so retry before waiting
+            missing = reserve_all(marketplace, cart_id, quantities)
+            while missing is not None:
+                cart_waits(cart_id, missing)
+                wait_time = None
+                if deadline is not None:
+                    wait_time = deadline - time.monotonic()
+                    if wait_time <= 0:
+                        break
+                if progress is not None:
+                    # Wake up regularly to check for deadlocks
+                    check_time = max(progress.stall_timeout, MIN_WAIT_TIME)
+                    wait_time = check_time if wait_time is None else min(wait_time,
+                                                                         check_time)
+                if marketplace.tracer is None:
+                    marketplace.stock_condition.wait(wait_time)
+                else:
+                    with marketplace.tracer.span("wait for stock", "marketplace",
+                                                 missing=str(missing)):
+                        marketplace.stock_condition.wait(wait_time)
+                marketplace.expire_reservations()
+                missing = reserve_all(marketplace, cart_id, quantities)
+        finally:
+            marketplace.stock_waiters -= 1
+            # The units held back for this cart may be free for the lower classes
+            if marketplace.priorities.stop_waiting(cart_id):
+                marketplace.stock_condition.notify_all()
+    return missing
+
+
+def release(marketplace, cart_ids, product=None):
+    """
+    Moves the units of the given carts of the Marketplace (only those of a product,
+    if given) back to its shelves. The units are grouped by product, so the lock of
+    each product is acquired once and the counters are updated once. The caller
+    wakes up the consumers waiting for stock.
+
+    :returns a dictionary with key: cart_id, value: number of released units
+    (only the carts that released something)
+    """
+    # Several carts are locked together, always in the same order
+    cart_ids = sorted({cart_id for cart_id in cart_ids if cart_id in marketplace.carts})
+    cart_locks = [marketplace.carts_locks[cart_id] for cart_id in cart_ids]
+    released = {}
+    for lock in cart_locks:
+        lock.acquire()
+    try:
+        for cart_id in cart_ids:
+            cart_list = marketplace.carts[cart_id]
+            removed = [cart_element for cart_element in cart_list
+                       if product is None or cart_element["product"] == product]
+            if not removed:
+                continue
+            marketplace.carts[cart_id] = [cart_element for cart_element in cart_list
+                                          if product is not None
+                                          and cart_element["product"] != product]
+            if marketplace.reservations is not None:
+                for cart_element in removed:
+                    marketplace.reservations.release(cart_element)
+            released[cart_id] = removed
+        _return_many_to_stock(marketplace, released)
+    finally:
+        for lock in cart_locks:
+            lock.release()
+    return {cart_id: len(removed) for cart_id, removed in released.items()}
+
+
+def _return_many_to_stock(marketplace, released):
+    """
+    Makes the units from carts available again from their producers, with the
+    locks of the carts held.
+
+    :type released: Dictionary
+    :param released: key: cart_id, value: list of the cart elements to return
+    """
+    # Dictionary with key: product, value: the ids of the producers of its units
+    producers = {}
+    for cart_elements in released.values():
+        for cart_element in cart_elements:
+            producers.setdefault(cart_element["product"], []).append(
+                cart_element["producer_id"])
+    locks = sorted((marketplace.products_locks[product] for product in producers), key=id)
+    for lock in locks:
+        lock.acquire()
+    try:
+        for product, producer_ids in producers.items():
+            marketplace.products_producers[product] += producer_ids
+        marketplace.inventory.returned_many(released)
+    finally:
+        for lock in locks:
+            lock.release()
+
+
+class TestBulk(unittest.TestCase):
+    """
+    Unit testing class for the bulk reservations and releases.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Prod0 publishes 3 x product0 and 2 x product1, prod1 publishes 2 x product2,
+        1 x product3 and 1 x product1.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.product2 = Coffee(name="Ethiopia", acidity="5.09", roast_level="MEDIUM", price=10)
+        self.product3 = Tea(name="Wild Cherry", type="Black", price=3)
+        self.marketplace = Marketplace(5)
+        for products in ([self.product0] * 3 + [self.product1] * 2,
+                         [self.product2] * 2 + [self.product3, self.product1]):
+            producer_id = self.marketplace.register_producer()
+            for product in products:
+                self.marketplace.publish(producer_id, product)
+
+    def test_execute_cart(self):
+        """
+        Tests that execute_cart nets the operations and reserves the whole cart at once.
+        """
+        operations = [{"type": "remove", "product": self.product2, "quantity": 1},
+                      {"type": "add", "product": self.product0, "quantity": 3},
+                      {"type": "add", "product": self.product2, "quantity": 2},
+                      {"type": "remove", "product": self.product0, "quantity": 1},
+                      {"type": "remove", "product": self.product2, "quantity": 2}]
+        self.assertEqual(net_quantities(operations), {self.product0: 2},
+                         'Wrong netted quantities!')
+        self.assertEqual(self.marketplace.execute_cart(operations),
+                         [self.product0, self.product0], 'Wrong cart list!')
+        self.assertEqual(len(self.marketplace.products_producers[self.product2]), 2,
+                         'Netted operations should not touch product2!')
+        # Only 1 unit of product3 is available, nothing must be reserved
+        operations = [{"type": "add", "product": self.product2, "quantity": 1},
+                      {"type": "add", "product": self.product3, "quantity": 2}]
+        self.assertIsNone(self.marketplace.execute_cart(operations, timeout=0),
+                          'The cart should not be available!')
+        self.assertEqual(len(self.marketplace.products_producers[self.product2]), 2,
+                         'Product2 should be available in quantity = 2!')
+        # The missing unit is published while the cart waits
+        publisher = Timer(0.05, self.marketplace.publish, args=('prod1', self.product3))
+        publisher.start()
+        self.assertEqual(self.marketplace.execute_cart(operations, timeout=5),
+                         [self.product2, self.product3, self.product3], 'Wrong cart list!')
+        publisher.join()
+        self.assertEqual(self.marketplace.producers_queue['prod1'], 2,
+                         'Producer prod1 queue should contain 2 products!')
+        self.assertEqual(list(self.marketplace.carts), [],
+                         'The carts of execute_cart should be dropped!')
+
+    def test_missed_publish(self):
+        """
+        Tests that a unit published between the failed reservation and the wait
+        for stock is not missed.
+        """
+        mint = Tea(name="Mint", type="Herbal", price=2)
+        producer_id = self.marketplace.register_producer()
+        quantities = {mint: 1}
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(reserve_all(self.marketplace, cart_id, quantities), mint,
+                         'Mint is not available!')
+        # Nobody waits yet, so the publish notifies nobody
+        self.marketplace.publish(producer_id, mint)
+        result = []
+        waiter = Thread(target=lambda: result.append(wait_for_stock(
+            self.marketplace, cart_id, quantities, None, lambda *_: None)), daemon=True)
+        waiter.start()
+        waiter.join(5)
+        self.assertEqual(result, [None], 'The published unit should be reserved!')
+        self.assertEqual(self.marketplace.place_order(cart_id), [mint], 'Wrong cart list!')
+
+    def test_bulk_release(self):
+        """
+        Tests that the units of a product, of a cart and of several carts are
+        returned to the Marketplace at once.
+        """
+        cart0 = self.marketplace.new_cart()
+        cart1 = self.marketplace.new_cart()
+        for product in (self.product0, self.product1, self.product1, self.product1,
+                        self.product2):
+            self.assertTrue(self.marketplace.add_to_cart(cart0, product),
+                            'Cannot add {0} to cart!'.format(product))
+        self.assertTrue(self.marketplace.add_to_cart(cart1, self.product2),
+                        'Cannot add product2 to cart!')
+        self.assertEqual(self.marketplace.release_product(0, self.product1), 3,
+                         'Cart0 holds 3 units of product1!')
+        self.assertEqual(len(self.marketplace.products_producers[self.product1]), 3,
+                         'Product1 should be available in quantity = 3!')
+        self.assertEqual(self.marketplace.carts[0],
+                         [{"product": self.product0, "producer_id": 'prod0'},
+                          {"product": self.product2, "producer_id": 'prod1'}],
+                         'Only product1 should leave cart0!')
+        self.assertEqual(self.marketplace.release_carts([1, 0, 1, 42]), 3,
+                         'Cart0 and cart1 hold 3 units!')
+        self.assertEqual(self.marketplace.clear_cart(0), 0, 'Cart0 should be empty!')
+        self.assertIsNone(self.marketplace.clear_cart(42), 'Cart42 does not exist!')
+        self.assertEqual(self.marketplace.inventory_snapshot().stock,
+                         {self.product0: 3, self.product1: 3, self.product2: 2,
+                          self.product3: 1}, 'All the units should be in stock!')
+        self.assertEqual(self.marketplace.producers_queue, {'prod0': 5, 'prod1': 4},
+                         'The units are still in the queues!')
@@ -0,0 +1,210 @@
+"""
+This module shares the capacity of the Marketplace between the producers according
+to the demand for their products.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Lock
+import unittest
+
+from tema.product import Coffee, Tea
+
+# Number of ordered units between two rebalances of the quotas
+DEFAULT_REBALANCE_EVERY = 32
+# Fraction of the demand remembered from one rebalance to the next
+DEFAULT_DECAY = 0.5
+
+
+class CapacityManager:
+    """
+    Replaces the fixed queue size of each producer with a quota. The sum of the
+    quotas stays queue_size_per_producer times the number of producers, but every
+    few orders the quotas are recomputed: half of the slots above the minimum quota
+    are split equally and half in proportion to the recent demand (the units ordered
+    from each producer, with an exponential decay), so the producers whose units are
+    bought get more room.
+
+    A producer whose queue is full of units nobody takes can also borrow a slot from
+    the producer with the most idle slots, to publish a different product.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, queue_size_per_producer, rebalance_every=DEFAULT_REBALANCE_EVERY,
+                 decay=DEFAULT_DECAY, min_quota=1):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the quota of a new producer, and the average quota
+
+        :type rebalance_every: Int
+        :param rebalance_every: the number of ordered units between two rebalances
+
+        :type decay: Float
+        :param decay: the fraction of the demand kept after a rebalance
+
+        :type min_quota: Int
+        :param min_quota: the quota every producer keeps
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.rebalance_every = rebalance_every
+        self.decay = decay
+        self.min_quota = min(min_quota, queue_size_per_producer)
+        # Dictionary with key: producer_id, value: the maximum size of its queue
+        self.quotas = {}
+        # Dictionary with key: producer_id, value: the recent number of ordered units
+        self.demand = {}
+        # Number of units ordered since the last rebalance
+        self.ordered_since = 0
+        # Number of slots lent in emergencies since the start
+        self.borrowed = 0
+        # Lock used to avoid race condition between orders, borrows and registrations
+        self.lock = Lock()
+
+    def register(self, producer_id):
+        """
+        Gives a new producer the default quota (the total grows with it).
+        """
+        with self.lock:
+            self.quotas[producer_id] = self.queue_size_per_producer
+            self.demand[producer_id] = 0
+
+    def quota(self, producer_id):
+        """
+        :returns the maximum size of the queue of a producer
+        """
+        return self.quotas.get(producer_id, self.queue_size_per_producer)
+
+    def ordered(self, producer_ids):
+        """
+        Records the units ordered from the given producers (one id per unit) and
+        rebalances the quotas when enough units were ordered.
+        """
+        with self.lock:
+            for producer_id in producer_ids:
+                self.demand[producer_id] = self.demand.get(producer_id, 0) + 1
+            self.ordered_since += len(producer_ids)
+            if self.ordered_since >= self.rebalance_every:
+                self._rebalance()
+
+    def borrow(self, producer_id, queues):
+        """
+        Moves a slot to a producer from the producer with the most idle slots
+        (the lender keeps at least its minimum quota).
+
+        :type queues: Dictionary
+        :param queues: key: producer_id, value: the current size of its queue
+        (read without the locks of the producers, only to choose the lender)
+
+        :returns True if a slot was borrowed
+        """
+        with self.lock:
+            lender, idle = None, 0
+            for other, quota in self.quotas.items():
+                other_idle = quota - max(queues.get(other, 0), self.min_quota)
+                if other != producer_id and other_idle > idle:
+                    lender, idle = other, other_idle
+            if lender is None:
+                return False
+            self.quotas[lender] -= 1
+            self.quotas[producer_id] = self.quota(producer_id) + 1
+            self.borrowed += 1
+            return True
+
+    def _rebalance(self):
+        """
+        Recomputes the quotas from the demand (the lock must be held).
+        """
+        producer_ids = list(self.quotas)
+        if not producer_ids:
+            return
+        total = self.queue_size_per_producer * len(producer_ids)
+        spare = total - self.min_quota * len(producer_ids)
+        mean_demand = sum(self.demand[producer_id] for producer_id in producer_ids) \
+            / len(producer_ids)
+        weights = [self.demand[producer_id] + mean_demand for producer_id in producer_ids]
+        total_weight = sum(weights)
+        if total_weight:
+            exact = [spare * weight / total_weight for weight in weights]
+        else:
+            exact = [spare / len(producer_ids)] * len(producer_ids)
+        quotas = [self.min_quota + int(share) for share in exact]
+        # The slots lost by rounding down go to the largest remainders
+        by_remainder = sorted(range(len(producer_ids)),
+                              key=lambda index: exact[index] - int(exact[index]), reverse=True)
+        for index in by_remainder[:total - sum(quotas)]:
+            quotas[index] += 1
+        self.quotas = dict(zip(producer_ids, quotas))
+        for producer_id in producer_ids:
+            self.demand[producer_id] *= self.decay
+        self.ordered_since = 0
+
+
+class TestCapacityManager(unittest.TestCase):
+    """
+    Unit testing class for CapacityManager functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Registers 2 producers with a quota of 4.
+        """
+        self.capacity = CapacityManager(4, rebalance_every=8)
+        self.capacity.register("prod0")
+        self.capacity.register("prod1")
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+
+    def test_rebalance(self):
+        """
+        Tests that the quotas move toward the ordered producer and that the total
+        stays the same.
+        """
+        self.capacity.ordered(["prod0"] * 7)
+        self.assertEqual(self.capacity.quotas, {"prod0": 4, "prod1": 4},
+                         'No rebalance before 8 units!')
+        self.capacity.ordered(["prod0"])
+        self.assertEqual(self.capacity.quotas, {"prod0": 6, "prod1": 2}, 'Wrong quotas!')
+        self.assertEqual(self.capacity.demand["prod0"], 4, 'The demand should decay!')
+
+    def test_borrow(self):
+        """
+        Tests that a full producer borrows the idle slots of another producer, which
+        keeps its minimum quota.
+        """
+        queues = {"prod0": 4, "prod1": 1}
+        self.assertTrue(self.capacity.borrow("prod0", queues), 'Prod1 has idle slots!')
+        self.assertTrue(self.capacity.borrow("prod0", queues), 'Prod1 has idle slots!')
+        self.assertEqual(self.capacity.quotas, {"prod0": 6, "prod1": 2}, 'Wrong quotas!')
+        queues["prod1"] = 2
+        self.assertFalse(self.capacity.borrow("prod0", queues), 'Prod1 has no idle slot!')
+        self.assertEqual(self.capacity.borrowed, 2, 'Wrong number of borrowed slots!')
+
+    def test_adaptive_capacity(self):
+        """
+        Tests that a producer whose queue is full of unwanted units borrows a slot
+        to publish another product.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(2, adaptive_capacity=True)
+        producer_id = marketplace.register_producer()
+        marketplace.register_producer()
+        while marketplace.publish(producer_id, self.product0):
+            pass
+        self.assertTrue(marketplace.publish(producer_id, self.product1),
+                        'Prod0 should borrow a slot from prod1!')
+        self.assertFalse(marketplace.publish(producer_id, self.product1),
+                         'Product1 is already published!')
+        self.assertEqual(marketplace.capacity.quotas, {'prod0': 3, 'prod1': 1},
+                         'Wrong quotas!')
+        cart_id = marketplace.new_cart()
+        self.assertTrue(marketplace.add_to_cart(cart_id, self.product1),
+                        'Cannot add product1 to cart!')
+        self.assertEqual(marketplace.place_order(cart_id), [self.product1], 'Wrong cart list!')
+        self.assertTrue(marketplace.publish(producer_id, self.product1),
+                        'Prod0 should be able to publish product1 again!')
@@ -0,0 +1,357 @@
+"""
+This module indexes the products in stock by their attributes.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from bisect import bisect_left, bisect_right, insort
+import math
+from dataclasses import dataclass
+from threading import Lock
+import unittest
+
+from tema.product import Coffee, Tea
+
+# Fields with few distinct values, indexed for each product class
+CATEGORICAL_FIELDS = {"Tea": ("type",), "Coffee": ("roast_level",)}
+# Fields of a ProductSpec that only a product class has
+CLASS_FIELDS = {"Tea": ("type",), "Coffee": ("roast_level", "min_acidity", "max_acidity")}
+
+
+@dataclass(frozen=True)
+class ProductSpec:
+    """
+    Describes the wanted products: every field that is not None must match.
+    The prices and the acidities are inclusive ranges.
+    """
+    product_type: str = None
+    name: str = None
+    type: str = None
+    roast_level: str = None
+    min_price: float = None
+    max_price: float = None
+    min_acidity: float = None
+    max_acidity: float = None
+
+    def __post_init__(self):
+        """
+        Rejects the specs that mix the fields of several product classes, no
+        product could match them.
+        """
+        kinds = {kind for kind, fields in CLASS_FIELDS.items()
+                 if any(getattr(self, field) is not None for field in fields)}
+        if self.product_type is not None:
+            kinds.add(self.product_type)
+        if len(kinds) > 1:
+            raise ValueError("ProductSpec mixes the fields of {0}".format(
+                " and ".join(sorted(kinds))))
+
+    def kind(self):
+        """
+        :returns the name of the product class implied by the fields (None if any)
+        """
+        if self.product_type is not None:
+            return self.product_type
+        if self.type is not None:
+            return "Tea"
+        if self.roast_level is not None or self.min_acidity is not None \
+                or self.max_acidity is not None:
+            return "Coffee"
+        return None
+
+    def matches(self, product):
+        """
+        :returns True if the product has all the asked attributes
+        """
+        # pylint: disable=too-many-return-statements
+        kind = self.kind()
+        if kind is not None and type(product).__name__ != kind:
+            return False
+        if self.name is not None and product.name != self.name:
+            return False
+        for field in CATEGORICAL_FIELDS.get(kind, ()):
+            wanted = getattr(self, field)
+            if wanted is not None and getattr(product, field) != wanted:
+                return False
+        if self.min_price is not None and product.price < self.min_price:
+            return False
+        if self.max_price is not None and product.price > self.max_price:
+            return False
+        if self.min_acidity is not None and float(product.acidity) < self.min_acidity:
+            return False
+        if self.max_acidity is not None and float(product.acidity) > self.max_acidity:
+            return False
+        return True
+
+
+class ProductCatalog:
+    """
+    Secondary indexes over the products in stock. Each index is a list of
+    (price, sequence number, product) sorted by price, for all the products, for
+    each product class and for each value of the categorical fields of a class.
+    A query picks the most selective index, jumps to the minimum price with a
+    binary search and scans in price order, so the cheapest match is usually one
+    of the first entries it looks at. The coffees are also indexed by acidity: a
+    query on an acidity range without a roast level only looks at the coffees in
+    that range (found with two binary searches) and sorts them by price.
+
+    The Marketplace adds a product when its first unit becomes available and
+    removes it when its last unit is taken.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Dictionary with key: index key, value: sorted list of entries
+        self.indexes = {}
+        # Dictionary with key: product, value: its entry (the sequence number keeps
+        # the entries unique and breaks the price ties in order of first appearance)
+        self.entries = {}
+        # Sorted list of (acidity, sequence number, product) for the coffees in stock
+        self.acidity_index = []
+        # Products in stock
+        self.in_stock = set()
+        # Lock used to avoid race condition between the updates and the queries
+        self.lock = Lock()
+
+    def add(self, product):
+        """
+        Records that a product is in stock.
+        """
+        with self.lock:
+            if product in self.in_stock:
+                return
+            entry = self.entries.get(product)
+            if entry is None:
+                entry = self.entries[product] = (product.price, len(self.entries), product)
+            self.in_stock.add(product)
+            for key in _index_keys(product):
+                insort(self.indexes.setdefault(key, []), entry)
+            if isinstance(product, Coffee):
+                insort(self.acidity_index, _acidity_entry(entry))
+
+    def remove(self, product):
+        """
+        Records that a product is out of stock.
+        """
+        with self.lock:
+            if product not in self.in_stock:
+                return
+            self.in_stock.discard(product)
+            entry = self.entries[product]
+            for key in _index_keys(product):
+                index = self.indexes[key]
+                del index[bisect_left(index, entry)]
+            if isinstance(product, Coffee):
+                del self.acidity_index[bisect_left(self.acidity_index, _acidity_entry(entry))]
+
+    def reset(self, products):
+        """
+        Replaces the products in stock.
+        """
+        with self.lock:
+            self.in_stock = set()
+            self.indexes = {}
+            self.acidity_index = []
+        for product in products:
+            self.add(product)
+
+    def cheapest(self, spec, exclude=()):
+        """
+        Returns the cheapest product in stock that matches a spec.
+
+        :type spec: ProductSpec or Callable
+        :param spec: the wanted attributes, or a function that receives a product and
+        returns True if it's acceptable (a function can't use the indexes)
+
+        :type exclude: Set
+        :param exclude: products that must be skipped
+
+        :returns the product or None
+        """
+        products = self._scan(spec, 1, exclude)
+        return products[0] if products else None
+
+    def matching(self, spec):
+        """
+        :returns the list of products in stock that match a spec, cheapest first
+        """
+        return self._scan(spec, None)
+
+    def _scan(self, spec, limit, exclude=()):
+        """
+        Scans the smallest index that contains the matches of a spec, in price order.
+
+        :returns the list of at most limit matching products (all of them if limit is None)
+        """
+        if not isinstance(spec, ProductSpec):
+            key, predicate, min_price, max_price = (), spec, None, None
+        else:
+            key, predicate = _query_key(spec), spec.matches
+            min_price, max_price = spec.min_price, spec.max_price
+            if key == ("Coffee",) and (spec.min_acidity is not None
+                                       or spec.max_acidity is not None):
+                return self._scan_acidity(spec, limit, exclude)
+        products = []
+        with self.lock:
+            index = self.indexes.get(key, [])
+            start = 0 if min_price is None else bisect_left(index, (min_price,))
+            for position in range(start, len(index)):
+                price, _, product = index[position]
+                if max_price is not None and price > max_price:
+                    break
+                if product not in exclude and predicate(product):
+                    products.append(product)
+                    if len(products) == limit:
+                        break
+        return products
+
+    def _scan_acidity(self, spec, limit, exclude):
+        """
+        Finds the coffees in the acidity range of a spec with the acidity index.
+
+        :returns the list of at most limit matching products, cheapest first
+        """
+        low = -math.inf if spec.min_acidity is None else spec.min_acidity
+        high = math.inf if spec.max_acidity is None else spec.max_acidity
+        with self.lock:
+            start = bisect_left(self.acidity_index, (low,))
+            end = bisect_right(self.acidity_index, (high, math.inf))
+            entries = [self.entries[product] for _, _, product in self.acidity_index[start:end]
+                       if product not in exclude and spec.matches(product)]
+        entries.sort()
+        return [product for _, _, product in entries[:limit]]
+
+
+def _acidity_entry(entry):
+    """
+    :returns the entry of a coffee in the acidity index, from its price entry
+    """
+    _, sequence, product = entry
+    return float(product.acidity), sequence, product
+
+
+def _index_keys(product):
+    """
+    :returns the keys of the indexes that contain a product
+    """
+    kind = type(product).__name__
+    return [(), (kind,)] + [(kind, field, getattr(product, field))
+                            for field in CATEGORICAL_FIELDS.get(kind, ())]
+
+
+def _query_key(spec):
+    """
+    :returns the key of the smallest index that contains all the matches of a spec
+    """
+    kind = spec.kind()
+    if kind is None:
+        return ()
+    for field in CATEGORICAL_FIELDS.get(kind, ()):
+        if getattr(spec, field) is not None:
+            return kind, field, getattr(spec, field)
+    return (kind,)
+
+
+class TestProductCatalog(unittest.TestCase):
+    """
+    Unit testing class for ProductCatalog functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Adds 2 coffees and 2 teas to a catalog.
+        """
+        self.catalog = ProductCatalog()
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.product2 = Coffee(name="Ethiopia", acidity="5.09", roast_level="DARK", price=10)
+        self.product3 = Tea(name="Wild Cherry", type="Black", price=3)
+        for product in (self.product2, self.product1, self.product0, self.product3):
+            self.catalog.add(product)
+
+    def test_queries(self):
+        """
+        Tests that queries return the matching products in stock, cheapest first.
+        """
+        self.assertEqual(self.catalog.cheapest(ProductSpec()), self.product0,
+                         'Wrong cheapest product!')
+        self.assertEqual(self.catalog.matching(ProductSpec(product_type="Tea")),
+                         [self.product3, self.product1], 'Wrong teas!')
+        self.assertEqual(self.catalog.cheapest(ProductSpec(type="Herbal", max_price=5)), None,
+                         'No herbal tea under 5!')
+        self.assertEqual(self.catalog.cheapest(ProductSpec(roast_level="DARK")), self.product2,
+                         'Wrong dark coffee!')
+        self.assertEqual(self.catalog.matching(ProductSpec(min_price=3, max_price=9)),
+                         [self.product3, self.product1], 'Wrong price range!')
+        self.assertEqual(self.catalog.cheapest(ProductSpec(min_acidity=5.06)), self.product2,
+                         'Wrong acidity range!')
+        self.assertEqual(self.catalog.matching(ProductSpec(min_acidity=5.0, max_acidity=5.06)),
+                         [self.product0], 'Wrong acidity range!')
+        self.assertEqual(self.catalog.cheapest(lambda product: product.price > 5),
+                         self.product1, 'Wrong predicate match!')
+        self.assertEqual(self.catalog.cheapest(ProductSpec(), {self.product0, self.product3}),
+                         self.product1, 'Product0 and product3 are excluded!')
+
+    def test_stock_changes(self):
+        """
+        Tests that the products out of stock are not returned.
+        """
+        self.catalog.remove(self.product3)
+        self.assertEqual(self.catalog.cheapest(ProductSpec(product_type="Tea")), self.product1,
+                         'Product3 is out of stock!')
+        self.catalog.remove(self.product0)
+        self.assertEqual(self.catalog.cheapest(ProductSpec(max_acidity=5.1)), self.product2,
+                         'Product0 is out of stock!')
+        self.catalog.add(self.product0)
+        self.catalog.add(self.product3)
+        self.assertEqual(self.catalog.cheapest(ProductSpec(product_type="Tea")), self.product3,
+                         'Product3 is in stock again!')
+        self.catalog.reset([self.product2])
+        self.assertEqual(self.catalog.matching(ProductSpec()), [self.product2],
+                         'Only product2 is in stock!')
+
+    def test_conflicting_spec(self):
+        """
+        Tests that a spec mixing the fields of tea and coffee is rejected.
+        """
+        with self.assertRaises(ValueError):
+            ProductSpec(product_type="Tea", min_acidity=5.0)
+        with self.assertRaises(ValueError):
+            ProductSpec(product_type="Tea", roast_level="DARK")
+        with self.assertRaises(ValueError):
+            ProductSpec(type="Herbal", max_acidity=5.1)
+        self.assertFalse(ProductSpec(product_type="Coffee", max_acidity=5.1).matches(
+            self.product1), 'A tea has no acidity!')
+
+    def test_add_matching_to_cart(self):
+        """
+        Tests that a Marketplace adds to a cart the cheapest product in stock matching
+        a spec and that it forgets the demand of the cart.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5)
+        medium0 = Coffee(name="Arabica", acidity="5.02", roast_level="MEDIUM", price=9)
+        medium1 = Coffee(name="Ethiopia", acidity="5.09", roast_level="MEDIUM", price=10)
+        producer_id = marketplace.register_producer()
+        for product in (self.product0, self.product1, medium1, medium1, medium0):
+            marketplace.publish(producer_id, product)
+        cart_id = marketplace.new_cart()
+        mint = Tea(name="Mint", type="Herbal", price=2)
+        self.assertFalse(marketplace.add_to_cart(cart_id, mint), 'Mint is not available!')
+        medium_coffee = ProductSpec(roast_level="MEDIUM", min_price=5)
+        self.assertEqual(marketplace.add_matching_to_cart(cart_id, medium_coffee), medium0,
+                         'Arabica is the cheapest match!')
+        self.assertEqual(marketplace.unmet_demand(), {}, 'The cart was served!')
+        self.assertEqual(marketplace.add_matching_to_cart(cart_id, medium_coffee), medium1,
+                         'Arabica is out of stock!')
+        self.assertIsNone(marketplace.add_matching_to_cart(cart_id, ProductSpec(
+            type="Herbal", max_price=5)), 'No herbal tea under 5!')
+        marketplace.remove_from_cart(cart_id, medium0)
+        self.assertEqual(marketplace.catalog.cheapest(medium_coffee), medium0,
+                         'Arabica is back in stock!')
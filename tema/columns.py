@@ -0,0 +1,31 @@
+"""
+This module holds the helpers shared by the NumPy tables: the optional import of
+NumPy and the interning of the values stored as small ints.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+try:
+    import numpy as np  # pylint: disable=unused-import
+except ImportError:
+    np = None
+
+
+def intern(values, index, value):
+    """
+    Returns the index of value in values, appending it if needed.
+
+    :type values: List
+    :param values: the interned values, in order of first appearance
+
+    :type index: Dictionary
+    :param index: key: value, value: its position in values
+    """
+    position = index.get(value)
+    if position is None:
+        position = len(values)
+        values.append(value)
+        index[value] = position
+    return position
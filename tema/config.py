@@ -0,0 +1,50 @@
+"""
+This module loads the market configuration from a test input file.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from json import loads
+
+from tema.product import Coffee, Tea
+
+# Product classes that can appear in the "product_type" field
+PRODUCT_TYPES = {"Coffee": Coffee, "Tea": Tea}
+
+
+def load_market_config(filename):
+    """
+    Reads a market configuration file and replaces the product ids with actual products,
+    in the producers and in the consumer operations.
+
+    :type filename: String
+    :param filename: the path of the .in file
+
+    :returns a dictionary with the keys: producers, consumers and marketplace
+    """
+    with open(filename, encoding="utf-8") as input_file:
+        market_config = loads(input_file.read())
+
+    # turn product definitions into actual products
+    products = {}
+
+    for k, products_dict in market_config['products'].items():
+        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
+        products[k] = PRODUCT_TYPES[products_dict['product_type']](**params)
+    del market_config['products']
+
+    # turn product ids into products in producers
+    for producer in market_config['producers']:
+        producer['products'] = [(products[i], quantity, sleep_time)
+                                for i, quantity, sleep_time
+                                in producer['products']]
+
+    # turn product ids into products in consumer order lists and expected carts
+    for consumer in market_config['consumers']:
+        for cart in consumer['carts']:
+            for operation in cart:
+                operation['product'] = products[operation['product']]
+
+    return market_config
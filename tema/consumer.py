@@ -7,7 +7,9 @@ March 2021
 """
 
 from threading import Thread
-from time import sleep
+
+from tema.priorities import DEFAULT_PRIORITY
+from tema.progress import MarketplaceStalled
 
 
 class Consumer(Thread):
@@ -27,39 +29,35 @@ class Consumer(Thread):
 
         :type retry_wait_time: Time
         :param retry_wait_time: the number of seconds that a producer must wait
-        until the Marketplace becomes available
+        until the Marketplace becomes available (kept for compatibility, it is no
+        longer used: execute_cart() blocks until the products become available)
 
         :type kwargs:
-        :param kwargs: other arguments that are passed to the Thread's __init__()
+        :param kwargs: other arguments that are passed to the Thread's __init__(),
+        and the optional priority class of the consumer's carts
         """
         Thread.__init__(self)
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
         self.name = kwargs["name"]
+        self.priority = kwargs.get("priority", DEFAULT_PRIORITY)
 
     def run(self):
         """
         This function describes what a consumer is doing.
         """
-        # For each cart
-        for cart in self.carts:
-            # Register cart
-            cart_id = self.marketplace.new_cart()
-            # For each operation in the cart
-            for operation in cart:
-                # If the operation is an add
-                if operation["type"] == "add":
-                    for _ in range(operation["quantity"]):
-                        while not self.marketplace.add_to_cart(cart_id, operation["product"]):
-                            # Wait if product is unavailable
-                            sleep(self.retry_wait_time)
-                elif operation["type"] == "remove":
-                    # If the operation is a remove
-                    for _ in range(operation["quantity"]):
-                        self.marketplace.remove_from_cart(cart_id, operation["product"])
-            # After all operations, place the order
-            order = self.marketplace.place_order(cart_id)
-            # Print the result of placing the order
-            for product in order:
-                print("{0} bought {1}".format(self.name, product))
+        try:
+            # For each cart
+            for cart in self.carts:
+                # Net the add and remove operations, wait for the products
+                # and place the order, all in a single call
+                order = self.marketplace.execute_cart(cart, consumer=self.name,
+                                                      priority=self.priority)
+                # Print the result of placing the order
+                for product in order:
+                    print("{0} bought {1}".format(self.name, product))
+        except MarketplaceStalled:
+            # The Marketplace is deadlocked (it already reported why),
+            # the remaining carts can't be bought
+            pass
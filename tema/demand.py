@@ -0,0 +1,163 @@
+"""
+This module keeps the products the consumers failed to get, so the producers can
+make them on demand.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Condition, Thread
+import unittest
+
+from tema.product import Coffee, Tea
+
+
+class DemandTracker:
+    """
+    Remembers the product each cart failed to add last time (one unit) and wakes up
+    the producers waiting for demand. The quantities of the carts waiting in
+    execute_cart() are kept by PriorityClasses, the Marketplace adds them.
+    """
+
+    def __init__(self):
+        # Dictionary with key: cart_id, value: the product add_to_cart() couldn't add
+        # to the cart last time
+        self.pending = {}
+        # Condition that protects pending, used to wake up the producers idling in wait()
+        self.condition = Condition()
+
+    def wanted(self, cart_id, product):
+        """
+        Records that a cart couldn't add a product and wakes up the producers.
+        """
+        with self.condition:
+            self.pending[cart_id] = product
+            self.condition.notify_all()
+
+    def met(self, cart_id):
+        """
+        Forgets the product a cart couldn't add, once it adds a product or orders.
+        """
+        if self.pending:
+            with self.condition:
+                self.pending.pop(cart_id, None)
+
+    def notify(self):
+        """
+        Wakes up the producers, for example when a cart starts waiting for stock.
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def unmet(self, waiting, stock_of, products=None):
+        """
+        Computes the units that are wanted and not available.
+
+        :type waiting: Iterable
+        :param waiting: the quantities (dictionaries product -> units) the carts
+        waiting for stock need
+
+        :type stock_of: Callable
+        :param stock_of: function that receives the wanted products and returns
+        a dictionary with key: product, value: number of available units
+
+        :type products: List
+        :param products: the products of interest (None for all of them)
+
+        :returns a dictionary with key: product, value: number of missing units
+        (only the products with missing units)
+        """
+        wanted = {}
+        for quantities in waiting:
+            for product, quantity in quantities.items():
+                wanted[product] = wanted.get(product, 0) + quantity
+        with self.condition:
+            pending = list(self.pending.values())
+        for product in pending:
+            wanted[product] = wanted.get(product, 0) + 1
+        stock = stock_of(wanted)
+        return {product: quantity - stock[product]
+                for product, quantity in wanted.items()
+                if quantity > stock[product] and (products is None or product in products)}
+
+    def wait(self, unmet, timeout):
+        """
+        Waits until unmet() returns some demand, or until the timeout expires.
+
+        :type unmet: Callable
+        :param unmet: function that returns the demand the caller is interested in
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait
+
+        :returns the last result of unmet()
+        """
+        # The Condition is reentrant, the demand is checked with it held so that
+        # a notification can't be missed between the check and the wait
+        with self.condition:
+            demand = unmet()
+            if not demand:
+                self.condition.wait(timeout)
+                demand = unmet()
+        return demand
+
+
+class TestDemandTracker(unittest.TestCase):
+    """
+    Unit testing class for DemandTracker functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        """
+        self.demand = DemandTracker()
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+
+    def test_unmet(self):
+        """
+        Tests that the waiting and the failed carts are counted as demand, minus the
+        available units.
+        """
+        stock = {self.product0: 1}
+
+        def stock_of(products):
+            return {product: stock.get(product, 0) for product in products}
+
+        self.demand.wanted(0, self.product1)
+        self.demand.wanted(1, self.product0)
+        self.assertEqual(self.demand.unmet([{self.product0: 3}], stock_of),
+                         {self.product0: 3, self.product1: 1}, 'Wrong demand!')
+        self.assertEqual(self.demand.unmet([], stock_of, [self.product1]),
+                         {self.product1: 1}, 'Only product1 is of interest!')
+        self.demand.met(0)
+        self.demand.met(1)
+        self.assertEqual(self.demand.unmet([], stock_of), {}, 'No demand should be left!')
+
+    def test_unmet_demand(self):
+        """
+        Tests that the Marketplace counts its waiting and failed carts as demand and
+        that an idle producer is woken up by the demand.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5)
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, self.product0)
+        cart_id = marketplace.new_cart()
+        self.assertFalse(marketplace.add_to_cart(cart_id, self.product1),
+                         'Product1 is not available!')
+        self.assertEqual(marketplace.unmet_demand(), {self.product1: 1}, 'Wrong demand!')
+        operations = [{"type": "add", "product": self.product0, "quantity": 3}]
+        buyer = Thread(target=marketplace.execute_cart, args=(operations, 5))
+        buyer.start()
+        self.assertEqual(marketplace.wait_for_demand([self.product0], 5), {self.product0: 2},
+                         'The waiting cart misses 2 units of product0!')
+        for _ in range(3):
+            marketplace.publish(producer_id, self.product0)
+        buyer.join()
+        self.assertTrue(marketplace.add_to_cart(cart_id, self.product0),
+                        'Cannot add product0 to cart!')
+        self.assertEqual(marketplace.unmet_demand(), {}, 'No demand should be left!')
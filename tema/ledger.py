@@ -0,0 +1,269 @@
+"""
+This module records the placed orders in a columnar ledger.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Lock
+import time
+import unittest
+
+from tema.columns import intern, np
+from tema.product import Coffee, Tea
+
+# Number of rows allocated by an empty ledger
+INITIAL_CAPACITY = 1024
+
+
+class OrderLedger:
+    """
+    Append-only ledger of the ordered units. Each unit is a row stored in parallel
+    NumPy arrays (columns): cart id, consumer, product, producer, price and timestamp.
+    Consumers, products and producers are interned, their columns hold small ints.
+
+    The columns double their capacity when full, so appends are amortised O(1).
+    Rows are never changed once written and growing replaces the arrays, so the
+    queries only hold the lock while they take references to the filled part of the
+    columns and compute everything else without blocking the appends.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        """
+        Constructor
+
+        :type capacity: Int
+        :param capacity: the number of rows allocated at the beginning
+        """
+        if np is None:
+            raise ImportError("The order ledger needs NumPy")
+        self.size = 0
+        self.cart_ids = np.empty(capacity, dtype=np.int64)
+        self.consumers = np.empty(capacity, dtype=np.int32)
+        self.products = np.empty(capacity, dtype=np.int32)
+        self.producers = np.empty(capacity, dtype=np.int32)
+        self.prices = np.empty(capacity, dtype=np.float64)
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        # Interned values: list of values and dictionary value -> index
+        self.consumer_names, self.consumer_index = [], {}
+        self.product_list, self.product_index = [], {}
+        self.producer_names, self.producer_index = [], {}
+        # Lock used to avoid race condition between appends
+        self.lock = Lock()
+
+    def append_order(self, cart_id, consumer, cart_elements, timestamp=None):
+        """
+        Appends the units of an order.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type consumer: String
+        :param consumer: the name of the consumer (None if unknown)
+
+        :type cart_elements: List
+        :param cart_elements: the ordered units ({"product": ..., "producer_id": ...})
+
+        :type timestamp: Float
+        :param timestamp: the moment of the order (time.time() if missing)
+        """
+        count = len(cart_elements)
+        if count == 0:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.size + count > len(self.cart_ids):
+                self._grow(self.size + count)
+            start, end = self.size, self.size + count
+            self.cart_ids[start:end] = cart_id
+            self.consumers[start:end] = intern(self.consumer_names, self.consumer_index,
+                                               consumer)
+            self.products[start:end] = [intern(self.product_list, self.product_index,
+                                               cart_element["product"])
+                                        for cart_element in cart_elements]
+            self.producers[start:end] = [intern(self.producer_names, self.producer_index,
+                                                cart_element["producer_id"])
+                                         for cart_element in cart_elements]
+            self.prices[start:end] = [cart_element["product"].price
+                                      for cart_element in cart_elements]
+            self.timestamps[start:end] = timestamp
+            self.size = end
+
+    def _grow(self, needed):
+        """
+        Doubles the capacity of the columns until they can hold needed rows.
+        """
+        capacity = len(self.cart_ids)
+        while capacity < needed:
+            capacity *= 2
+        for column in ("cart_ids", "consumers", "products", "producers",
+                       "prices", "timestamps"):
+            old = getattr(self, column)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def columns(self):
+        """
+        Returns read-only views of the filled part of the columns.
+
+        :returns a dictionary with key: column name, value: NumPy array
+        """
+        with self.lock:
+            size = self.size
+            columns = {"cart_id": self.cart_ids[:size], "consumer": self.consumers[:size],
+                       "product": self.products[:size], "producer": self.producers[:size],
+                       "price": self.prices[:size], "timestamp": self.timestamps[:size]}
+        for column in columns.values():
+            column.flags.writeable = False
+        return columns
+
+    def __len__(self):
+        return self.size
+
+    def revenue_by_product(self):
+        """
+        :returns a dictionary with key: product, value: total price of its ordered units
+        """
+        columns = self.columns()
+        revenue = np.bincount(columns["product"], weights=columns["price"],
+                              minlength=len(self.product_list))
+        return dict(zip(self.product_list, revenue.tolist()))  # pylint: disable=no-member
+
+    def revenue_by_producer(self):
+        """
+        :returns a dictionary with key: producer_id, value: total price of its ordered units
+        """
+        columns = self.columns()
+        revenue = np.bincount(columns["producer"], weights=columns["price"],
+                              minlength=len(self.producer_names))
+        return dict(zip(self.producer_names, revenue.tolist()))  # pylint: disable=no-member
+
+    def units_by_product(self):
+        """
+        :returns a dictionary with key: product, value: number of ordered units
+        """
+        units = np.bincount(self.columns()["product"], minlength=len(self.product_list))
+        return dict(zip(self.product_list, units.tolist()))  # pylint: disable=no-member
+
+    def units_per_bucket(self, bucket_seconds, start=None):
+        """
+        Counts the ordered units in consecutive time intervals.
+
+        :type bucket_seconds: Float
+        :param bucket_seconds: the length of an interval
+
+        :type start: Float
+        :param start: the beginning of the first interval (the first order if missing)
+
+        :returns a tuple (array with the beginning of each interval, array of units)
+        """
+        timestamps = self.columns()["timestamp"]
+        if len(timestamps) == 0:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        if start is None:
+            start = timestamps.min()
+        buckets = ((timestamps - start) // bucket_seconds).astype(np.int64)
+        units = np.bincount(buckets)
+        return start + bucket_seconds * np.arange(len(units)), units
+
+    def top_sellers(self, count, by_revenue=False):
+        """
+        Returns the best sold products.
+
+        :type count: Int
+        :param count: the number of products to return
+
+        :type by_revenue: Bool
+        :param by_revenue: True to rank by total price, False to rank by ordered units
+
+        :returns a list of (product, units or revenue), best first
+        """
+        columns = self.columns()
+        weights = columns["price"] if by_revenue else None
+        totals = np.bincount(columns["product"], weights=weights,
+                             minlength=len(self.product_list))
+        count = min(count, len(totals))
+        if count == 0:
+            return []
+        best = np.argpartition(-totals, count - 1)[:count]  # pylint: disable=invalid-unary-operand-type
+        best = best[np.argsort(-totals[best], kind="stable")]
+        return [(self.product_list[index], totals[index].item()) for index in best]
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestOrderLedger(unittest.TestCase):
+    """
+    Unit testing class for OrderLedger functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Records 3 orders in a ledger that has to grow.
+        """
+        self.ledger = OrderLedger(capacity=2)
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.ledger.append_order(0, "cons1", [{"product": self.product0, "producer_id": "prod0"},
+                                              {"product": self.product1, "producer_id": "prod1"},
+                                              {"product": self.product1, "producer_id": "prod1"}],
+                                 timestamp=100.0)
+        self.ledger.append_order(1, "cons2", [{"product": self.product0, "producer_id": "prod1"}],
+                                 timestamp=100.5)
+        self.ledger.append_order(2, "cons1", [{"product": self.product0, "producer_id": "prod0"}],
+                                 timestamp=102.0)
+
+    def test_columns(self):
+        """
+        Tests that every ordered unit is a row.
+        """
+        columns = self.ledger.columns()
+        self.assertEqual(len(self.ledger), 5, 'Wrong number of rows!')
+        self.assertEqual(columns["cart_id"].tolist(), [0, 0, 0, 1, 2], 'Wrong cart ids!')
+        self.assertEqual(columns["consumer"].tolist(), [0, 0, 0, 1, 0], 'Wrong consumers!')
+        self.assertEqual(columns["price"].tolist(), [1, 9, 9, 1, 1], 'Wrong prices!')
+
+    def test_aggregates(self):
+        """
+        Tests the revenue, units and top sellers queries.
+        """
+        self.assertEqual(self.ledger.revenue_by_product(),
+                         {self.product0: 3, self.product1: 18}, 'Wrong revenue per product!')
+        self.assertEqual(self.ledger.revenue_by_producer(), {"prod0": 2, "prod1": 19},
+                         'Wrong revenue per producer!')
+        self.assertEqual(self.ledger.units_by_product(), {self.product0: 3, self.product1: 2},
+                         'Wrong units per product!')
+        self.assertEqual(self.ledger.top_sellers(1), [(self.product0, 3)],
+                         'Wrong top seller by units!')
+        self.assertEqual(self.ledger.top_sellers(1, by_revenue=True), [(self.product1, 18)],
+                         'Wrong top seller by revenue!')
+        starts, units = self.ledger.units_per_bucket(1.0)
+        self.assertEqual(starts.tolist(), [100.0, 101.0, 102.0], 'Wrong buckets!')
+        self.assertEqual(units.tolist(), [4, 0, 1], 'Wrong units per bucket!')
+
+    def test_record_orders(self):
+        """
+        Tests that placed orders are recorded in the ledger.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5, record_orders=True)
+        producer_id = marketplace.register_producer()
+        for product in (self.product0, self.product1, self.product1):
+            marketplace.publish(producer_id, product)
+        cart_id = marketplace.new_cart("cons1")
+        marketplace.add_to_cart(cart_id, self.product1)
+        marketplace.add_to_cart(cart_id, self.product0)
+        marketplace.place_order(cart_id)
+        marketplace.execute_cart([{"type": "add", "product": self.product1, "quantity": 1}],
+                                 consumer="cons2")
+        self.assertEqual(marketplace.ledger.columns()["cart_id"].tolist(), [0, 0, 1],
+                         'Wrong cart ids in ledger!')
+        self.assertEqual(marketplace.ledger.consumer_names, ["cons1", "cons2"],
+                         'Wrong consumers in ledger!')
+        self.assertEqual(marketplace.ledger.revenue_by_product(),
+                         {self.product1: 18, self.product0: 1}, 'Wrong revenue in ledger!')
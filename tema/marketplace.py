@@ -5,12 +5,25 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
+import sys
 import time
-from threading import Lock
+from threading import Condition, Lock
 import unittest
 import logging
 from logging.handlers import RotatingFileHandler
-from tema.product import Coffee, Tea
+from tema.bulk import net_quantities, release, reserve_all, wait_for_stock
+from tema.capacity import CapacityManager
+from tema.catalog import ProductCatalog
+from tema.demand import DemandTracker
+from tema.ledger import OrderLedger
+from tema.matrix import InventoryMatrix
+from tema.persistence import load_marketplace, save_marketplace
+from tema.priorities import DEFAULT_PRIORITY, PriorityClasses
+from tema.product import Coffee, Product, Tea
+from tema.progress import MarketplaceStalled, ProgressMonitor
+from tema.reservations import ReservationTracker
+from tema.snapshot import InventoryStats
+from tema.tracing import TracedLock, traced
 
 
 class Marketplace:
@@ -20,14 +33,59 @@ class Marketplace:
     """
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, *, reservation_ttl=None,
+                 stall_timeout=None, abort_on_stall=False, record_orders=False, tracer=None,
+                 priority_shares=None, adaptive_capacity=False, inventory_matrix=False):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type reservation_ttl: Float
+        :param reservation_ttl: the number of seconds a unit can stay in a cart before it
+        is returned to the Marketplace (None means that reservations never expire)
+
+        :type stall_timeout: Float
+        :param stall_timeout: the number of seconds without any successful publish,
+        add_to_cart or place_order after which the waiting consumers are considered
+        deadlocked (None disables the detection)
+
+        :type abort_on_stall: Bool
+        :param abort_on_stall: True if add_to_cart should raise MarketplaceStalled
+        once the Marketplace is considered deadlocked
+
+        :type record_orders: Bool
+        :param record_orders: True if the ordered units should be recorded in an
+        OrderLedger (needs NumPy)
+
+        :type tracer: Tracer
+        :param tracer: records the calls, the carts and the lock waits as spans
+        (None disables tracing)
+
+        :type priority_shares: Dictionary
+        :param priority_shares: key: priority, value: the fraction of the stock of each
+        product reserved for the carts of that priority or of a higher one
+
+        :type adaptive_capacity: Bool
+        :param adaptive_capacity: True if the total capacity of the producers should be
+        shared according to the demand for their products (see CapacityManager), instead
+        of giving each one queue_size_per_producer slots
+
+        :type inventory_matrix: Bool
+        :param inventory_matrix: True if the units of each producer should be counted
+        in an InventoryMatrix, for vectorised stock queries (needs NumPy)
         """
         self.queue_size_per_producer = queue_size_per_producer
+        # The other options (the tracer aside), kept so a recording of the calls
+        # can be replayed on an identical Marketplace
+        self.options = {"reservation_ttl": reservation_ttl, "stall_timeout": stall_timeout,
+                        "abort_on_stall": abort_on_stall, "record_orders": record_orders,
+                        "priority_shares": priority_shares,
+                        "adaptive_capacity": adaptive_capacity,
+                        "inventory_matrix": inventory_matrix}
+        # Records the spans, if enabled (set first, the locks depend on it)
+        self.tracer = tracer
         # Dictionary with key: producer_id, value: number of products in queue
         self.producers_queue = {}
         # Dictionary with key: cart_id, value: list of products from cart
@@ -37,9 +95,9 @@ class Marketplace:
         # Variable used to add new carts
         self.cart_id = 0
         # Lock used to avoid race condition from producers register
-        self.producer_id_lock = Lock()
+        self.producer_id_lock = self.new_lock()
         # Lock used to avoid race condition from adding new carts
-        self.cart_id_lock = Lock()
+        self.cart_id_lock = self.new_lock()
         # Dictionary with key: producer_id, value: a Lock used to avoid race condition when
         # we modify the queue size of the producer (for example the producer publish a product
         # and a consumer places an order which contains products from this producer)
@@ -53,6 +111,46 @@ class Marketplace:
         # after that each one pops the queue products_producers[product1] and the second
         # pop will give us an error (we will pop an empty queue)
         self.products_locks = {}
+        # Lock used to avoid race condition when two producers publish a new product
+        self.new_products_lock = self.new_lock()
+        # Dictionary with key: cart_id, value: a Lock used to avoid race condition when
+        # the cart is changed by its consumer and by the expiration of its reservations
+        self.carts_locks = {}
+        # Condition used to wake up the consumers waiting in execute_cart() when
+        # units become available, and the number of such consumers
+        self.stock_condition = Condition()
+        self.stock_waiters = 0
+        # Products the carts failed to add, used to wake up the producers idling in
+        # wait_for_demand() when a product is wanted
+        self.demand = DemandTracker()
+        # Indexes of the products in stock by their attributes, kept up to date
+        # by the inventory counters
+        self.catalog = ProductCatalog()
+        # Producers x products unit counts, if enabled
+        self.matrix = InventoryMatrix() if inventory_matrix else None
+        # Counters of the inventory, used to build consistent snapshots
+        self.inventory = InventoryStats(self.catalog, self.matrix)
+        # Keeps the deadlines of the units from carts, if reservations can expire
+        self.reservations = None
+        if reservation_ttl is not None:
+            self.reservations = ReservationTracker(reservation_ttl)
+        # Records the ordered units, if enabled
+        self.ledger = OrderLedger() if record_orders else None
+        # Dictionary with key: cart_id, value: the name of the consumer who owns the cart
+        self.carts_consumers = {}
+        # Dictionary with key: cart_id, value: the priority of the cart, if it's not
+        # the default one
+        self.carts_priorities = {}
+        # Units held back for the higher priority classes and latencies of each class
+        self.priorities = PriorityClasses(priority_shares)
+        # Quotas of the producers, if they adapt to the demand
+        self.capacity = None
+        if adaptive_capacity:
+            self.capacity = CapacityManager(queue_size_per_producer)
+        # Detects the deadlocks, if enabled
+        self.progress = None
+        if stall_timeout is not None:
+            self.progress = ProgressMonitor(stall_timeout, abort_on_stall)
         # Used for logging
         self.logger = logging.getLogger('my_logger')
         self.logger.setLevel(logging.INFO)
@@ -74,7 +172,10 @@ class Marketplace:
         # Queue of this producer will be empty
         self.producers_queue[producer_id_string] = 0
         # Initialise the lock for this producer
-        self.producers_locks[producer_id_string] = Lock()
+        self.producers_locks[producer_id_string] = self.new_lock()
+        self.inventory.register_producer(producer_id_string)
+        if self.capacity is not None:
+            self.capacity.register(producer_id_string)
         # Increments the id
         self.producer_id += 1
         # Release the lock which protects producer_id
@@ -83,6 +184,7 @@ class Marketplace:
                          producer_id_string)
         return producer_id_string
 
+    @traced()
     def publish(self, producer_id, product):
         """
         Adds the product provided by the producer to the marketplace
@@ -96,38 +198,52 @@ class Marketplace:
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
         self.logger.info("Entered publish(%s, %s)!", producer_id, product)
+        # Expired reservations may free space in the queue of the producer
+        self.expire_reservations()
         # Acquire the lock which protects the queue size of the producer
         self.producers_locks[producer_id].acquire()
         # Extracts the queue size
         queue_size = self.producers_queue[producer_id]
-        # If queue is full, we cannot publish the product
-        if queue_size == self.queue_size_per_producer:
+        # If queue is full, we cannot publish the product (unless a slot can be
+        # borrowed, the quota of a producer may even drop under its queue size)
+        if queue_size >= self._quota(producer_id) and \
+                not self._borrow_slot(producer_id, product, queue_size):
             # Release the lock
             self.producers_locks[producer_id].release()
             self.logger.info("Finished publish(%s, %s): Queue is Full!",
                              producer_id, product)
+            if self.progress is not None:
+                self.progress.producer_waits(producer_id, product)
+                self._check_progress()
             return False
         # Marks the product as available at producer_id
-        if product not in self.products_producers:
-            self.products_locks[product] = Lock()
-            self.products_locks[product].acquire()
-            self.products_producers[product] = []
-        else:
-            self.products_locks[product].acquire()
+        product_lock = self._product_lock(product)
+        product_lock.acquire()
         self.products_producers[product].append(producer_id)
-        self.products_locks[product].release()
+        self.inventory.published(producer_id, product)
+        product_lock.release()
         # Increments queue size
         self.producers_queue[producer_id] += 1
         # Release the lock
         self.producers_locks[producer_id].release()
+        self._notify_stock()
+        if self.progress is not None:
+            self.progress.producer_done(producer_id)
+            self.progress.progress("publish")
         self.logger.info("Finished publish(%s, %s): Published product!",
                          producer_id, product)
         return True
 
-    def new_cart(self):
+    def new_cart(self, consumer=None, priority=DEFAULT_PRIORITY):
         """
         Creates a new cart for the consumer
 
+        :type consumer: String
+        :param consumer: the name of the consumer, recorded with its orders
+
+        :type priority: Int
+        :param priority: the priority class of the cart (higher is more important)
+
         :returns an int representing the cart_id
         """
         self.logger.info("Entered new_cart()!")
@@ -136,6 +252,13 @@ class Marketplace:
         cart_id = self.cart_id
         # Creates new cart with cart_id
         self.carts[cart_id] = []
+        self.carts_locks[cart_id] = self.new_lock()
+        if consumer is not None:
+            self.carts_consumers[cart_id] = consumer
+        if priority != DEFAULT_PRIORITY:
+            self.carts_priorities[cart_id] = priority
+        if self.tracer is not None:
+            self.tracer.begin_cart(cart_id)
         # Increments cart_id
         self.cart_id += 1
         # Release the lock
@@ -143,6 +266,7 @@ class Marketplace:
         self.logger.info("Finished new_cart(): New cart: %d!", cart_id)
         return cart_id
 
+    @traced(cart_method=True)
     def add_to_cart(self, cart_id, product):
         """
         Adds a product to the given cart. The method returns
@@ -161,30 +285,68 @@ class Marketplace:
             self.logger.info("Finished add_to_cart(%d, %s): Cart doesn't exist!",
                              cart_id, product)
             return False
+        # Units held for too long by other carts become available again
+        self.expire_reservations()
         # Checks if product is available at any producer
         if product not in self.products_producers:
             self.logger.info("Finished add_to_cart(%d, %s): Product is not available!",
                              cart_id, product)
-            return False
-        self.products_locks[product].acquire()
-        if not self.products_producers[product]:
-            self.products_locks[product].release()
+            return self._product_unavailable(cart_id, product)
+        producer_id = self._take_unit(cart_id, product)
+        if producer_id is None:
             self.logger.info("Finished add_to_cart(%d, %s): Product is not available!",
                              cart_id, product)
-            return False
-        # Extracts one producer that has the product available
-        # Makes product unavailable
-        producer_id = self.products_producers[product].pop(0)
-        self.products_locks[product].release()
-        # Adds product to the cart, knowing what is the producer of the product
-        # so in case of removing, the product will become available again from
-        # this producer
-        self.carts[cart_id].append({"product": product,
-                                    "producer_id": producer_id})
+            return self._product_unavailable(cart_id, product)
+        self.demand.met(cart_id)
+        if self.progress is not None:
+            self.progress.cart_done(cart_id)
+            self.progress.progress("add_to_cart")
         self.logger.info("Finished add_to_cart(%d, %s): Product added to cart!",
                          cart_id, product)
         return True
 
+    @traced(cart_method=True)
+    def add_matching_to_cart(self, cart_id, spec):
+        """
+        Adds to the given cart the cheapest product in stock that matches a spec.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type spec: ProductSpec or Callable
+        :param spec: the wanted attributes, or a function that receives a product
+        and returns True if it's acceptable
+
+        :returns the added product or None if no product in stock matches
+        """
+        self.logger.info("Entered add_matching_to_cart(%d, %s)!", cart_id, spec)
+        if cart_id not in self.carts:
+            self.logger.info("Finished add_matching_to_cart(%d, %s): Cart doesn't exist!",
+                             cart_id, spec)
+            return None
+        self.expire_reservations()
+        # Another consumer may take the last unit of the match first, or its units
+        # may be held back for the higher priority classes: the next cheapest match
+        # is tried, never the same product twice
+        tried = set()
+        product = self.catalog.cheapest(spec)
+        while product is not None and self._take_unit(cart_id, product) is None:
+            tried.add(product)
+            product = self.catalog.cheapest(spec, tried)
+        if product is None:
+            self.logger.info("Finished add_matching_to_cart(%d, %s): No product available!",
+                             cart_id, spec)
+            self._product_unavailable(cart_id, spec)
+            return None
+        self.demand.met(cart_id)
+        if self.progress is not None:
+            self.progress.cart_done(cart_id)
+            self.progress.progress("add_to_cart")
+        self.logger.info("Finished add_matching_to_cart(%d, %s): Added %s to cart!",
+                         cart_id, spec, product)
+        return product
+
+    @traced(cart_method=True)
     def remove_from_cart(self, cart_id, product):
         """
         Removes a product from cart.
@@ -201,23 +363,86 @@ class Marketplace:
             self.logger.info("Finished remove_from_cart(%d, %s): Cart doesn't exist!",
                              cart_id, product)
             return False
-        # Extracts the cart list
-        cart_list = self.carts[cart_id]
-        # Search for the product in the list
-        for cart_element in cart_list:
-            if cart_element["product"] == product:
-                # Makes product available from the producer
-                producer_id = cart_element["producer_id"]
-                self.products_producers[product].append(producer_id)
-                # Removes product from cart
-                self.carts[cart_id].remove(cart_element)
-                self.logger.info("Finished remove_from_cart(%d, %s): Product removed from cart!",
-                                 cart_id, product)
-                return True
+        removed = None
+        with self.carts_locks[cart_id]:
+            # Extracts the cart list
+            cart_list = self.carts[cart_id]
+            # Search for the product in the list
+            for index, cart_element in enumerate(cart_list):
+                if cart_element["product"] == product:
+                    # Removes product from cart
+                    removed = cart_list.pop(index)
+                    if self.reservations is not None:
+                        self.reservations.release(removed)
+                    # Makes product available from the producer
+                    self._return_to_stock(cart_id, product, removed["producer_id"])
+                    break
+        if removed is not None:
+            self._notify_stock()
+            self.logger.info("Finished remove_from_cart(%d, %s): Product removed from cart!",
+                             cart_id, product)
+            return True
         self.logger.info("Finished remove_from_cart(%d, %s): Product not found in cart!",
                          cart_id, product)
         return False
 
+    @traced(cart_method=True)
+    def clear_cart(self, cart_id):
+        """
+        Returns all the units from a cart to the Marketplace.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :returns the number of released units or None if the cart doesn't exist
+        """
+        self.logger.info("Entered clear_cart(%d)!", cart_id)
+        if cart_id not in self.carts:
+            self.logger.info("Finished clear_cart(%d): Cart doesn't exist!", cart_id)
+            return None
+        released = self._release([cart_id]).get(cart_id, 0)
+        self.logger.info("Finished clear_cart(%d): Released %d units!", cart_id, released)
+        return released
+
+    @traced(cart_method=True)
+    def release_product(self, cart_id, product):
+        """
+        Returns all the units of a product from a cart to the Marketplace.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :returns the number of released units or None if the cart doesn't exist
+        """
+        self.logger.info("Entered release_product(%d, %s)!", cart_id, product)
+        if cart_id not in self.carts:
+            self.logger.info("Finished release_product(%d, %s): Cart doesn't exist!",
+                             cart_id, product)
+            return None
+        released = self._release([cart_id], product).get(cart_id, 0)
+        self.logger.info("Finished release_product(%d, %s): Released %d units!",
+                         cart_id, product, released)
+        return released
+
+    @traced()
+    def release_carts(self, cart_ids):
+        """
+        Returns all the units from several carts to the Marketplace, at once.
+
+        :type cart_ids: List
+        :param cart_ids: ids of the carts (the ones that don't exist are ignored)
+
+        :returns the total number of released units
+        """
+        self.logger.info("Entered release_carts(%s)!", cart_ids)
+        released = sum(self._release(cart_ids).values())
+        self.logger.info("Finished release_carts(%s): Released %d units!", cart_ids, released)
+        return released
+
+    @traced(cart_method=True, ends_cart=True)
     def place_order(self, cart_id):
         """
         Return a list with all the products in the cart.
@@ -231,22 +456,372 @@ class Marketplace:
         if cart_id not in self.carts:
             self.logger.info("Finished place_order(%d): Cart doesn't exist!", cart_id)
             return None
-        # Extracts the cart list
-        cart_list = self.carts[cart_id]
-        # Remove each product from the queue of the producer who produced it
-        for cart_element in cart_list:
-            product = cart_element["product"]
-            result.append(product)
-            producer_id = cart_element["producer_id"]
-            # Use the lock to avoid race condition
-            self.producers_locks[producer_id].acquire()
-            self.producers_queue[producer_id] -= 1
-            self.producers_locks[producer_id].release()
-        # Cleans the cart list
-        self.carts[cart_id] = []
+        with self.carts_locks[cart_id]:
+            # Extracts the cart list
+            cart_list = self.carts[cart_id]
+            # Remove each product from the queue of the producer who produced it
+            for cart_element in cart_list:
+                product = cart_element["product"]
+                result.append(product)
+                producer_id = cart_element["producer_id"]
+                if self.reservations is not None:
+                    self.reservations.release(cart_element)
+                # Use the lock to avoid race condition
+                self.producers_locks[producer_id].acquire()
+                self.producers_queue[producer_id] -= 1
+                self.producers_locks[producer_id].release()
+            self.inventory.ordered(cart_id, cart_list)
+            if self.capacity is not None:
+                self.capacity.ordered([cart_element["producer_id"] for cart_element in cart_list])
+            if self.ledger is not None:
+                self.ledger.append_order(cart_id, self.carts_consumers.get(cart_id), cart_list)
+            # Cleans the cart list
+            self.carts[cart_id] = []
+        self.demand.met(cart_id)
+        if self.progress is not None:
+            self.progress.cart_done(cart_id)
+            self.progress.progress("place_order")
         self.logger.info("Finished place_order(%d): Order placed: %s!", cart_id, result)
         return result
 
+    @traced()
+    def execute_cart(self, operations, timeout=None, consumer=None, priority=DEFAULT_PRIORITY):
+        """
+        Buys a whole cart in a single call: the add and remove operations are netted,
+        the remaining quantities are reserved at once and the order is placed.
+
+        :type operations: List
+        :param operations: add and remove operations, in the format used by Consumer
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait for the products to
+        become available (None waits forever, 0 doesn't wait at all)
+
+        :type consumer: String
+        :param consumer: the name of the consumer, recorded with its order
+
+        :type priority: Int
+        :param priority: the priority class of the cart: while it waits, the carts of
+        the lower classes can't take the units it needs
+
+        :returns the list of ordered products or None if they weren't available in time
+        """
+        start = time.monotonic()
+        quantities = net_quantities(operations)
+        cart_id = self.new_cart(consumer, priority)
+        self.logger.info("Entered execute_cart(%d, %s)!", cart_id, quantities)
+        missing = reserve_all(self, cart_id, quantities)
+        if missing is not None:
+            missing = wait_for_stock(self, cart_id, quantities, timeout, self._cart_waits)
+        if missing is not None:
+            self.logger.info("Finished execute_cart(%d): %s is not available!",
+                             cart_id, missing)
+            if self.progress is not None:
+                self.progress.cart_done(cart_id)
+            if self.tracer is not None:
+                self.tracer.end_cart(cart_id, missing=str(missing))
+            self._drop_cart(cart_id)
+            self.priorities.record(priority, time.monotonic() - start, False)
+            return None
+        self.logger.info("Finished execute_cart(%d): Products reserved!", cart_id)
+        order = self.place_order(cart_id)
+        self._drop_cart(cart_id)
+        self.priorities.record(priority, time.monotonic() - start, True)
+        return order
+
+    def _drop_cart(self, cart_id):
+        """
+        Forgets an empty cart nobody else knows about (the carts of execute_cart()),
+        so the carts and their locks don't pile up.
+        """
+        # The lock which protects cart_id is also held by save_marketplace() while
+        # it walks the carts
+        with self.cart_id_lock:
+            del self.carts[cart_id]
+            del self.carts_locks[cart_id]
+            self.carts_consumers.pop(cart_id, None)
+            self.carts_priorities.pop(cart_id, None)
+
+    def unmet_demand(self, products=None):
+        """
+        Returns the units that consumers want and can't get now: the quantities of
+        the carts waiting in execute_cart() and the product each cart failed to add
+        with add_to_cart() (one unit), minus the available units.
+
+        :type products: List
+        :param products: the products of interest (None for all of them)
+
+        :returns a dictionary with key: product, value: number of missing units
+        (only the products with missing units)
+        """
+        return self.demand.unmet((quantities for _, _, quantities in self.priorities.waiting),
+                                 self.inventory.stock_of, products)
+
+    def wait_for_demand(self, products, timeout):
+        """
+        Waits until some of the given products are wanted (see unmet_demand()),
+        or until the timeout expires.
+
+        :type products: List
+        :param products: the products of the calling producer
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to wait
+
+        :returns the unmet demand for the given products (empty after a timeout)
+        """
+        return self.demand.wait(lambda: self.unmet_demand(products), timeout)
+
+    def inventory_snapshot(self):
+        """
+        Returns a consistent point-in-time view of the stock of each product, of the
+        queue and stock of each producer and of the content of each cart. It never
+        touches the lists used by producers and consumers, so it can be called often.
+
+        :returns an InventorySnapshot
+        """
+        return self.inventory.snapshot()
+
+    def priority_latencies(self):
+        """
+        Returns the latency of the carts bought with execute_cart(), by priority class.
+
+        :returns a dictionary with key: priority, value: dictionary of metrics
+        (see PriorityClasses.latency_report())
+        """
+        return self.priorities.latency_report()
+
+    def snapshot(self, path):
+        """
+        Saves the stock, the producer queues and the carts to a file, as they were
+        at a single moment, even if producers and consumers are working meanwhile.
+        The recorded orders (the ledger) are not saved.
+
+        :type path: String
+        :param path: the file to write
+        """
+        self.logger.info("Entered snapshot(%s)!", path)
+        save_marketplace(self, path)
+        self.logger.info("Finished snapshot(%s)!", path)
+
+    @classmethod
+    def restore(cls, path, **kwargs):
+        """
+        Builds a Marketplace from a file written by snapshot().
+
+        :type path: String
+        :param path: the file to read
+
+        :type kwargs:
+        :param kwargs: the other arguments of the constructor (the queue size is restored)
+
+        :returns the restored Marketplace
+        """
+        return load_marketplace(cls, path, **kwargs)
+
+    def refresh_cart(self, cart_id):
+        """
+        Extends the reservation of all the units from a cart, as if they had just been
+        added to it.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :returns the number of refreshed units or None if the cart doesn't exist
+        """
+        self.logger.info("Entered refresh_cart(%d)!", cart_id)
+        if cart_id not in self.carts:
+            self.logger.info("Finished refresh_cart(%d): Cart doesn't exist!", cart_id)
+            return None
+        with self.carts_locks[cart_id]:
+            cart_list = self.carts[cart_id]
+            if self.reservations is not None:
+                self.reservations.refresh(cart_id, cart_list)
+            refreshed = len(cart_list)
+        self.logger.info("Finished refresh_cart(%d): Refreshed %d units!", cart_id, refreshed)
+        return refreshed
+
+    def expire_reservations(self, now=None):
+        """
+        Returns to the Marketplace the units which stayed in carts longer than
+        the reservation time to live.
+
+        :type now: Float
+        :param now: current time (time.monotonic() if missing)
+
+        :returns the number of units that expired
+        """
+        if self.reservations is None:
+            return 0
+        expired = 0
+        for entry in self.reservations.pop_expired(now):
+            _, cart_id, cart_element = entry
+            with self.carts_locks[cart_id]:
+                # The unit may have been ordered or refreshed after pop_expired()
+                if not self.reservations.is_expired(entry):
+                    continue
+                cart_list = self.carts[cart_id]
+                for index, element in enumerate(cart_list):
+                    if element is cart_element:
+                        del cart_list[index]
+                        break
+                self.reservations.release(cart_element)
+                self._return_to_stock(cart_id, cart_element["product"],
+                                      cart_element["producer_id"])
+            self.reservations.count_expired(cart_id)
+            expired += 1
+            self.logger.info("Reservation of %s in cart %d expired!",
+                             cart_element["product"], cart_id)
+        if expired:
+            self._notify_stock()
+        return expired
+
+    def _product_unavailable(self, cart_id, product):
+        """
+        Records that a cart is waiting for a product and checks for deadlocks.
+
+        :returns False, the result of add_to_cart
+        """
+        if isinstance(product, Product):
+            self.demand.wanted(cart_id, product)
+        self._cart_waits(cart_id, product)
+        return False
+
+    def _cart_waits(self, cart_id, product):
+        """
+        Records that a cart is waiting for a product (or a spec) and checks for
+        deadlocks. Raises MarketplaceStalled if the consumers must give up.
+        """
+        if self.progress is not None:
+            self.progress.cart_waits(cart_id, product)
+            self._check_progress()
+            if self.progress.should_abort():
+                raise MarketplaceStalled(self.progress.report)
+
+    def _check_progress(self):
+        """
+        Dumps the diagnostic (on stderr and in the log) when the Marketplace stalls.
+        """
+        report = self.progress.check(lambda: self.inventory.describe_queues(self._quota))
+        if report is not None:
+            self.logger.error("%s", report)
+            print(report, file=sys.stderr)
+
+    def _quota(self, producer_id):
+        """
+        Returns the maximum size of the queue of a producer.
+        """
+        if self.capacity is None:
+            return self.queue_size_per_producer
+        return self.capacity.quota(producer_id)
+
+    def _borrow_slot(self, producer_id, product, queue_size):
+        """
+        Borrows a slot for a producer whose queue is full of units nobody took (all of
+        them are still available) and who publishes a different product. Called with
+        the lock of the producer held.
+
+        :returns True if the producer can publish
+        """
+        if self.capacity is None:
+            return False
+        with self.inventory.lock:
+            producer_stock = self.inventory.producer_stock[producer_id]
+            if product in producer_stock or sum(producer_stock.values()) < queue_size:
+                return False
+        if not self.capacity.borrow(producer_id, self.producers_queue):
+            return False
+        self.logger.info("%s borrowed a slot to publish %s!", producer_id, product)
+        return True
+
+    def _take_unit(self, cart_id, product):
+        """
+        Moves a unit of a product from the Marketplace into a cart.
+
+        :returns the id of its producer or None if the product is not available
+        """
+        # The lock of the cart is held while the unit moves from the producer to the
+        # cart, so the unit is always visible to snapshot()
+        priority = self.carts_priorities.get(cart_id, DEFAULT_PRIORITY)
+        with self.carts_locks[cart_id]:
+            self.products_locks[product].acquire()
+            available = len(self.products_producers[product])
+            # The last units may be held back for the carts of the higher classes
+            if available <= self.priorities.held_back(priority, product, available):
+                self.products_locks[product].release()
+                return None
+            # Extracts one producer that has the product available
+            # Makes product unavailable
+            producer_id = self.products_producers[product].pop(0)
+            self.inventory.taken(cart_id, product, producer_id)
+            self.products_locks[product].release()
+            # Adds product to the cart, knowing what is the producer of the product
+            # so in case of removing, the product will become available again from
+            # this producer
+            cart_element = {"product": product, "producer_id": producer_id}
+            self.carts[cart_id].append(cart_element)
+            if self.reservations is not None:
+                self.reservations.reserve(cart_id, cart_element)
+        return producer_id
+
+    def new_lock(self):
+        """
+        Creates a lock of the Marketplace (a TracedLock if the calls are traced,
+        so the time spent waiting for it is recorded).
+        """
+        if self.tracer is None:
+            return Lock()
+        return TracedLock(self.tracer)
+
+    def _product_lock(self, product):
+        """
+        Returns the lock of a product, creating the lock and the list of its
+        producers the first time the product is published.
+        """
+        product_lock = self.products_locks.get(product)
+        if product_lock is None:
+            # Two producers may publish a new product at the same time, only one
+            # of them creates the lock and the list
+            with self.new_products_lock:
+                if product not in self.products_locks:
+                    # The lock must exist before the product becomes visible to
+                    # add_to_cart(), which checks products_producers first
+                    self.products_locks[product] = self.new_lock()
+                    self.products_producers[product] = []
+                product_lock = self.products_locks[product]
+        return product_lock
+
+    def _return_to_stock(self, cart_id, product, producer_id):
+        """
+        Makes a unit from a cart available again from its producer.
+        """
+        self.products_locks[product].acquire()
+        self.products_producers[product].append(producer_id)
+        self.inventory.returned(cart_id, product, producer_id)
+        self.products_locks[product].release()
+
+    def _release(self, cart_ids, product=None):
+        """
+        Moves the units of the given carts (only those of a product, if given) back
+        to the Marketplace, see bulk.release().
+
+        :returns a dictionary with key: cart_id, value: number of released units
+        (only the carts that released something)
+        """
+        released = release(self, cart_ids, product)
+        if released:
+            self._notify_stock()
+        return released
+
+    def _notify_stock(self):
+        """
+        Wakes up the consumers waiting in execute_cart(), if any.
+        Must not be called while holding the lock of a cart or of a product.
+        """
+        if self.stock_waiters:
+            with self.stock_condition:
+                self.stock_condition.notify_all()
+
 
 class TestMarketplace(unittest.TestCase):
     """
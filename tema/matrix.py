@@ -0,0 +1,268 @@
+"""
+This module keeps the units held by each producer in a dense producers x products
+count matrix, for vectorised stock queries.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import os
+import tempfile
+from threading import Lock
+import unittest
+
+from tema.columns import intern, np
+from tema.product import Coffee, Tea
+
+# Number of rows (producers) and columns (products) allocated by an empty matrix
+INITIAL_PRODUCERS = 16
+INITIAL_PRODUCTS = 64
+
+
+class InventoryMatrix:
+    """
+    Two producers x products matrices of unit counts: the units available on the
+    shelves and the units held in carts (both still in the queue of their producer).
+    Producers and products are interned, in order of first appearance, as the rows
+    and the columns. The matrices double their rows or columns when full.
+
+    The InventoryStats of the Marketplace applies each change to the matrix with its
+    own lock held, so the matrix always agrees with the inventory counters. The queries
+    copy the filled part of the matrices under the lock and compute without it.
+    """
+
+    def __init__(self, producers=INITIAL_PRODUCERS, products=INITIAL_PRODUCTS):
+        """
+        Constructor
+
+        :type producers: Int
+        :param producers: the number of rows allocated at the beginning
+
+        :type products: Int
+        :param products: the number of columns allocated at the beginning
+        """
+        if np is None:
+            raise ImportError("The inventory matrix needs NumPy")
+        self.available = np.zeros((producers, products), dtype=np.int64)
+        self.in_carts = np.zeros((producers, products), dtype=np.int64)
+        # Interned values: list of values and dictionary value -> index
+        self.producer_names, self.producer_index = [], {}
+        self.product_list, self.product_index = [], {}
+        # Lock used to avoid race condition between the changes and the queries
+        self.lock = Lock()
+
+    def register_producer(self, producer_id):
+        """
+        Adds the row of a producer, so it appears in the queries before publishing.
+        """
+        with self.lock:
+            self._row(producer_id)
+
+    def change(self, producer_id, product, available=0, in_carts=0):
+        """
+        Adds the given deltas to the counts of a unit of a producer.
+        """
+        with self.lock:
+            row, column = self._row(producer_id), self._column(product)
+            self.available[row, column] += available
+            self.in_carts[row, column] += in_carts
+
+    def change_many(self, cart_elements, available=0, in_carts=0):
+        """
+        Adds the given deltas to the counts of each unit, at once.
+
+        :type cart_elements: List
+        :param cart_elements: the units ({"product": ..., "producer_id": ...})
+        """
+        if not cart_elements:
+            return
+        with self.lock:
+            rows = [self._row(cart_element["producer_id"]) for cart_element in cart_elements]
+            columns = [self._column(cart_element["product"]) for cart_element in cart_elements]
+            # Unlike +=, add.at() counts the repeated (row, column) pairs
+            if available:
+                np.add.at(self.available, (rows, columns), available)
+            if in_carts:
+                np.add.at(self.in_carts, (rows, columns), in_carts)
+
+    def load(self, producer_stock, carts):
+        """
+        Rebuilds the matrices (used when the Marketplace is restored from a file).
+
+        :type producer_stock: Dictionary
+        :param producer_stock: key: producer_id, value: dictionary product -> available units
+
+        :type carts: Dictionary
+        :param carts: key: cart_id, value: list of the units in the cart
+        """
+        with self.lock:
+            self.available[:] = 0
+            self.in_carts[:] = 0
+            for producer_id, stock in producer_stock.items():
+                row = self._row(producer_id)
+                for product, count in stock.items():
+                    self.available[row, self._column(product)] = count
+        for cart_list in carts.values():
+            self.change_many(cart_list, in_carts=1)
+
+    def _row(self, producer_id):
+        """
+        :returns the row of a producer, growing the matrices if it's new
+        """
+        row = intern(self.producer_names, self.producer_index, producer_id)
+        if row >= self.available.shape[0]:
+            self._grow(2 * self.available.shape[0], self.available.shape[1])
+        return row
+
+    def _column(self, product):
+        """
+        :returns the column of a product, growing the matrices if it's new
+        """
+        column = intern(self.product_list, self.product_index, product)
+        if column >= self.available.shape[1]:
+            self._grow(self.available.shape[0], 2 * self.available.shape[1])
+        return column
+
+    def _grow(self, producers, products):
+        """
+        Replaces the matrices with bigger ones, keeping the counts.
+        """
+        for name in ("available", "in_carts"):
+            old = getattr(self, name)
+            new = np.zeros((producers, products), dtype=old.dtype)
+            new[:old.shape[0], :old.shape[1]] = old
+            setattr(self, name, new)
+
+    def counts(self):
+        """
+        Returns copies of the filled part of the matrices.
+
+        :returns a tuple (list of producer_ids, list of products, available units matrix,
+        units in carts matrix)
+        """
+        with self.lock:
+            producers, products = len(self.producer_names), len(self.product_list)
+            return (list(self.producer_names), list(self.product_list),
+                    self.available[:producers, :products].copy(),
+                    self.in_carts[:producers, :products].copy())
+
+    def stock_by_product(self):
+        """
+        :returns a dictionary with key: product, value: number of available units
+        """
+        _, products, available, _ = self.counts()
+        return dict(zip(products, available.sum(axis=0).tolist()))
+
+    def units_by_producer(self):
+        """
+        :returns a dictionary with key: producer_id, value: number of units in its queue
+        (available or in carts)
+        """
+        producers, _, available, in_carts = self.counts()
+        return dict(zip(producers, (available + in_carts).sum(axis=1).tolist()))
+
+    def top_holders(self):
+        """
+        :returns a dictionary with key: product, value: the producer with the most
+        available units of it (only the products in stock)
+        """
+        producers, products, available, _ = self.counts()
+        in_stock = np.flatnonzero(available.sum(axis=0))
+        best = available[:, in_stock].argmax(axis=0)
+        return {products[column]: producers[row] for column, row in zip(in_stock, best)}
+
+    def low_stock(self, threshold):
+        """
+        :returns the list of (product, available units) for the products with fewer
+        available units than threshold, the scarcest first
+        """
+        _, products, available, _ = self.counts()
+        totals = available.sum(axis=0)
+        low = np.flatnonzero(totals < threshold)
+        low = low[np.argsort(totals[low], kind="stable")]
+        return [(products[column], totals[column].item()) for column in low]
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestInventoryMatrix(unittest.TestCase):
+    """
+    Unit testing class for InventoryMatrix functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Two producers publish 2 products in a matrix that has to grow.
+        """
+        self.matrix = InventoryMatrix(producers=1, products=1)
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.matrix.register_producer("prod0")
+        self.matrix.register_producer("prod1")
+        for producer_id, product in (("prod0", self.product0), ("prod1", self.product0),
+                                     ("prod1", self.product0), ("prod1", self.product1)):
+            self.matrix.change(producer_id, product, available=1)
+
+    def test_queries(self):
+        """
+        Tests the stock, holders and low stock queries after units move to carts.
+        """
+        self.matrix.change_many([{"product": self.product0, "producer_id": "prod1"}] * 2,
+                                available=-1, in_carts=1)
+        self.assertEqual(self.matrix.stock_by_product(), {self.product0: 1, self.product1: 1},
+                         'Wrong stock per product!')
+        self.assertEqual(self.matrix.units_by_producer(), {"prod0": 1, "prod1": 3},
+                         'Wrong units per producer!')
+        self.assertEqual(self.matrix.top_holders(), {self.product0: "prod0",
+                                                     self.product1: "prod1"},
+                         'Wrong top holders!')
+        self.matrix.change("prod1", self.product1, available=-1)
+        self.assertEqual(self.matrix.low_stock(2), [(self.product1, 0), (self.product0, 1)],
+                         'Wrong low stock products!')
+
+    def test_load(self):
+        """
+        Tests that loading replaces all the counts.
+        """
+        self.matrix.load({"prod0": {}, "prod1": {self.product1: 2}},
+                         {0: [{"product": self.product1, "producer_id": "prod0"}]})
+        _, _, available, in_carts = self.matrix.counts()
+        self.assertEqual(available.tolist(), [[0, 0], [0, 2]], 'Wrong available units!')
+        self.assertEqual(in_carts.tolist(), [[0, 1], [0, 0]], 'Wrong units in carts!')
+
+    def test_marketplace(self):
+        """
+        Tests that the inventory matrix of a Marketplace follows the units and is
+        rebuilt on restore.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5, inventory_matrix=True)
+        cart0 = marketplace.new_cart()
+        cart1 = marketplace.new_cart()
+        for products in ([self.product0] * 3 + [self.product1], [self.product0, self.product1]):
+            producer_id = marketplace.register_producer()
+            for product in products:
+                marketplace.publish(producer_id, product)
+        for product in (self.product0, self.product1, self.product1):
+            marketplace.add_to_cart(cart0, product)
+        marketplace.add_to_cart(cart1, self.product0)
+        marketplace.remove_from_cart(cart0, self.product1)
+        marketplace.release_product(cart1, self.product0)
+        matrix = marketplace.matrix
+        self.assertEqual(matrix.stock_by_product(),
+                         {product: len(producer_ids) for product, producer_ids
+                          in marketplace.products_producers.items()},
+                         'The matrix disagrees with the shelves!')
+        self.assertEqual(matrix.top_holders()[self.product0], 'prod0', 'Wrong top holder!')
+        marketplace.place_order(cart0)
+        self.assertEqual(matrix.units_by_producer(), marketplace.producers_queue,
+                         'The matrix disagrees with the queues!')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "marketplace.snap")
+            marketplace.snapshot(path)
+            restored = Marketplace.restore(path, inventory_matrix=True)
+        for query in ("stock_by_product", "units_by_producer", "top_holders"):
+            self.assertEqual(getattr(restored.matrix, query)(), getattr(matrix, query)(),
+                             'Wrong restored matrix!')
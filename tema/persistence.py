@@ -0,0 +1,304 @@
+"""
+This module saves the state of the Marketplace to a file and restores it.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from array import array
+from contextlib import contextmanager
+from dataclasses import asdict
+import json
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+
+from tema.config import PRODUCT_TYPES
+from tema.product import Coffee, Tea
+
+# The file starts with the magic string and the length of the JSON header
+MAGIC = b"MKTSNAP1"
+PREAMBLE = struct.Struct("<8sI")
+# The arrays start at offsets multiple of 8 bytes, so they can be read in place
+ALIGNMENT = 8
+
+
+def save_marketplace(marketplace, path):
+    """
+    Writes the stock, the producer queues and the carts of a Marketplace to a file.
+
+    Producers, products and carts are numbered and the state is written as packed
+    arrays of numbers, after a small JSON header describing the products and the
+    arrays. All the locks of the Marketplace are held while the state is copied
+    (not while it is converted and written), so the file describes a single moment,
+    even if producers and consumers keep working.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace to save
+
+    :type path: String
+    :param path: the file to write
+    """
+    # pylint: disable=too-many-locals
+    with _frozen(marketplace):
+        producer_ids = list(marketplace.producers_queue)
+        queue_sizes = [marketplace.producers_queue[producer_id] for producer_id in producer_ids]
+        shelves = [(product, list(shelf))
+                   for product, shelf in marketplace.products_producers.items()]
+        carts = [(cart_id, [(cart_element["product"], cart_element["producer_id"])
+                            for cart_element in cart_list])
+                 for cart_id, cart_list in marketplace.carts.items()]
+        counters = [marketplace.producer_id, marketplace.cart_id]
+        producer_stock = marketplace.inventory.snapshot().producer_stock
+
+    producer_index = {producer_id: index for index, producer_id in enumerate(producer_ids)}
+    products = [product for product, _ in shelves]
+    product_index = {product: index for index, product in enumerate(products)}
+    for _, cart_elements in carts:
+        for product, _ in cart_elements:
+            if product not in product_index:
+                product_index[product] = len(products)
+                products.append(product)
+
+    stock_triplets = [(producer_index[producer_id], product_index[product], count)
+                      for producer_id, stock in producer_stock.items()
+                      for product, count in stock.items()]
+    arrays = {
+        "queue_sizes": array("i", queue_sizes),
+        "shelf_lengths": array("i", [len(shelf) for _, shelf in shelves]),
+        "shelf_producers": array("i", [producer_index[producer_id]
+                                       for _, shelf in shelves for producer_id in shelf]),
+        "cart_ids": array("q", [cart_id for cart_id, _ in carts]),
+        "cart_lengths": array("i", [len(cart_elements) for _, cart_elements in carts]),
+        "cart_products": array("i", [product_index[product] for _, cart_elements in carts
+                                     for product, _ in cart_elements]),
+        "cart_producers": array("i", [producer_index[producer_id]
+                                      for _, cart_elements in carts
+                                      for _, producer_id in cart_elements]),
+        "stock_producers": array("i", [triplet[0] for triplet in stock_triplets]),
+        "stock_products": array("i", [triplet[1] for triplet in stock_triplets]),
+        "stock_counts": array("i", [triplet[2] for triplet in stock_triplets]),
+    }
+
+    header = {"queue_size_per_producer": marketplace.queue_size_per_producer,
+              "producer_id": counters[0], "cart_id": counters[1],
+              "producers": producer_ids,
+              "products": [dict(asdict(product), product_type=type(product).__name__)
+                           for product in products],
+              "carts_consumers": [[cart_id, marketplace.carts_consumers[cart_id]]
+                                  for cart_id, cart_elements in carts
+                                  if cart_elements and cart_id in marketplace.carts_consumers],
+              "carts_priorities": [[cart_id, marketplace.carts_priorities[cart_id]]
+                                   for cart_id, cart_elements in carts
+                                   if cart_elements and cart_id in marketplace.carts_priorities],
+              "arrays": {}}
+    offset = 0
+    for name, values in arrays.items():
+        header["arrays"][name] = [values.typecode, offset, len(values)]
+        offset = _align(offset + len(values) * values.itemsize)
+    encoded_header = json.dumps(header).encode()
+    data_start = _align(PREAMBLE.size + len(encoded_header))
+
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(PREAMBLE.pack(MAGIC, len(encoded_header)))
+        snapshot_file.write(encoded_header)
+        snapshot_file.write(bytes(data_start - PREAMBLE.size - len(encoded_header)))
+        for name, values in arrays.items():
+            snapshot_file.write(values.tobytes())
+            padding = _align(len(values) * values.itemsize) - len(values) * values.itemsize
+            snapshot_file.write(bytes(padding))
+
+
+def load_marketplace(marketplace_class, path, **kwargs):
+    """
+    Builds a Marketplace from a file written by save_marketplace().
+
+    :type marketplace_class: Class
+    :param marketplace_class: Marketplace or a subclass
+
+    :type path: String
+    :param path: the file to read
+
+    :type kwargs:
+    :param kwargs: other arguments that are passed to the Marketplace's __init__()
+
+    :returns the restored Marketplace
+    """
+    # pylint: disable=too-many-locals
+    header, arrays = _read_snapshot(path)
+    marketplace = marketplace_class(header["queue_size_per_producer"], **kwargs)
+    producer_ids = header["producers"]
+    products = [PRODUCT_TYPES[product.pop("product_type")](**product)
+                for product in header["products"]]
+
+    marketplace.producer_id = header["producer_id"]
+    marketplace.cart_id = header["cart_id"]
+    for producer_id, queue_size in zip(producer_ids, arrays["queue_sizes"]):
+        marketplace.producers_queue[producer_id] = queue_size
+        marketplace.producers_locks[producer_id] = marketplace.new_lock()
+        if marketplace.capacity is not None:
+            marketplace.capacity.register(producer_id)
+
+    position = 0
+    shelf_producers = [producer_ids[index] for index in arrays["shelf_producers"]]
+    for product, length in zip(products, arrays["shelf_lengths"]):
+        marketplace.products_locks[product] = marketplace.new_lock()
+        marketplace.products_producers[product] = shelf_producers[position:position + length]
+        position += length
+
+    position = 0
+    cart_holdings = {}
+    cart_products = arrays["cart_products"]
+    cart_producers = arrays["cart_producers"]
+    for cart_id, length in zip(arrays["cart_ids"], arrays["cart_lengths"]):
+        cart_list = [{"product": products[cart_products[index]],
+                      "producer_id": producer_ids[cart_producers[index]]}
+                     for index in range(position, position + length)]
+        position += length
+        marketplace.carts[cart_id] = cart_list
+        marketplace.carts_locks[cart_id] = marketplace.new_lock()
+        holdings = cart_holdings[cart_id] = {}
+        for cart_element in cart_list:
+            holdings[cart_element["product"]] = holdings.get(cart_element["product"], 0) + 1
+            if marketplace.reservations is not None:
+                marketplace.reservations.reserve(cart_id, cart_element)
+    marketplace.carts_consumers.update(header["carts_consumers"])
+    marketplace.carts_priorities.update(header.get("carts_priorities", []))
+
+    producer_stock = {producer_id: {} for producer_id in producer_ids}
+    for producer, product, count in zip(arrays["stock_producers"], arrays["stock_products"],
+                                        arrays["stock_counts"]):
+        producer_stock[producer_ids[producer]][products[product]] = count
+    marketplace.inventory.load(
+        {product: len(shelf) for product, shelf in marketplace.products_producers.items()},
+        dict(marketplace.producers_queue), producer_stock, cart_holdings)
+    if marketplace.matrix is not None:
+        marketplace.matrix.load(producer_stock, marketplace.carts)
+    return marketplace
+
+
+def _read_snapshot(path):
+    """
+    Reads the header and the arrays of a snapshot file. The file is memory-mapped and
+    the arrays are read in place, without parsing.
+
+    :returns a tuple (header dictionary, dictionary with key: name, value: list of numbers)
+    """
+    with open(path, "rb") as snapshot_file, \
+            mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, header_length = PREAMBLE.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a Marketplace snapshot".format(path))
+        header = json.loads(data[PREAMBLE.size:PREAMBLE.size + header_length])
+        data_start = _align(PREAMBLE.size + header_length)
+        arrays = {}
+        for name, (typecode, offset, length) in header["arrays"].items():
+            start = data_start + offset
+            with memoryview(data)[start:start + length * array(typecode).itemsize] as raw, \
+                    raw.cast(typecode) as values:
+                arrays[name] = values.tolist()
+    return header, arrays
+
+
+@contextmanager
+def _frozen(marketplace):
+    """
+    Holds the locks of the Marketplace, in the order used by its methods (carts
+    before producers before products), so nothing changes meanwhile. Only the carts
+    holding units are locked: an empty cart can't receive a unit while the locks of
+    the products are held. If one received a unit before they were all acquired,
+    the locks are released and acquired again.
+    """
+    while True:
+        locks, cart_ids = _lock_all(marketplace)
+        if all(cart_id in cart_ids or not cart_list
+               for cart_id, cart_list in marketplace.carts.items()):
+            break
+        _unlock_all(locks)
+    try:
+        yield
+    finally:
+        _unlock_all(locks)
+
+
+def _lock_all(marketplace):
+    """
+    Acquires the locks held by _frozen().
+
+    :returns a tuple (list of the acquired locks, set of the ids of the locked carts)
+    """
+    locks = [marketplace.producer_id_lock, marketplace.cart_id_lock]
+    for lock in locks:
+        lock.acquire()
+    # No cart is created or dropped while the lock which protects cart_id is held
+    cart_ids = [cart_id for cart_id, cart_list in marketplace.carts.items() if cart_list]
+    for lock in [marketplace.carts_locks[cart_id] for cart_id in sorted(cart_ids)] \
+            + list(marketplace.producers_locks.values()) \
+            + list(marketplace.products_locks.values()):
+        lock.acquire()
+        locks.append(lock)
+    return locks, set(cart_ids)
+
+
+def _unlock_all(locks):
+    """
+    Releases the locks acquired by _lock_all(), in reverse order.
+    """
+    for lock in reversed(locks):
+        lock.release()
+
+
+def _align(offset):
+    """
+    Rounds an offset up to a multiple of ALIGNMENT.
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class TestPersistence(unittest.TestCase):
+    """
+    Unit testing class for the snapshots of the Marketplace.
+    """
+
+    def test_snapshot_restore(self):
+        """
+        Tests that a restored Marketplace has the same stock, queues and carts.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5)
+        product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        product1 = Tea(name="Linden", type="Herbal", price=9)
+        for products in ([product0, product0, product1], [product1]):
+            producer_id = marketplace.register_producer()
+            for product in products:
+                marketplace.publish(producer_id, product)
+        cart0 = marketplace.new_cart()
+        cart1 = marketplace.new_cart()
+        for product in (product0, product1, product1):
+            marketplace.add_to_cart(cart0, product)
+        marketplace.add_to_cart(cart1, product0)
+        marketplace.remove_from_cart(cart0, product1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "marketplace.snap")
+            marketplace.snapshot(path)
+            restored = Marketplace.restore(path)
+        self.assertEqual(restored.queue_size_per_producer, 5, 'Wrong queue size!')
+        self.assertEqual(restored.producers_queue, marketplace.producers_queue,
+                         'Wrong producer queues!')
+        self.assertEqual(restored.products_producers, marketplace.products_producers,
+                         'Wrong available products!')
+        self.assertEqual(restored.carts, marketplace.carts, 'Wrong carts!')
+        self.assertEqual(restored.inventory_snapshot().producer_stock,
+                         marketplace.inventory_snapshot().producer_stock,
+                         'Wrong inventory counters!')
+        # The restored Marketplace keeps working where the saved one stopped
+        self.assertEqual(restored.register_producer(), 'prod2',
+                         'Incorrect producer_id assigned after restore!')
+        self.assertEqual(restored.new_cart(), 2, 'Incorrect cart_id assigned after restore!')
+        self.assertEqual(restored.place_order(cart0), [product0, product1], 'Wrong cart list!')
+        self.assertEqual(restored.producers_queue, {'prod0': 2, 'prod1': 0, 'prod2': 0},
+                         'Wrong producer queues after the order!')
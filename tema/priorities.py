@@ -0,0 +1,263 @@
+"""
+This module implements the priority classes of the carts: the units held back for
+the higher classes and the latency of the carts of each class.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import math
+from threading import Lock, Thread
+import time
+import unittest
+
+from tema.catalog import ProductSpec
+from tema.product import Coffee, Tea
+
+# Priority of the carts of the consumers that don't ask for one; a higher number is
+# a more important class
+DEFAULT_PRIORITY = 0
+
+
+class PriorityClasses:
+    """
+    Decides how many units of a product a cart must leave on the shelves for the
+    carts of the higher priority classes: the share of the stock reserved for those
+    classes, or the units their waiting carts still need, if that is more. So when
+    a product is scarce, the units published go to the highest-priority waiting carts
+    first, while the units nobody more important needs can be taken by anyone.
+    """
+
+    def __init__(self, shares=None):
+        """
+        Constructor
+
+        :type shares: Dictionary
+        :param shares: key: priority, value: the fraction of the stock of each product
+        that only the carts of that priority or of a higher one can take (the keys
+        may be strings, as in the JSON config)
+        """
+        self.shares = {int(priority): float(share)
+                       for priority, share in (shares or {}).items()}
+        # Tuple (highest priority of the waiting carts or None, tuple of (cart_id,
+        # priority, dictionary with key: product, value: quantity) for the carts
+        # waiting in execute_cart()); it's replaced, never modified, so it can be
+        # read without the lock
+        self.waiting_state = (None, ())
+        # Dictionary with key: priority, value: list of latencies (seconds) of the
+        # bought carts, and the number of carts that weren't bought in time
+        self.latencies = {}
+        self.failures = {}
+        # Lock used to avoid race condition between the threads that record latencies
+        self.lock = Lock()
+
+    @property
+    def waiting(self):
+        """
+        :returns the tuple of (cart_id, priority, quantities) of the waiting carts
+        """
+        return self.waiting_state[1]
+
+    def held_back(self, priority, product, available):
+        """
+        :returns the number of units of a product, from the available ones, that
+        a cart of the given priority can't take
+        """
+        highest, waiting = self.waiting_state
+        # Usually every cart has the same priority: nothing to scan
+        if not self.shares and (highest is None or highest <= priority):
+            return 0
+        share = sum(share for other, share in self.shares.items() if other > priority)
+        # The small epsilon keeps 0.1 * 30 from being rounded up to 4
+        held = math.ceil(share * available - 1e-9) if share else 0
+        needed = 0
+        if highest is not None and highest > priority:
+            needed = sum(quantities.get(product, 0)
+                         for _, other, quantities in waiting if other > priority)
+        return min(max(held, needed), available)
+
+    def start_waiting(self, cart_id, priority, quantities):
+        """
+        Records that a cart waits for the given quantities. The caller must hold
+        the stock condition of the Marketplace.
+        """
+        self._set_waiting(self.waiting + ((cart_id, priority, quantities),))
+
+    def stop_waiting(self, cart_id):
+        """
+        Records that a cart doesn't wait anymore. The caller must hold the stock
+        condition of the Marketplace.
+
+        :returns True if a cart of a lower priority is still waiting (the units it
+        couldn't take may now be free for it)
+        """
+        priority = next(other for waiting_id, other, _ in self.waiting if waiting_id == cart_id)
+        self._set_waiting(tuple(entry for entry in self.waiting if entry[0] != cart_id))
+        return any(other < priority for _, other, _ in self.waiting)
+
+    def _set_waiting(self, waiting):
+        """
+        Replaces the waiting carts, with their highest priority.
+        """
+        self.waiting_state = (max((other for _, other, _ in waiting), default=None), waiting)
+
+    def record(self, priority, latency, bought):
+        """
+        Records the end of a cart of execute_cart().
+
+        :type latency: Float
+        :param latency: the seconds between the call and the order (or the timeout)
+
+        :type bought: Bool
+        :param bought: False if the products weren't available in time
+        """
+        with self.lock:
+            if bought:
+                self.latencies.setdefault(priority, []).append(latency)
+            else:
+                self.failures[priority] = self.failures.get(priority, 0) + 1
+
+    def latency_report(self):
+        """
+        :returns a dictionary with key: priority, value: dictionary with the number
+        of bought and failed carts and the mean, median, 95th percentile and maximum
+        latency in milliseconds (None if no cart was bought)
+        """
+        with self.lock:
+            latencies = {priority: sorted(values) for priority, values in self.latencies.items()}
+            failures = dict(self.failures)
+        report = {}
+        for priority in sorted(set(latencies) | set(failures), reverse=True):
+            values = latencies.get(priority, [])
+            metrics = {"carts": len(values), "failed": failures.get(priority, 0)}
+            for name, value in (("mean_ms", sum(values) / len(values) if values else None),
+                                ("p50_ms", _percentile(values, 0.5)),
+                                ("p95_ms", _percentile(values, 0.95)),
+                                ("max_ms", values[-1] if values else None)):
+                metrics[name] = None if value is None else round(value * 1000, 3)
+            report[priority] = metrics
+        return report
+
+
+def _percentile(values, fraction):
+    """
+    :returns the value under which lie the given fraction of the sorted values
+    (nearest rank, None if there are no values)
+    """
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class TestPriorityClasses(unittest.TestCase):
+    """
+    Unit testing class for PriorityClasses functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        A quarter of the stock is reserved for the class 1.
+        """
+        self.classes = PriorityClasses({"1": 0.25})
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.product3 = Coffee(name="Arabica", acidity="5.02", roast_level="MEDIUM", price=9)
+
+    def test_held_back(self):
+        """
+        Tests that the reserved share and the waiting carts of the higher classes
+        are held back from the lower ones only.
+        """
+        self.assertEqual(self.classes.held_back(0, self.product0, 4), 1, 'Wrong reserved share!')
+        self.assertEqual(self.classes.held_back(0, self.product0, 1), 1, 'Wrong reserved share!')
+        self.assertEqual(self.classes.held_back(1, self.product0, 4), 0,
+                         'Nothing is reserved above the class 1!')
+        self.classes.start_waiting(7, 1, {self.product0: 3})
+        self.classes.start_waiting(8, 0, {self.product0: 5})
+        self.assertEqual(self.classes.held_back(0, self.product0, 4), 3,
+                         'The waiting cart of the class 1 needs 3 units!')
+        self.assertEqual(self.classes.held_back(0, self.product1, 4), 1,
+                         'Wrong reserved share!')
+        self.assertEqual(self.classes.held_back(1, self.product0, 4), 0,
+                         'Carts of the same class are not held back!')
+        self.assertTrue(self.classes.stop_waiting(7), 'A class 0 cart is still waiting!')
+        self.assertFalse(self.classes.stop_waiting(8), 'No cart is waiting anymore!')
+        self.assertEqual(self.classes.held_back(0, self.product0, 4), 1, 'Wrong reserved share!')
+
+    def test_latency_report(self):
+        """
+        Tests the latency metrics of each class.
+        """
+        for latency in (0.004, 0.001, 0.002, 0.003):
+            self.classes.record(0, latency, True)
+        self.classes.record(0, 1.0, False)
+        self.classes.record(1, 0.0005, True)
+        report = self.classes.latency_report()
+        self.assertEqual(list(report), [1, 0], 'The highest class comes first!')
+        self.assertEqual(report[0], {"carts": 4, "failed": 1, "mean_ms": 2.5, "p50_ms": 2.0,
+                                     "p95_ms": 4.0, "max_ms": 4.0}, 'Wrong class 0 metrics!')
+        self.assertEqual(report[1]["p50_ms"], 0.5, 'Wrong class 1 median!')
+
+    def test_add_matching_held_back(self):
+        """
+        Tests that add_matching_to_cart skips the matches held back for the higher
+        priority classes.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5, priority_shares={1: 0.5})
+        producer_id = marketplace.register_producer()
+        for product in (self.product0, self.product3, self.product3):
+            marketplace.publish(producer_id, product)
+        medium_coffee = ProductSpec(roast_level="MEDIUM")
+        cart_id = marketplace.new_cart()
+        self.assertEqual(marketplace.add_matching_to_cart(cart_id, medium_coffee),
+                         self.product3, 'The last unit of product0 is reserved!')
+        self.assertIsNone(marketplace.add_matching_to_cart(cart_id, medium_coffee),
+                          'The last units are reserved for the class 1!')
+
+    def test_priority_classes(self):
+        """
+        Tests that a scarce unit goes to the waiting cart of the highest priority and
+        that the reserved share is held back from the lower classes.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(5, priority_shares={1: 0.5})
+        producer_id = marketplace.register_producer()
+        operations = [{"type": "add", "product": self.product0, "quantity": 1}]
+        orders = {}
+
+        def buy(priority):
+            orders[priority] = marketplace.execute_cart(operations, timeout=5,
+                                                        priority=priority)
+
+        buyers = {}
+        # The low priority cart waits first
+        for priority in (0, 1):
+            buyers[priority] = Thread(target=buy, args=(priority,))
+            buyers[priority].start()
+            while marketplace.stock_waiters <= priority:
+                time.sleep(0.001)
+        self.assertTrue(marketplace.publish(producer_id, self.product0),
+                        'Producer prod0 should be able to publish product!')
+        buyers[1].join()
+        self.assertEqual(orders, {1: [self.product0]}, 'The unit goes to the class 1 cart!')
+        for _ in range(2):
+            marketplace.publish(producer_id, self.product0)
+        buyers[0].join()
+        self.assertEqual(orders[0], [self.product0], 'The class 0 cart should be bought!')
+        # Half of the last unit is reserved for the class 1
+        cart0 = marketplace.new_cart()
+        self.assertFalse(marketplace.add_to_cart(cart0, self.product0),
+                         'The last unit is reserved for the class 1!')
+        cart1 = marketplace.new_cart(priority=1)
+        self.assertTrue(marketplace.add_to_cart(cart1, self.product0),
+                        'The class 1 cart can take the reserved unit!')
+        report = marketplace.priority_latencies()
+        self.assertEqual([report[1]["carts"], report[0]["carts"]], [1, 1],
+                         'Wrong number of carts by class!')
+        self.assertLessEqual(report[1]["max_ms"], report[0]["max_ms"],
+                             'The class 1 cart waited less!')
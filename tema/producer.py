@@ -6,16 +6,30 @@ Assignment 1
 March 2021
 """
 
-from threading import Thread
+from contextlib import nullcontext, redirect_stdout
+from io import StringIO
+from threading import Event, Thread
 from time import sleep
+import unittest
+
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+
+# The producer makes its products in order, forever
+CYCLE_MODE = "cycle"
+# The producer makes only the products that consumers are missing
+DEMAND_MODE = "demand"
 
 
 class Producer(Thread):
     """
     Class that represents a producer.
     """
+    # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, *, tracer=None,
+                 mode=CYCLE_MODE, stop_event=None, **kwargs):
         """
         Constructor.
 
@@ -29,14 +43,33 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type tracer: Tracer
+        @param tracer: records the production and the publishing as spans (None
+        disables tracing)
+
+        @type mode: String
+        @param mode: CYCLE_MODE to produce the products in order, forever, or
+        DEMAND_MODE to produce only the products consumers are missing, the most
+        wanted first, and to idle while nothing is missing (it needs the
+        wait_for_demand() method of the Marketplace)
+
+        @type stop_event: Event
+        @param stop_event: when set, the producer stops (None means it runs until
+        the program exits)
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
         # Set daemon = True, to create a background thread
         Thread.__init__(self, daemon=True)
+        if mode not in (CYCLE_MODE, DEMAND_MODE):
+            raise ValueError("Unknown production mode {0}".format(mode))
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.tracer = tracer
+        self.mode = mode
+        self.stop_event = stop_event
         self.name = kwargs["name"]
 
     def run(self):
@@ -47,16 +80,124 @@ class Producer(Thread):
         producer_id = self.marketplace.register_producer()
         # Publish products
         while True:
+            if self.mode == DEMAND_MODE:
+                if not self._produce_demanded(producer_id):
+                    return
+                continue
             # Publish each product
             for element in self.products:
                 # Extract product, quantity and production time
                 product = element[0]
                 quantity = element[1]
                 production_time = element[2]
-                # Wait to finish production
-                sleep(production_time)
-                # Publish the product
-                for _ in range(quantity):
-                    while not self.marketplace.publish(producer_id, product):
-                        # Wait if queue is full
-                        sleep(self.republish_wait_time)
+                if not self._produce(producer_id, product, quantity, production_time):
+                    return
+
+    def _produce_demanded(self, producer_id):
+        """
+        Waits until consumers miss some of the products, then produces them, the
+        most wanted first, at most the missing quantity of each.
+
+        @returns False if the producer must stop
+        """
+        demand = self.marketplace.wait_for_demand([element[0] for element in self.products],
+                                                  self.republish_wait_time)
+        wanted = sorted((element for element in self.products if element[0] in demand),
+                        key=lambda element: demand[element[0]], reverse=True)
+        for product, quantity, production_time in wanted:
+            if not self._produce(producer_id, product, min(quantity, demand[product]),
+                                 production_time):
+                return False
+        return not self._stopped()
+
+    def _produce(self, producer_id, product, quantity, production_time):
+        """
+        Produces a batch of a product and publishes it.
+
+        @returns False if the producer must stop
+        """
+        with self._span("produce", product=str(product), quantity=quantity) as span:
+            # Wait to finish production
+            with self._span("production"):
+                if self._sleep(production_time):
+                    return False
+            # Publish the product
+            for _ in range(quantity):
+                while not self.marketplace.publish(producer_id, product):
+                    # Wait if queue is full
+                    with self._span("publish retry wait"):
+                        if self._sleep(self.republish_wait_time):
+                            return False
+                    if span is not None:
+                        self.tracer.count(span, "publish_retries")
+        return True
+
+    def _sleep(self, seconds):
+        """
+        Sleeps, unless the producer is asked to stop.
+
+        @returns True if the producer must stop
+        """
+        if self.stop_event is None:
+            sleep(seconds)
+            return False
+        return self.stop_event.wait(seconds)
+
+    def _stopped(self):
+        """
+        @returns True if the producer must stop
+        """
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _span(self, name, **args):
+        """
+        :returns a context manager that records a span, if the producer is traced
+        """
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(name, "producer", **args)
+
+
+class TestProducer(unittest.TestCase):
+    """
+    Unit testing class for the production modes of the producers.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        """
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+
+    def test_demand_producers(self):
+        """
+        Tests that demand-mode producers make every unit the carts of a consumer
+        need, until they are stopped.
+        """
+        marketplace = Marketplace(10)
+        stop_event = Event()
+        producers = [Producer([[self.product0, 2, 0.001], [self.product1, 1, 0.001]],
+                              marketplace, 0.01, mode=DEMAND_MODE, stop_event=stop_event,
+                              name="prod{0}".format(index))
+                     for index in range(2)]
+        carts = [[{"type": "add", "product": self.product0, "quantity": 3},
+                  {"type": "add", "product": self.product1, "quantity": 2},
+                  {"type": "remove", "product": self.product0, "quantity": 1}]] * 10
+        consumer = Consumer(carts, marketplace, 0.01, name="cons0")
+        # A stuck consumer must not keep the test run alive
+        consumer.daemon = True
+        output = StringIO()
+        with redirect_stdout(output):
+            for producer in producers:
+                producer.start()
+            consumer.start()
+            consumer.join(30)
+            stop_event.set()
+            for producer in producers:
+                producer.join(5)
+        self.assertFalse(consumer.is_alive(), 'The consumer should buy all its carts!')
+        self.assertFalse(any(producer.is_alive() for producer in producers),
+                         'The producers should stop!')
+        self.assertEqual(output.getvalue().count("cons0 bought"), 40,
+                         'Each cart holds 4 units!')
@@ -0,0 +1,221 @@
+"""
+This module profiles the CPU time of the producer and consumer threads and the memory
+allocated between the phases of a run, and writes the reports as JSON.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import cProfile
+import json
+import os
+import pstats
+from threading import Lock, Thread
+import time
+import tracemalloc
+import unittest
+
+# Number of functions or allocation sites kept in a report
+DEFAULT_TOP = 30
+# Number of frames recorded for each allocation
+TRACEMALLOC_FRAMES = 1
+# Paths under this directory are written relative to it, so the reports of two
+# checkouts can be compared
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CpuProfiler:
+    """
+    Runs a cProfile profiler in each wrapped thread (cProfile only sees the thread
+    that enabled it) and merges their statistics when the threads are done. The
+    profilers measure the CPU time of their thread, so the time spent sleeping or
+    waiting for a lock is not counted.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # List of (thread name, pstats.Stats) of the finished threads
+        self.profiles = []
+        # Lock used to avoid race condition between the threads that finish
+        self.lock = Lock()
+
+    def wrap(self, thread):
+        """
+        Profiles the run() method of a thread that didn't start yet.
+        """
+        run = thread.run
+
+        def profiled_run():
+            profile = cProfile.Profile(time.thread_time)
+            profile.enable()
+            try:
+                run()
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiles.append((thread.name, pstats.Stats(profile)))
+
+        thread.run = profiled_run
+        return thread
+
+    def report(self, top=DEFAULT_TOP):
+        """
+        Merges the statistics of the finished threads.
+
+        :returns a dictionary with the CPU time of each thread and the top functions
+        by own time (time spent in the function itself), with their calls and their
+        cumulative time, summed over all the threads
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+        threads = [{"name": name, "time": round(stats.total_tt, 6)}
+                   for name, stats in sorted(profiles, key=lambda profile: profile[0])]
+        functions = []
+        if profiles:
+            merged = pstats.Stats()
+            for _, stats in profiles:
+                merged.add(stats)
+            for (filename, line, name), (primitive_calls, calls, own_time, cumulative_time,
+                                         _) in merged.stats.items():
+                functions.append({"function": "{0}:{1}({2})".format(_relative(filename),
+                                                                     line, name),
+                                  "calls": calls, "primitive_calls": primitive_calls,
+                                  "own_time": round(own_time, 6),
+                                  "cumulative_time": round(cumulative_time, 6)})
+            functions.sort(key=lambda function: function["own_time"], reverse=True)
+        return {"profile": "cpu", "threads": threads,
+                "total_time": round(sum(thread["time"] for thread in threads), 6),
+                "functions": functions[:top]}
+
+
+class MemoryProfiler:
+    """
+    Takes tracemalloc snapshots at the phase boundaries of a run and reports the
+    biggest allocation sites of each phase and what grew since the previous one.
+    """
+
+    def __init__(self, top=DEFAULT_TOP):
+        """
+        Constructor
+
+        :type top: Int
+        :param top: the number of allocation sites kept for each phase
+        """
+        self.top = top
+        # List of (phase name, tracemalloc snapshot, traced bytes, peak bytes)
+        self.snapshots = []
+
+    def start(self):
+        """
+        Starts tracing the allocations (before the first phase).
+        """
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def snapshot(self, phase):
+        """
+        Records the allocations alive at the end of a phase.
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        current, peak = tracemalloc.get_traced_memory()
+        self.snapshots.append((phase, snapshot, current, peak))
+
+    def stop(self):
+        """
+        Stops tracing the allocations.
+        """
+        tracemalloc.stop()
+
+    def report(self):
+        """
+        :returns a dictionary with, for each phase, the traced bytes, the top
+        allocation sites and the sites that grew the most since the previous phase
+        """
+        phases = []
+        previous = None
+        for phase, snapshot, current, peak in self.snapshots:
+            top = [_site_entry(stat.traceback[0], size=stat.size, count=stat.count)
+                   for stat in snapshot.statistics("lineno")[:self.top]]
+            growth = []
+            if previous is not None:
+                growth = [_site_entry(stat.traceback[0], size_diff=stat.size_diff,
+                                      count_diff=stat.count_diff)
+                          for stat in snapshot.compare_to(previous, "lineno")[:self.top]
+                          if stat.size_diff > 0]
+            phases.append({"phase": phase, "traced_bytes": current, "peak_bytes": peak,
+                           "top": top, "growth": growth})
+            previous = snapshot
+        return {"profile": "mem", "phases": phases}
+
+
+def write_report(report, path):
+    """
+    Writes a report as JSON (sorted keys, so two reports can be diffed).
+    """
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=1, sort_keys=True)
+
+
+def _site_entry(frame, **values):
+    """
+    :returns the dictionary describing an allocation site
+    """
+    return dict(values, site="{0}:{1}".format(_relative(frame.filename), frame.lineno))
+
+
+def _relative(filename):
+    """
+    :returns the path of a file relative to the root of the project, if it's inside
+    """
+    if filename.startswith(ROOT_DIRECTORY + os.sep):
+        return os.path.relpath(filename, ROOT_DIRECTORY)
+    return filename
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Unit testing class for CpuProfiler and MemoryProfiler functionalities.
+    """
+
+    def test_cpu_profiler(self):
+        """
+        Tests that the profiles of several threads are merged.
+        """
+        profiler = CpuProfiler()
+        threads = [profiler.wrap(Thread(target=sorted, args=(range(1000),), name=name))
+                   for name in ("cons1", "cons2")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report = profiler.report()
+        self.assertEqual([thread["name"] for thread in report["threads"]], ["cons1", "cons2"],
+                         'Wrong profiled threads!')
+        sort_calls = [function["calls"] for function in report["functions"]
+                      if "sorted" in function["function"]]
+        self.assertEqual(sort_calls, [2], 'The calls of both threads should be merged!')
+
+    def test_memory_profiler(self):
+        """
+        Tests that the allocations of a phase are reported as growth.
+        """
+        profiler = MemoryProfiler(top=5)
+        profiler.start()
+        try:
+            profiler.snapshot("start")
+            carts = [{"product": index} for index in range(10000)]
+            profiler.snapshot("carts")
+        finally:
+            profiler.stop()
+        report = profiler.report()
+        self.assertEqual([phase["phase"] for phase in report["phases"]], ["start", "carts"],
+                         'Wrong phases!')
+        self.assertGreater(report["phases"][1]["traced_bytes"],
+                           report["phases"][0]["traced_bytes"], 'The carts were not traced!')
+        self.assertTrue(report["phases"][1]["growth"][0]["site"].startswith("tema"),
+                        'The carts should be the biggest growth!')
+        self.assertEqual(len(carts), 10000)
@@ -0,0 +1,201 @@
+"""
+This module detects the situations when the Marketplace stops making progress.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from threading import Lock
+from time import monotonic, sleep
+import unittest
+
+from tema.product import Coffee, Tea
+
+
+class MarketplaceStalled(Exception):
+    """
+    Raised to the consumers when the Marketplace made no progress for too long
+    and it was configured to abort.
+    """
+
+
+class ProgressMonitor:
+    """
+    Counts the successful operations of the Marketplace and remembers who is waiting
+    for what. If nothing advanced during stall_timeout seconds while consumers are
+    still waiting, the situation is a deadlock (or a livelock: everybody retries, but
+    nobody succeeds), for example when the queues of the producers are full of products
+    that no consumer wants.
+    """
+
+    def __init__(self, stall_timeout, abort_on_stall=False):
+        """
+        Constructor
+
+        :type stall_timeout: Float
+        :param stall_timeout: the number of seconds without progress after which the
+        Marketplace is considered stalled
+
+        :type abort_on_stall: Bool
+        :param abort_on_stall: True if the waiting consumers should receive a
+        MarketplaceStalled exception
+        """
+        self.stall_timeout = stall_timeout
+        self.abort_on_stall = abort_on_stall
+        # Number of successful operations, by kind
+        self.counts = {"publish": 0, "add_to_cart": 0, "place_order": 0}
+        # Moment of the last successful operation
+        self.last_progress = monotonic()
+        # Dictionary with key: cart_id, value: the product the cart is waiting for
+        self.waiting_carts = {}
+        # Dictionary with key: producer_id, value: the product the producer wants to publish
+        self.waiting_producers = {}
+        # The diagnostic built when the current stall was detected (None while everything
+        # is fine, it's forgotten once the Marketplace makes progress again)
+        self.report = None
+        # Lock used to avoid race condition on counters and on the report
+        self.lock = Lock()
+
+    def progress(self, operation):
+        """
+        Records a successful operation.
+
+        :type operation: String
+        :param operation: the name of the operation (publish, add_to_cart, place_order)
+        """
+        with self.lock:
+            self.counts[operation] += 1
+            self.last_progress = monotonic()
+            self.report = None
+
+    def cart_waits(self, cart_id, product):
+        """
+        Records that a cart could not get a product.
+        """
+        self.waiting_carts[cart_id] = product
+
+    def cart_done(self, cart_id):
+        """
+        Records that a cart is no longer waiting.
+        """
+        self.waiting_carts.pop(cart_id, None)
+        if not self.waiting_carts and self.report is not None:
+            with self.lock:
+                self.report = None
+
+    def producer_waits(self, producer_id, product):
+        """
+        Records that a producer could not publish a product.
+        """
+        self.waiting_producers[producer_id] = product
+
+    def producer_done(self, producer_id):
+        """
+        Records that a producer is no longer waiting.
+        """
+        self.waiting_producers.pop(producer_id, None)
+
+    def is_stalled(self, now=None):
+        """
+        Checks if no operation succeeded for stall_timeout seconds while consumers
+        are waiting.
+        """
+        if now is None:
+            now = monotonic()
+        return bool(self.waiting_carts) and now - self.last_progress >= self.stall_timeout
+
+    def check(self, describe, now=None):
+        """
+        Builds the diagnostic the first time the Marketplace is found stalled.
+
+        :type describe: Callable
+        :param describe: function that returns the lines describing the queues
+
+        :type now: Float
+        :param now: current time (time.monotonic() if missing)
+
+        :returns the diagnostic if it was built by this call, None otherwise
+        """
+        if self.report is not None or not self.is_stalled(now):
+            return None
+        with self.lock:
+            # Another thread may have built it meanwhile
+            if self.report is not None:
+                return None
+            idle = (monotonic() if now is None else now) - self.last_progress
+            lines = ["Marketplace made no progress for {0:.2f}s "
+                     "(publish: {1}, add_to_cart: {2}, place_order: {3})"
+                     .format(idle, self.counts["publish"], self.counts["add_to_cart"],
+                             self.counts["place_order"]),
+                     "Waiting consumers:"]
+            lines += ["  cart {0} waits for {1}".format(cart_id, product)
+                      for cart_id, product in sorted(list(self.waiting_carts.items()),
+                                                     key=lambda item: item[0])]
+            lines.append("Waiting producers:")
+            lines += ["  {0} waits to publish {1}".format(producer_id, product)
+                      for producer_id, product in sorted(list(self.waiting_producers.items()),
+                                                         key=lambda item: item[0])]
+            lines += describe()
+            self.report = "\n".join(lines)
+        return self.report
+
+    def should_abort(self):
+        """
+        Checks if the waiting consumers must give up: the Marketplace is still stalled
+        (a stall that cleared must not abort the later waits).
+        """
+        return self.abort_on_stall and self.is_stalled()
+
+
+class TestProgressMonitor(unittest.TestCase):
+    """
+    Unit testing class for ProgressMonitor functionalities.
+    """
+
+    def test_stall_clears(self):
+        """
+        Tests that a stall is forgotten once the Marketplace makes progress again,
+        and that a later stall is reported again.
+        """
+        monitor = ProgressMonitor(0.05, abort_on_stall=True)
+        monitor.cart_waits(0, "product1")
+        sleep(0.06)
+        first = monitor.check(lambda: ["queues"])
+        self.assertIn("cart 0 waits for product1", first, 'The waiting cart is reported!')
+        self.assertTrue(monitor.should_abort(), 'The waiting consumers should give up!')
+        monitor.progress("publish")
+        self.assertIsNone(monitor.report, 'The stall cleared!')
+        self.assertFalse(monitor.should_abort(), 'The next wait should not abort!')
+        monitor.cart_done(0)
+        monitor.cart_waits(1, "product2")
+        sleep(0.06)
+        second = monitor.check(lambda: ["queues"])
+        self.assertIn("cart 1 waits for product2", second, 'The new stall is reported!')
+        monitor.cart_done(1)
+        self.assertFalse(monitor.should_abort(), 'Nobody waits anymore!')
+
+    def test_stall_detection(self):
+        """
+        Tests that a consumer waiting on a Marketplace that can't make progress
+        anymore receives a diagnostic of the deadlock.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        product1 = Tea(name="Linden", type="Herbal", price=9)
+        marketplace = Marketplace(2, stall_timeout=0, abort_on_stall=True)
+        producer_id = marketplace.register_producer()
+        # The queue of prod0 is full of product0, but the consumer wants product1
+        while marketplace.publish(producer_id, product0):
+            pass
+        cart_id = marketplace.new_cart()
+        with self.assertRaises(MarketplaceStalled) as context:
+            marketplace.add_to_cart(cart_id, product1)
+        report = str(context.exception)
+        self.assertIn('cart 0 waits for ' + str(product1), report,
+                      'The waiting consumer should be reported!')
+        self.assertIn('prod0 waits to publish ' + str(product0), report,
+                      'The waiting producer should be reported!')
+        self.assertIn(str(product0) + ' x 2', report,
+                      'The content of the queue should be reported!')
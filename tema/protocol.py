@@ -0,0 +1,342 @@
+"""
+This module implements the binary protocol spoken between the Marketplace server
+and its clients.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+import json
+import math
+import struct
+
+from tema.config import PRODUCT_TYPES
+from tema.priorities import DEFAULT_PRIORITY
+
+# Every frame starts with the length of its body
+FRAME = struct.Struct("<I")
+# The body of a request starts with the operation code and the request id
+REQUEST = struct.Struct("<BI")
+# The body of a reply starts with the request id and the status
+REPLY = struct.Struct("<IB")
+STATUS_OK = 0
+STATUS_ERROR = 1
+# A product is sent as its index in the table of the connection, the first time
+# it is followed by its definition
+PRODUCT_INDEX = struct.Struct("<H")
+MAX_PRODUCTS = 0xFFFF
+# Encoding of the values, by signature letter (a string may be a long report,
+# such as the diagnostic of MarketplaceStalled)
+LENGTH = struct.Struct("<I")
+COUNT = struct.Struct("<I")
+INT = struct.Struct("<q")
+FLAG = struct.Struct("<B")
+FLOAT = struct.Struct("<d")
+OPERATION = struct.Struct("<BI")
+OPERATION_TYPES = ["add", "remove"]
+
+# Dictionary with key: method name, value: (operation code, signature of the
+# arguments, signature of the result). Signature letters: s = string, o = optional
+# string, q = int, b = bool, p = product, f = optional float, c = cart operations,
+# P = list of products, L = optional list of products
+OPERATIONS = {
+    "register_producer": (1, "", "s"),
+    "publish": (2, "sp", "b"),
+    "new_cart": (3, "oq", "q"),
+    "add_to_cart": (4, "qp", "b"),
+    "remove_from_cart": (5, "qp", "b"),
+    "place_order": (6, "q", "L"),
+    "execute_cart": (7, "cfoq", "L"),
+}
+# Dictionary with key: operation code, value: (method name, arguments, result)
+OPERATION_CODES = {code: (name, arguments, result)
+                   for name, (code, arguments, result) in OPERATIONS.items()}
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame that can't be decoded.
+    """
+
+
+class MessageCodec:
+    """
+    Encodes and decodes the frames of one connection. Each direction of the
+    connection has its own table of products: a product is defined the first
+    time it is sent and referred to by its index afterwards.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Products sent: list and dictionary with key: product, value: index
+        self.sent_products, self.sent_index = [], {}
+        # Products received, by index
+        self.received_products = []
+
+    def encode_request(self, request_id, name, arguments):
+        """
+        :returns the frame of a request, as bytes
+        """
+        code, signature, _ = OPERATIONS[name]
+        if len(arguments) != len(signature):
+            raise TypeError("{0}() takes {1} arguments".format(name, len(signature)))
+        body = bytearray(REQUEST.pack(code, request_id))
+        for letter, value in zip(signature, arguments):
+            self._write(body, letter, value)
+        return FRAME.pack(len(body)) + body
+
+    def decode_request(self, body):
+        """
+        :returns a tuple (request id, method name, list of arguments)
+        """
+        code, request_id = REQUEST.unpack_from(body)
+        if code not in OPERATION_CODES:
+            raise ProtocolError("Unknown operation {0}".format(code))
+        name, signature, _ = OPERATION_CODES[code]
+        offset = REQUEST.size
+        arguments = []
+        for letter in signature:
+            value, offset = self._read(body, offset, letter)
+            arguments.append(value)
+        return request_id, name, arguments
+
+    @staticmethod
+    def request_id(body):
+        """
+        :returns the id of a request, read before the rest of the request is decoded
+        """
+        return REQUEST.unpack_from(body)[1]
+
+    def encode_reply(self, request_id, name, result):
+        """
+        :returns the frame of a successful reply, as bytes
+        """
+        body = bytearray(REPLY.pack(request_id, STATUS_OK))
+        self._write(body, OPERATIONS[name][2], result)
+        return FRAME.pack(len(body)) + body
+
+    def encode_error(self, request_id, error):
+        """
+        :returns the frame of a reply carrying an exception, as bytes
+        """
+        body = bytearray(REPLY.pack(request_id, STATUS_ERROR))
+        self._write(body, "s", type(error).__name__)
+        self._write(body, "s", str(error))
+        return FRAME.pack(len(body)) + body
+
+    def decode_reply(self, body, name):
+        """
+        :returns a tuple (request id, result), or (request id, (exception name,
+        message)) and a True error flag
+        """
+        request_id, status = REPLY.unpack_from(body)
+        if status == STATUS_ERROR:
+            error_name, offset = self._read(body, REPLY.size, "s")
+            message, _ = self._read(body, offset, "s")
+            return request_id, (error_name, message), True
+        result, _ = self._read(body, REPLY.size, OPERATIONS[name][2])
+        return request_id, result, False
+
+    def _write(self, body, letter, value):
+        """
+        Appends a value, encoded as described by its signature letter.
+        """
+        # pylint: disable=too-many-branches
+        if letter == "s":
+            encoded = value.encode()
+            body += LENGTH.pack(len(encoded))
+            body += encoded
+        elif letter in "oL":
+            body += FLAG.pack(value is not None)
+            if value is not None:
+                self._write(body, "s" if letter == "o" else "P", value)
+        elif letter == "q":
+            body += INT.pack(value)
+        elif letter == "b":
+            body += FLAG.pack(value)
+        elif letter == "f":
+            body += FLOAT.pack(math.nan if value is None else value)
+        elif letter == "p":
+            self._write_product(body, value)
+        elif letter == "P":
+            body += COUNT.pack(len(value))
+            for product in value:
+                self._write_product(body, product)
+        elif letter == "c":
+            body += COUNT.pack(len(value))
+            for operation in value:
+                body += OPERATION.pack(OPERATION_TYPES.index(operation["type"]),
+                                       operation["quantity"])
+                self._write_product(body, operation["product"])
+        else:
+            raise ProtocolError("Unknown signature letter {0}".format(letter))
+
+    def _read(self, body, offset, letter):
+        """
+        Decodes a value, as described by its signature letter.
+
+        :returns a tuple (value, offset after the value)
+        """
+        # pylint: disable=too-many-return-statements
+        if letter == "s":
+            (length,) = LENGTH.unpack_from(body, offset)
+            offset += LENGTH.size
+            return bytes(body[offset:offset + length]).decode(), offset + length
+        if letter in "oL":
+            (present,) = FLAG.unpack_from(body, offset)
+            if not present:
+                return None, offset + FLAG.size
+            return self._read(body, offset + FLAG.size, "s" if letter == "o" else "P")
+        if letter == "q":
+            return INT.unpack_from(body, offset)[0], offset + INT.size
+        if letter == "b":
+            return bool(FLAG.unpack_from(body, offset)[0]), offset + FLAG.size
+        if letter == "f":
+            (value,) = FLOAT.unpack_from(body, offset)
+            return (None if math.isnan(value) else value), offset + FLOAT.size
+        if letter == "p":
+            return self._read_product(body, offset)
+        if letter == "P":
+            (count,) = COUNT.unpack_from(body, offset)
+            offset += COUNT.size
+            products = []
+            for _ in range(count):
+                product, offset = self._read_product(body, offset)
+                products.append(product)
+            return products, offset
+        if letter == "c":
+            (count,) = COUNT.unpack_from(body, offset)
+            offset += COUNT.size
+            operations = []
+            for _ in range(count):
+                operation_type, quantity = OPERATION.unpack_from(body, offset)
+                product, offset = self._read_product(body, offset + OPERATION.size)
+                operations.append({"type": OPERATION_TYPES[operation_type],
+                                   "product": product, "quantity": quantity})
+            return operations, offset
+        raise ProtocolError("Unknown signature letter {0}".format(letter))
+
+    def _write_product(self, body, product):
+        """
+        Appends the index of a product, followed by its definition if it's new.
+        """
+        index = self.sent_index.get(product)
+        if index is not None:
+            body += PRODUCT_INDEX.pack(index)
+            return
+        index = len(self.sent_products)
+        if index >= MAX_PRODUCTS:
+            raise ProtocolError("Too many products on a connection")
+        self.sent_products.append(product)
+        self.sent_index[product] = index
+        body += PRODUCT_INDEX.pack(index)
+        self._write(body, "s", json.dumps(dict(asdict(product),
+                                               product_type=type(product).__name__)))
+
+    def _read_product(self, body, offset):
+        """
+        Decodes a product, remembering its definition if it's new.
+
+        :returns a tuple (product, offset after the product)
+        """
+        (index,) = PRODUCT_INDEX.unpack_from(body, offset)
+        offset += PRODUCT_INDEX.size
+        if index < len(self.received_products):
+            return self.received_products[index], offset
+        if index != len(self.received_products):
+            raise ProtocolError("Product {0} used before its definition".format(index))
+        definition, offset = self._read(body, offset, "s")
+        params = json.loads(definition)
+        product = PRODUCT_TYPES[params.pop("product_type")](**params)
+        self.received_products.append(product)
+        return product, offset
+
+
+class MarketplaceCalls(ABC):
+    """
+    The methods of the Marketplace that can be called remotely (or recorded).
+    Subclasses decide what happens with a call in _submit().
+    """
+
+    @abstractmethod
+    def _submit(self, name, arguments):
+        """
+        Handles a call of a Marketplace method.
+
+        :type name: String
+        :param name: the name of the method
+
+        :type arguments: Tuple
+        :param arguments: the arguments of the call
+
+        :returns the result of the call
+        """
+
+    def register_producer(self):
+        """
+        See Marketplace.register_producer().
+        """
+        return self._submit("register_producer", ())
+
+    def publish(self, producer_id, product):
+        """
+        See Marketplace.publish().
+        """
+        return self._submit("publish", (producer_id, product))
+
+    def new_cart(self, consumer=None, priority=DEFAULT_PRIORITY):
+        """
+        See Marketplace.new_cart().
+        """
+        return self._submit("new_cart", (consumer, priority))
+
+    def add_to_cart(self, cart_id, product):
+        """
+        See Marketplace.add_to_cart().
+        """
+        return self._submit("add_to_cart", (cart_id, product))
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        See Marketplace.remove_from_cart().
+        """
+        return self._submit("remove_from_cart", (cart_id, product))
+
+    def place_order(self, cart_id):
+        """
+        See Marketplace.place_order().
+        """
+        return self._submit("place_order", (cart_id,))
+
+    def execute_cart(self, operations, timeout=None, consumer=None, priority=DEFAULT_PRIORITY):
+        """
+        See Marketplace.execute_cart().
+        """
+        return self._submit("execute_cart", (operations, timeout, consumer, priority))
+
+
+def split_frames(buffer):
+    """
+    Removes the complete frames from the beginning of a buffer.
+
+    :type buffer: bytearray
+    :param buffer: the received bytes that weren't decoded yet
+
+    :returns the list of frame bodies (the incomplete frame stays in the buffer)
+    """
+    bodies = []
+    offset = 0
+    while len(buffer) - offset >= FRAME.size:
+        (length,) = FRAME.unpack_from(buffer, offset)
+        if len(buffer) - offset - FRAME.size < length:
+            break
+        start = offset + FRAME.size
+        bodies.append(bytes(buffer[start:start + length]))
+        offset = start + length
+    del buffer[:offset]
+    return bodies
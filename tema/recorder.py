@@ -0,0 +1,346 @@
+"""
+This module records the calls made to a Marketplace in a compact binary file and
+replays them, without any sleep, against any Marketplace implementation.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import json
+import os
+import struct
+import tempfile
+import threading
+from time import perf_counter, perf_counter_ns
+import unittest
+
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+from tema.protocol import FRAME, LENGTH, MarketplaceCalls, MessageCodec
+
+# The file starts with the magic string and the length of the JSON header
+MAGIC = b"MKTREC02"
+PREAMBLE = struct.Struct("<8sI")
+# Each record starts with its kind
+KIND = struct.Struct("<B")
+THREAD_RECORD = 0
+CALL_RECORD = 1
+# A thread record holds the index of the thread, followed by its name
+THREAD = struct.Struct("<H")
+# A call record holds the thread index, the call time (nanoseconds from the beginning
+# of the recording) and the duration, followed by the request and the reply frames
+# of the protocol used by the Marketplace server
+CALL = struct.Struct("<HqQ")
+# Number of bytes kept in memory before they are written to the file
+FLUSH_SIZE = 1 << 20
+
+
+class RecordedCall:
+    """
+    A call read from a recording.
+    """
+    # pylint: disable=too-few-public-methods, too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+
+    def __init__(self, thread, start, duration, name, arguments, result, is_error):
+        self.thread = thread
+        self.start = start
+        self.duration = duration
+        self.name = name
+        self.arguments = arguments
+        self.result = result
+        self.is_error = is_error
+
+
+class RecordingMarketplace(MarketplaceCalls):
+    """
+    Forwards the calls to a Marketplace and records each of them, with its result
+    and the calling thread, when it returns. The calls are written in the order
+    they returned.
+    """
+
+    def __init__(self, marketplace, path):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the recorded marketplace
+
+        :type path: String
+        :param path: the file to write
+        """
+        self.marketplace = marketplace
+        self.recording = open(path, "wb")  # pylint: disable=consider-using-with
+        header = json.dumps({"queue_size_per_producer": marketplace.queue_size_per_producer,
+                             "options": marketplace.options}).encode()
+        self.buffer = bytearray(PREAMBLE.pack(MAGIC, len(header)) + header)
+        self.codec = MessageCodec()
+        self.start = perf_counter_ns()
+        self.calls = 0
+        # Dictionary with key: thread ident, value: index of the thread in the file
+        self.threads = {}
+        # Lock used to avoid race condition between the threads that record calls
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # The other methods of the Marketplace (wait_for_demand(), the reports...)
+        # are forwarded, but not recorded
+        return getattr(self.marketplace, name)
+
+    def _submit(self, name, arguments):
+        start = perf_counter_ns()
+        try:
+            result = getattr(self.marketplace, name)(*arguments)
+        except Exception as error:
+            self._record(name, arguments, start, error, True)
+            raise
+        self._record(name, arguments, start, result, False)
+        return result
+
+    def _record(self, name, arguments, start, result, is_error):
+        """
+        Appends a call record (and the record of the thread, the first time).
+        """
+        # pylint: disable=too-many-arguments
+        end = perf_counter_ns()
+        thread_id = threading.get_ident()
+        with self.lock:
+            if self.recording is None:
+                return
+            thread = self.threads.get(thread_id)
+            if thread is None:
+                thread = self.threads[thread_id] = len(self.threads)
+                name_bytes = threading.current_thread().name.encode()
+                self.buffer += KIND.pack(THREAD_RECORD) + THREAD.pack(thread)
+                self.buffer += LENGTH.pack(len(name_bytes)) + name_bytes
+            request_id = self.calls & 0xFFFFFFFF
+            self.buffer += KIND.pack(CALL_RECORD)
+            self.buffer += CALL.pack(thread, start - self.start, end - start)
+            self.buffer += self.codec.encode_request(request_id, name, arguments)
+            if is_error:
+                self.buffer += self.codec.encode_error(request_id, result)
+            else:
+                self.buffer += self.codec.encode_reply(request_id, name, result)
+            self.calls += 1
+            if len(self.buffer) >= FLUSH_SIZE:
+                self.recording.write(self.buffer)
+                self.buffer = bytearray()
+
+    def close(self):
+        """
+        Writes the last calls and closes the file. The calls made afterwards are
+        forwarded, but not recorded.
+        """
+        with self.lock:
+            if self.recording is not None:
+                self.recording.write(self.buffer)
+                self.recording.close()
+                self.recording = None
+
+
+def read_recording(path):
+    """
+    Reads a file written by RecordingMarketplace.
+
+    :returns a tuple (header dictionary, list of thread names, list of RecordedCall)
+    """
+    # pylint: disable=too-many-locals
+    with open(path, "rb") as recording:
+        data = recording.read()
+    magic, header_length = PREAMBLE.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("{0} is not a Marketplace recording".format(path))
+    offset = PREAMBLE.size
+    header = json.loads(data[offset:offset + header_length])
+    offset += header_length
+    codec = MessageCodec()
+    thread_names, calls = [], []
+    while offset < len(data):
+        (kind,) = KIND.unpack_from(data, offset)
+        offset += KIND.size
+        if kind == THREAD_RECORD:
+            offset += THREAD.size
+            (length,) = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            thread_names.append(data[offset:offset + length].decode())
+            offset += length
+            continue
+        thread, start, duration = CALL.unpack_from(data, offset)
+        offset += CALL.size
+        request, offset = _read_frame(data, offset)
+        _, name, arguments = codec.decode_request(request)
+        reply, offset = _read_frame(data, offset)
+        _, result, is_error = codec.decode_reply(reply, name)
+        calls.append(RecordedCall(thread, start, duration, name, arguments, result, is_error))
+    return header, thread_names, calls
+
+
+def _read_frame(data, offset):
+    """
+    :returns a tuple (body of the frame starting at offset, offset after the frame)
+    """
+    (length,) = FRAME.unpack_from(data, offset)
+    offset += FRAME.size
+    return data[offset:offset + length], offset + length
+
+
+class Replayer:
+    """
+    Makes recorded calls on a Marketplace and compares their results with the
+    recorded ones. The producer and cart ids returned during the replay may differ
+    from the recorded ones, the arguments are translated.
+    """
+
+    def __init__(self, marketplace, wait_timeout=0):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace that receives the calls
+
+        :type wait_timeout: Float
+        :param wait_timeout: the timeout of the replayed execute_cart() calls (the
+        recorded ones might have waited for producers that are not replayed yet)
+        """
+        self.marketplace = marketplace
+        self.wait_timeout = wait_timeout
+        # Dictionaries with key: recorded id, value: id returned during the replay
+        self.producer_ids = {}
+        self.cart_ids = {}
+        # Dictionary with key: method name, value: number of different results, and
+        # the Lock used to avoid race condition when several threads replay calls
+        self.mismatches = {}
+        self.mismatches_lock = threading.Lock()
+
+    def replay(self, call):
+        """
+        Makes a recorded call and counts it if its result is different.
+        """
+        arguments = list(call.arguments)
+        if call.name == "publish":
+            arguments[0] = self.producer_ids.get(arguments[0], arguments[0])
+        elif call.name in ("add_to_cart", "remove_from_cart", "place_order"):
+            arguments[0] = self.cart_ids.get(arguments[0], arguments[0])
+        elif call.name == "execute_cart":
+            arguments[1] = self.wait_timeout
+        try:
+            result, is_error = getattr(self.marketplace, call.name)(*arguments), False
+        except Exception:  # pylint: disable=broad-except
+            # The recorded call may have failed too, the results are compared below
+            result, is_error = None, True
+        if call.name == "register_producer" and not call.is_error:
+            self.producer_ids[call.result] = result
+        elif call.name == "new_cart" and not call.is_error:
+            self.cart_ids[call.result] = result
+        elif is_error != call.is_error or (not is_error and result != call.result):
+            with self.mismatches_lock:
+                self.mismatches[call.name] = self.mismatches.get(call.name, 0) + 1
+
+
+def replay_sequential(marketplace, calls, wait_timeout=0):
+    """
+    Replays the calls from a single thread, in the recorded order.
+
+    :returns a tuple (elapsed seconds, dictionary of mismatches by method name)
+    """
+    replayer = Replayer(marketplace, wait_timeout)
+    start = perf_counter()
+    for call in calls:
+        replayer.replay(call)
+    return perf_counter() - start, replayer.mismatches
+
+
+def replay_threads(marketplace, calls, wait_timeout=1):
+    """
+    Replays the calls of each recorded thread from its own thread, all the threads
+    starting together, so the original partitioning of the calls is kept.
+
+    The threads don't keep the recorded interleaving, so an execute_cart() call may
+    run before the publish() calls of another thread it depends on: with several
+    threads, wait_timeout must be positive, or such calls would fail at once and be
+    counted as mismatches.
+
+    :returns a tuple (elapsed seconds, dictionary of mismatches by method name)
+    """
+    partitions = {}
+    for call in calls:
+        partitions.setdefault(call.thread, []).append(call)
+    if len(partitions) > 1 and wait_timeout <= 0:
+        raise ValueError("replaying several threads needs a positive wait_timeout")
+    replayer = Replayer(marketplace, wait_timeout)
+    barrier = threading.Barrier(len(partitions) + 1)
+
+    def replay_partition(partition):
+        barrier.wait()
+        for call in partition:
+            replayer.replay(call)
+
+    threads = [threading.Thread(target=replay_partition, args=(partition,))
+               for partition in partitions.values()]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start, replayer.mismatches
+
+
+class TestRecorder(unittest.TestCase):
+    """
+    Unit testing class for RecordingMarketplace and the replay functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Records a few calls in a temporary file.
+        """
+        handle, self.path = tempfile.mkstemp(suffix=".rec")
+        os.close(handle)
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        recorder = RecordingMarketplace(Marketplace(2, reservation_ttl=60), self.path)
+        producer_id = recorder.register_producer()
+        for product in (self.product0, self.product1, self.product1):
+            recorder.publish(producer_id, product)
+        cart_id = recorder.new_cart()
+        recorder.add_to_cart(cart_id, self.product1)
+        recorder.add_to_cart(cart_id, self.product0)
+        recorder.remove_from_cart(cart_id, self.product0)
+        recorder.place_order(cart_id)
+        recorder.execute_cart([{"type": "add", "product": self.product0, "quantity": 1}])
+        recorder.close()
+
+    def tearDown(self):
+        """
+        Removes the recording.
+        """
+        os.unlink(self.path)
+
+    def test_read(self):
+        """
+        Tests that the calls are read back with their results.
+        """
+        header, thread_names, calls = read_recording(self.path)
+        self.assertEqual(header["queue_size_per_producer"], 2, 'Wrong header!')
+        self.assertEqual(header["options"]["reservation_ttl"], 60, 'Wrong options!')
+        self.assertEqual(thread_names, [threading.current_thread().name], 'Wrong threads!')
+        self.assertEqual([call.name for call in calls][:3],
+                         ["register_producer", "publish", "publish"], 'Wrong calls!')
+        self.assertEqual([call.result for call in calls[1:4]], [True, True, False],
+                         'Wrong publish results!')
+        self.assertEqual(calls[-2].result, [self.product1], 'Wrong order!')
+
+    def test_replay(self):
+        """
+        Tests that replaying the calls on a new Marketplace gives the same results.
+        """
+        header, _, calls = read_recording(self.path)
+        marketplace = Marketplace(header["queue_size_per_producer"], **header["options"])
+        _, mismatches = replay_sequential(marketplace, calls)
+        self.assertEqual(mismatches, {}, 'The replay should give the same results!')
+        _, mismatches = replay_sequential(Marketplace(1), calls)
+        self.assertEqual(mismatches, {"publish": 1, "add_to_cart": 1, "place_order": 1},
+                         'A smaller queue changes the results!')
@@ -0,0 +1,183 @@
+"""
+This module keeps track of the cart reservations that can expire.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from collections import deque
+from threading import Lock
+from time import monotonic
+import unittest
+
+from tema.product import Coffee
+
+
+class ReservationTracker:
+    """
+    Remembers when every unit moved into a cart has to be given back to the Marketplace.
+
+    The time to live is the same for every reservation, so deadlines are created in
+    non-decreasing order and a FIFO queue is enough to find the expired ones: we only
+    look at its head. Refreshing a cart pushes new entries at the tail and the old ones
+    become stale (their deadline no longer matches the one stored in the cart element),
+    so they are dropped when they reach the head.
+    """
+
+    def __init__(self, ttl):
+        """
+        Constructor
+
+        :type ttl: Float
+        :param ttl: the number of seconds a unit can stay in a cart before it expires
+        """
+        self.ttl = ttl
+        # Queue of (deadline, cart_id, cart_element), ordered by deadline
+        self.deadlines = deque()
+        # Lock used to avoid race condition on the deadlines queue
+        self.deadlines_lock = Lock()
+        # Number of units that expired and were returned to the Marketplace
+        self.expired_units = 0
+        # Dictionary with key: cart_id, value: number of units expired from that cart
+        self.expired_by_cart = {}
+        # Number of units whose reservation was extended by a refresh
+        self.refreshed_units = 0
+
+    def reserve(self, cart_id, cart_element, now=None):
+        """
+        Starts the reservation of a unit which has just been added to a cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type cart_element: Dict
+        :param cart_element: the element of the cart list that holds the unit
+
+        :type now: Float
+        :param now: current time (time.monotonic() if missing)
+        """
+        deadline = (monotonic() if now is None else now) + self.ttl
+        cart_element["deadline"] = deadline
+        with self.deadlines_lock:
+            self.deadlines.append((deadline, cart_id, cart_element))
+
+    def refresh(self, cart_id, cart_elements, now=None):
+        """
+        Extends the reservation of all the units from a cart. The caller must hold
+        the lock of the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type cart_elements: List
+        :param cart_elements: the elements of the cart
+
+        :type now: Float
+        :param now: current time (time.monotonic() if missing)
+        """
+        deadline = (monotonic() if now is None else now) + self.ttl
+        with self.deadlines_lock:
+            for cart_element in cart_elements:
+                cart_element["deadline"] = deadline
+                self.deadlines.append((deadline, cart_id, cart_element))
+            self.refreshed_units += len(cart_elements)
+
+    def pop_expired(self, now=None):
+        """
+        Extracts the reservations whose deadline has passed.
+
+        The returned entries may still be stale (the unit was ordered, removed or
+        refreshed meanwhile), so the caller must check them again under the cart lock,
+        using is_expired().
+
+        :type now: Float
+        :param now: current time (time.monotonic() if missing)
+
+        :returns a list of (deadline, cart_id, cart_element)
+        """
+        if now is None:
+            now = monotonic()
+        expired = []
+        # Cheap check without the lock, the head only moves forward in time
+        if not self.deadlines or self.deadlines[0][0] > now:
+            return expired
+        with self.deadlines_lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                entry = self.deadlines.popleft()
+                # Skip the entries that were refreshed or released meanwhile
+                if entry[2].get("deadline") == entry[0]:
+                    expired.append(entry)
+        return expired
+
+    @staticmethod
+    def is_expired(entry):
+        """
+        Checks that an entry returned by pop_expired() still has to expire.
+        The caller must hold the lock of the cart.
+        """
+        return entry[2].get("deadline") == entry[0]
+
+    @staticmethod
+    def release(cart_element):
+        """
+        Marks a unit as no longer reserved (ordered or removed from cart).
+        The caller must hold the lock of the cart.
+        """
+        cart_element["deadline"] = None
+
+    def count_expired(self, cart_id):
+        """
+        Updates the expiration counters after a unit was returned to the Marketplace.
+        """
+        with self.deadlines_lock:
+            self.expired_units += 1
+            self.expired_by_cart[cart_id] = self.expired_by_cart.get(cart_id, 0) + 1
+
+
+class TestReservationTracker(unittest.TestCase):
+    """
+    Unit testing class for the reservations that expire.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        """
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+
+    def test_reservation_expiry(self):
+        """
+        Tests that units held in a cart longer than the reservation ttl are returned
+        to the Marketplace and that a refresh extends the reservation.
+        """
+        # Imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        marketplace = Marketplace(2, reservation_ttl=10)
+        producer_id = marketplace.register_producer()
+        for _ in range(2):
+            self.assertTrue(marketplace.publish(producer_id, self.product0),
+                            'Producer prod0 should be able to publish product!')
+        cart0 = marketplace.new_cart()
+        cart1 = marketplace.new_cart()
+        self.assertTrue(marketplace.add_to_cart(cart0, self.product0),
+                        'Cannot add product0 to cart!')
+        self.assertTrue(marketplace.add_to_cart(cart1, self.product0),
+                        'Cannot add product0 to cart!')
+        # Cart1 is refreshed later, so only the unit from cart0 expires
+        now = marketplace.reservations.deadlines[0][0]
+        self.assertEqual(marketplace.refresh_cart(cart1), 1, 'Cart1 should hold one unit!')
+        self.assertEqual(marketplace.expire_reservations(now), 1,
+                         'Only the unit from cart0 should expire!')
+        self.assertEqual(marketplace.carts[cart0], [], 'Cart0 should be empty!')
+        self.assertEqual(len(marketplace.carts[cart1]), 1, 'Cart1 should keep its unit!')
+        self.assertEqual(len(marketplace.products_producers[self.product0]), 1,
+                         'Product0 should be available in quantity = 1!')
+        self.assertEqual(marketplace.reservations.expired_by_cart, {cart0: 1},
+                         'Wrong expiration counters!')
+        # The expired unit still counts in the queue until it is ordered
+        self.assertFalse(marketplace.publish(producer_id, self.product0),
+                         'Producer prod0 should not be able to publish product!')
+        self.assertEqual(marketplace.place_order(cart1), [self.product0], 'Wrong cart list!')
+        self.assertEqual(marketplace.expire_reservations(now + 100), 0,
+                         'Ordered units should not expire!')
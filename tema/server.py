@@ -0,0 +1,495 @@
+"""
+This module serves a Marketplace on a local socket and offers a proxy with the
+same methods, so producers and consumers can run in other processes.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import os
+import socket
+import socketserver
+import tempfile
+from threading import Lock, Thread
+import time
+import unittest
+
+from tema.marketplace import Marketplace
+from tema.product import Coffee, Tea
+from tema.progress import MarketplaceStalled
+from tema.protocol import FRAME, REQUEST, MarketplaceCalls, MessageCodec, split_frames
+
+# Number of bytes read from a socket at once
+RECV_SIZE = 1 << 16
+# Number of idle connections kept by a proxy
+DEFAULT_POOL_SIZE = 8
+# Exceptions raised by the Marketplace that are raised again by the proxy
+REMOTE_EXCEPTIONS = {"MarketplaceStalled": MarketplaceStalled}
+
+
+class RemoteError(Exception):
+    """
+    Raised by the proxy when a call failed on the server.
+    """
+
+
+def parse_address(text):
+    """
+    Parses a server address: "host:port" for TCP, a path for a Unix socket.
+
+    :returns a tuple (host, port) or the path
+    """
+    host, separator, port = text.rpartition(":")
+    if separator and port.isdigit():
+        return host or "localhost", int(port)
+    return text
+
+
+class _MarketplaceHandler(socketserver.BaseRequestHandler):
+    """
+    Serves the requests of a connection, in order. All the requests received
+    together are answered with a single send.
+    """
+
+    def handle(self):
+        if self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        codec = MessageCodec()
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(RECV_SIZE)
+            if not data:
+                return
+            buffer += data
+            replies = bytearray()
+            for body in split_frames(buffer):
+                replies += self.server.dispatch(codec, body)
+            if replies:
+                self.request.sendall(replies)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MarketplaceServer:
+    """
+    Serves a Marketplace on a Unix socket or on a TCP port, with a thread for
+    each connection.
+    """
+
+    def __init__(self, marketplace, address):
+        """
+        Constructor
+
+        :type marketplace: Marketplace
+        :param marketplace: the served marketplace
+
+        :type address: String or Tuple
+        :param address: the path of a Unix socket or a tuple (host, port)
+        """
+        self.marketplace = marketplace
+        server_class = _TCPServer if isinstance(address, tuple) else _UnixServer
+        self.server = server_class(address, _MarketplaceHandler)
+        self.server.dispatch = self.dispatch
+        self.thread = None
+
+    @property
+    def address(self):
+        """
+        The address of the server (with the actual port, if port 0 was asked).
+        """
+        return self.server.server_address
+
+    def dispatch(self, codec, body):
+        """
+        Calls the Marketplace method asked by a request.
+
+        :returns the frame of the reply
+        """
+        request_id = 0
+        try:
+            request_id = codec.request_id(body)
+            _, name, arguments = codec.decode_request(body)
+            result = getattr(self.marketplace, name)(*arguments)
+        except Exception as error:  # pylint: disable=broad-except
+            # The client gets the exception, even for a request it can't decode,
+            # the server keeps working
+            return codec.encode_error(request_id, error)
+        return codec.encode_reply(request_id, name, result)
+
+    def serve_forever(self):
+        """
+        Serves the clients until close() is called.
+        """
+        self.server.serve_forever()
+
+    def start(self):
+        """
+        Serves the clients from a background thread.
+        """
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stops the server and removes its Unix socket.
+        """
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class _ClientConnection:
+    """
+    A connection of a proxy, used by one thread at a time.
+    """
+
+    def __init__(self, address):
+        family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.codec = MessageCodec()
+        self.buffer = bytearray()
+        self.next_request_id = 0
+
+    def call_many(self, calls):
+        """
+        Sends all the calls at once and reads their replies.
+
+        :type calls: List
+        :param calls: list of (method name, tuple of arguments)
+
+        :returns the list of (result, True if the result is an error)
+        """
+        frames = []
+        for name, arguments in calls:
+            frames.append(self.codec.encode_request(self.next_request_id, name, arguments))
+            self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(b"".join(frames))
+        bodies = []
+        while len(bodies) < len(calls):
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("The Marketplace server closed the connection")
+            self.buffer += data
+            bodies += split_frames(self.buffer)
+        replies = []
+        for (name, _), body in zip(calls, bodies):
+            _, result, is_error = self.codec.decode_reply(body, name)
+            replies.append((result, is_error))
+        return replies
+
+    def close(self):
+        """
+        Closes the socket.
+        """
+        self.sock.close()
+
+
+class MarketplaceProxy(MarketplaceCalls):
+    """
+    Stands for a Marketplace served by a MarketplaceServer. It can be shared by
+    producers and consumers: each call takes a connection from a pool.
+    """
+
+    def __init__(self, address, pool_size=DEFAULT_POOL_SIZE):
+        """
+        Constructor
+
+        :type address: String or Tuple
+        :param address: the path of a Unix socket or a tuple (host, port)
+
+        :type pool_size: Int
+        :param pool_size: the maximum number of idle connections kept open
+        """
+        self.address = address
+        self.pool_size = pool_size
+        # Idle connections, the last used is reused first
+        self.pool = []
+        # Lock used to avoid race condition when threads take and give back connections
+        self.pool_lock = Lock()
+
+    def _submit(self, name, arguments):
+        return self.call_many([(name, arguments)])[0]
+
+    def call_many(self, calls):
+        """
+        Makes several calls in a single round-trip. They are executed in order
+        by the server, so a call that blocks (execute_cart) delays the next ones.
+
+        :type calls: List
+        :param calls: list of (method name, tuple of arguments)
+
+        :returns the list of results
+        """
+        with self.pool_lock:
+            connection = self.pool.pop() if self.pool else None
+        if connection is None:
+            connection = _ClientConnection(self.address)
+        try:
+            replies = connection.call_many(calls)
+        except Exception:
+            # The connection is in an unknown state, don't reuse it
+            connection.close()
+            raise
+        with self.pool_lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+        for result, is_error in replies:
+            if is_error:
+                error_name, message = result
+                if error_name in REMOTE_EXCEPTIONS:
+                    raise REMOTE_EXCEPTIONS[error_name](message)
+                raise RemoteError("{0}: {1}".format(error_name, message))
+        return [result for result, _ in replies]
+
+    def publish_many(self, producer_id, products):
+        """
+        Publishes several products in a single round-trip.
+
+        :returns the list of publish() results
+        """
+        return self.call_many([("publish", (producer_id, product)) for product in products])
+
+    def add_many(self, cart_id, products):
+        """
+        Adds several products to a cart in a single round-trip.
+
+        :returns the list of add_to_cart() results
+        """
+        return self.call_many([("add_to_cart", (cart_id, product)) for product in products])
+
+    def pipeline(self):
+        """
+        :returns a Pipeline that sends the calls of this proxy in batches
+        """
+        return Pipeline(self)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self.pool_lock:
+            connections, self.pool = self.pool, []
+        for connection in connections:
+            connection.close()
+
+
+class Pipeline(MarketplaceCalls):
+    """
+    Collects calls and sends them in a single round-trip when execute() is called
+    (or at the end of a with block). The calls return None, the results are
+    returned by execute() and kept in results.
+    """
+
+    def __init__(self, proxy):
+        """
+        Constructor
+
+        :type proxy: MarketplaceProxy
+        :param proxy: the proxy that sends the calls
+        """
+        self.proxy = proxy
+        self.calls = []
+        self.results = None
+
+    def _submit(self, name, arguments):
+        self.calls.append((name, arguments))
+
+    def execute(self):
+        """
+        Sends the collected calls.
+
+        :returns the list of their results, in order
+        """
+        calls, self.calls = self.calls, []
+        self.results = self.proxy.call_many(calls) if calls else []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+def benchmark(proxy, count, batch_size):
+    """
+    Measures the throughput of single calls and of batched calls.
+
+    :returns a list of (description, calls per second)
+    """
+    product = Tea(name="Linden", type="Herbal", price=9)
+    producer_id = proxy.register_producer()
+    cart_id = proxy.new_cart()
+    results = []
+
+    start = time.perf_counter()
+    for _ in range(count):
+        proxy.publish(producer_id, product)
+    results.append(("publish, one per round-trip", count / (time.perf_counter() - start)))
+    start = time.perf_counter()
+    for _ in range(count):
+        proxy.add_to_cart(cart_id, product)
+    results.append(("add_to_cart, one per round-trip",
+                    count / (time.perf_counter() - start)))
+
+    start = time.perf_counter()
+    for batch_start in range(0, count, batch_size):
+        proxy.publish_many(producer_id, [product] * min(batch_size, count - batch_start))
+    results.append(("publish, {0} per round-trip".format(batch_size),
+                    count / (time.perf_counter() - start)))
+    start = time.perf_counter()
+    for batch_start in range(0, count, batch_size):
+        proxy.add_many(cart_id, [product] * min(batch_size, count - batch_start))
+    results.append(("add_to_cart, {0} per round-trip".format(batch_size),
+                    count / (time.perf_counter() - start)))
+    return results
+
+
+def main():
+    """
+    Serves a Marketplace, or measures the throughput of a local server.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", help="host:port or path of a Unix socket "
+                                          "(a temporary Unix socket for --bench)")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="queue_size_per_producer of the served Marketplace")
+    parser.add_argument("--bench", type=int, metavar="CALLS",
+                        help="measure the throughput with this number of calls")
+    parser.add_argument("--batch", type=int, default=100,
+                        help="number of calls per round-trip in the benchmark")
+    args = parser.parse_args()
+
+    if args.bench is None:
+        if args.address is None:
+            parser.error("--address is needed to serve a Marketplace")
+        server = MarketplaceServer(Marketplace(args.queue_size), parse_address(args.address))
+        print("serving on {0}".format(server.address), flush=True)
+        server.serve_forever()
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        address = os.path.join(directory, "marketplace.sock")
+        if args.address is not None:
+            address = parse_address(args.address)
+        server = MarketplaceServer(Marketplace(2 * args.bench), address)
+        server.start()
+        proxy = MarketplaceProxy(server.address)
+        for description, throughput in benchmark(proxy, args.bench, args.batch):
+            print("{0:<36} {1:>12.0f} calls/s".format(description, throughput))
+        proxy.close()
+        server.close()
+
+
+class TestMarketplaceServer(unittest.TestCase):
+    """
+    Unit testing class for MarketplaceServer and MarketplaceProxy functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Serves a Marketplace with queue size 2 on a temporary Unix socket.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.marketplace = Marketplace(2)
+        self.server = MarketplaceServer(self.marketplace,
+                                        os.path.join(self.directory, "test.sock"))
+        self.server.start()
+        self.proxy = MarketplaceProxy(self.server.address)
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+
+    def tearDown(self):
+        """
+        Stops the server.
+        """
+        self.proxy.close()
+        self.server.close()
+        os.rmdir(self.directory)
+
+    def test_calls(self):
+        """
+        Tests that the proxy calls the methods of the Marketplace.
+        """
+        producer_id = self.proxy.register_producer()
+        self.assertEqual(producer_id, "prod0", 'Wrong producer id!')
+        self.assertTrue(self.proxy.publish(producer_id, self.product0), 'Publish failed!')
+        self.assertTrue(self.proxy.publish(producer_id, self.product1), 'Publish failed!')
+        self.assertFalse(self.proxy.publish(producer_id, self.product1), 'Queue is full!')
+        cart_id = self.proxy.new_cart("cons0")
+        self.assertTrue(self.proxy.add_to_cart(cart_id, self.product1), 'Add failed!')
+        self.assertTrue(self.proxy.add_to_cart(cart_id, self.product0), 'Add failed!')
+        self.assertTrue(self.proxy.remove_from_cart(cart_id, self.product1), 'Remove failed!')
+        self.assertEqual(self.proxy.place_order(cart_id), [self.product0], 'Wrong order!')
+        self.assertEqual(self.marketplace.carts_consumers[cart_id], "cons0", 'Wrong consumer!')
+        cart = [{"type": "add", "product": self.product1, "quantity": 1}]
+        self.assertEqual(self.proxy.execute_cart(cart, consumer="cons1"), [self.product1],
+                         'Wrong order!')
+        self.assertIsNone(self.proxy.execute_cart(cart, timeout=0), 'No product left!')
+        self.assertIsNone(self.proxy.place_order(100), 'Cart does not exist!')
+        with self.assertRaises(RemoteError):
+            self.proxy.publish("prod100", self.product0)
+
+    def test_batches(self):
+        """
+        Tests that the calls sent in a single round-trip are executed in order.
+        """
+        producer_id = self.proxy.register_producer()
+        self.assertEqual(self.proxy.publish_many(producer_id, [self.product0] * 3),
+                         [True, True, False], 'Wrong publish results!')
+        with self.proxy.pipeline() as pipeline:
+            pipeline.new_cart()
+            pipeline.add_to_cart(0, self.product0)
+            pipeline.add_to_cart(0, self.product1)
+            pipeline.place_order(0)
+        self.assertEqual(pipeline.results, [0, True, False, [self.product0]],
+                         'Wrong pipeline results!')
+        cart_id = self.proxy.new_cart()
+        self.assertEqual(self.proxy.add_many(cart_id, [self.product0] * 2), [True, False],
+                         'Wrong add results!')
+
+    def test_errors(self):
+        """
+        Tests that long error messages and requests that can't be decoded are
+        answered with an error, without closing the connection.
+        """
+        with self.assertRaises(RemoteError) as context:
+            self.proxy.publish("x" * 70000, self.product0)
+        self.assertIn("x" * 70000, str(context.exception), 'The message is cut!')
+        connection = _ClientConnection(self.server.address)
+        body = REQUEST.pack(99, 7)
+        connection.sock.sendall(FRAME.pack(len(body)) + body)
+        reply = b""
+        while len(split_frames(bytearray(reply))) == 0:
+            reply += connection.sock.recv(RECV_SIZE)
+        request_id, (error_name, _), is_error = connection.codec.decode_reply(
+            split_frames(bytearray(reply))[0], "publish")
+        self.assertEqual((request_id, error_name, is_error), (7, "ProtocolError", True),
+                         'Wrong error reply!')
+        self.assertEqual(connection.call_many([("register_producer", ())]),
+                         [("prod0", False)], 'The connection should still work!')
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""
+This module offers consistent point-in-time views of the Marketplace inventory.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from dataclasses import dataclass
+from threading import Lock
+import unittest
+
+from tema.product import Coffee, Tea
+
+# Names of the tables of InventoryStats handed out by its snapshots
+TABLES = ("stock", "queues", "producer_stock", "cart_holdings")
+
+
+@dataclass(frozen=True)
+class InventorySnapshot:
+    """
+    Point-in-time view of the Marketplace. The dictionaries are shared with the
+    Marketplace (copy-on-write), so they must not be modified.
+    """
+    # Number of changes applied to the inventory when the view was taken
+    version: int
+    # Dictionary with key: product, value: number of available units
+    stock: dict
+    # Dictionary with key: producer_id, value: number of units in the producer's queue
+    queues: dict
+    # Dictionary with key: producer_id, value: dictionary product -> available units
+    producer_stock: dict
+    # Dictionary with key: cart_id, value: dictionary product -> units in cart (only
+    # the carts holding units)
+    cart_holdings: dict
+
+
+class InventoryStats:
+    """
+    Counters of the Marketplace inventory, updated by the producers and the consumers.
+
+    Taking a snapshot only hands out references to the current tables and marks them
+    as shared. The first change of a table after a snapshot copies it (only that
+    table) and each inner table is copied the first time it is changed, so readers
+    never copy anything and never hold the lock for more than a few instructions.
+    The emptied carts are dropped from cart_holdings, so a copy of it only costs
+    as much as the carts holding units. While nothing changes, the same snapshot is
+    returned again.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, catalog=None, matrix=None):
+        """
+        Constructor
+
+        :type catalog: ProductCatalog
+        :param catalog: told when a product runs out of stock or becomes available again
+
+        :type matrix: InventoryMatrix
+        :param matrix: receives every change of the units of the producers (None if the
+        Marketplace doesn't keep the matrix)
+        """
+        self.version = 0
+        self.stock = {}
+        self.queues = {}
+        self.producer_stock = {}
+        self.cart_holdings = {}
+        # Names of the tables referenced by the last snapshot and not copied since
+        self.shared = set()
+        # Keys of the inner tables copied since the last snapshot
+        self.owned_producers = set()
+        self.owned_carts = set()
+        self.last_snapshot = None
+        self.catalog = catalog
+        self.matrix = matrix
+        # Lock used to apply each change atomically
+        self.lock = Lock()
+
+    def snapshot(self):
+        """
+        Returns a consistent view of the inventory.
+
+        :returns an InventorySnapshot
+        """
+        with self.lock:
+            if self.last_snapshot is None or self.last_snapshot.version != self.version:
+                self.last_snapshot = InventorySnapshot(self.version, self.stock, self.queues,
+                                                       self.producer_stock, self.cart_holdings)
+                self.shared = set(TABLES)
+            return self.last_snapshot
+
+    def stock_of(self, products):
+        """
+        Reads the available units of a few products, without taking a snapshot (the
+        next change of the inventory would have to copy its tables).
+
+        :returns a dictionary with key: product, value: number of available units
+        """
+        with self.lock:
+            return {product: self.stock.get(product, 0) for product in products}
+
+    def describe_queues(self, quota):
+        """
+        Describes the content of the queue of each producer, for the deadlock diagnostic.
+
+        :type quota: Callable
+        :param quota: function that returns the maximum size of the queue of a producer
+
+        :returns a list of lines
+        """
+        in_carts = {}
+        with self.lock:
+            queues = dict(self.queues)
+            producer_stock = {producer_id: list(stock.items())
+                              for producer_id, stock in self.producer_stock.items()}
+            for cart_holdings in self.cart_holdings.values():
+                for product, count in cart_holdings.items():
+                    in_carts[product] = in_carts.get(product, 0) + count
+        lines = ["Producer queues:"]
+        for producer_id, queue_size in queues.items():
+            lines.append("  {0}: {1}/{2} units".format(producer_id, queue_size,
+                                                       quota(producer_id)))
+            lines += ["    {0} x {1}".format(product, count)
+                      for product, count in producer_stock[producer_id]]
+        lines.append("Units in carts:")
+        lines += ["  {0} x {1}".format(product, count) for product, count in in_carts.items()]
+        return lines
+
+    def load(self, stock, queues, producer_stock, cart_holdings):
+        """
+        Replaces all the counters (used when the Marketplace is restored from a file).
+        The tables are owned by the InventoryStats afterwards.
+        """
+        with self.lock:
+            self.stock = stock
+            self.queues = queues
+            self.producer_stock = producer_stock
+            self.cart_holdings = {cart_id: holdings
+                                  for cart_id, holdings in cart_holdings.items() if holdings}
+            self.owned_producers = set(producer_stock)
+            self.owned_carts = set(self.cart_holdings)
+            self.shared = set()
+            self.version += 1
+            if self.catalog is not None:
+                self.catalog.reset(product for product, count in stock.items() if count > 0)
+
+    def register_producer(self, producer_id):
+        """
+        Records a new producer with an empty queue.
+        """
+        with self.lock:
+            self._unshare("queues")
+            self._unshare("producer_stock")
+            self.queues[producer_id] = 0
+            self.producer_stock[producer_id] = {}
+            self.owned_producers.add(producer_id)
+            if self.matrix is not None:
+                self.matrix.register_producer(producer_id)
+            self.version += 1
+
+    def published(self, producer_id, product):
+        """
+        Records a unit published by a producer.
+        """
+        with self.lock:
+            self._change_queue(producer_id, 1)
+            self._change_stock(producer_id, product, 1)
+            if self.matrix is not None:
+                self.matrix.change(producer_id, product, available=1)
+            self.version += 1
+
+    def taken(self, cart_id, product, producer_id):
+        """
+        Records a unit moved from the Marketplace into a cart.
+        """
+        with self.lock:
+            self._change_stock(producer_id, product, -1)
+            self._change_cart(cart_id, product, 1)
+            if self.matrix is not None:
+                self.matrix.change(producer_id, product, available=-1, in_carts=1)
+            self.version += 1
+
+    def taken_many(self, cart_id, cart_elements):
+        """
+        Records several units moved from the Marketplace into a cart, at once.
+        """
+        with self.lock:
+            for cart_element in cart_elements:
+                self._change_stock(cart_element["producer_id"], cart_element["product"], -1)
+                self._change_cart(cart_id, cart_element["product"], 1)
+            if self.matrix is not None:
+                self.matrix.change_many(cart_elements, available=-1, in_carts=1)
+            self.version += 1
+
+    def returned(self, cart_id, product, producer_id):
+        """
+        Records a unit moved from a cart back into the Marketplace.
+        """
+        with self.lock:
+            self._change_cart(cart_id, product, -1)
+            self._change_stock(producer_id, product, 1)
+            if self.matrix is not None:
+                self.matrix.change(producer_id, product, available=1, in_carts=-1)
+            self.version += 1
+
+    def returned_many(self, released):
+        """
+        Records units moved from carts back into the Marketplace, at once.
+
+        :type released: Dictionary
+        :param released: key: cart_id, value: list of the returned cart elements
+        """
+        with self.lock:
+            for cart_id, cart_elements in released.items():
+                # Dictionary with key: (product, producer_id), value: number of units
+                counts = {}
+                for cart_element in cart_elements:
+                    key = (cart_element["product"], cart_element["producer_id"])
+                    counts[key] = counts.get(key, 0) + 1
+                for (product, producer_id), count in counts.items():
+                    self._change_cart(cart_id, product, -count)
+                    self._change_stock(producer_id, product, count)
+                if self.matrix is not None:
+                    self.matrix.change_many(cart_elements, available=1, in_carts=-1)
+            self.version += 1
+
+    def ordered(self, cart_id, cart_elements):
+        """
+        Records the units of a cart that were ordered.
+        """
+        with self.lock:
+            for cart_element in cart_elements:
+                self._change_queue(cart_element["producer_id"], -1)
+                self._change_cart(cart_id, cart_element["product"], -1)
+            if self.matrix is not None:
+                self.matrix.change_many(cart_elements, in_carts=-1)
+            self.version += 1
+
+    def _unshare(self, table):
+        """
+        Copies a table before its first change, if it is referenced by a snapshot.
+        """
+        if table in self.shared:
+            setattr(self, table, dict(getattr(self, table)))
+            self.shared.discard(table)
+            # The inner tables are still referenced by the snapshot
+            if table == "producer_stock":
+                self.owned_producers = set()
+            elif table == "cart_holdings":
+                self.owned_carts = set()
+
+    def _change_queue(self, producer_id, delta):
+        """
+        Changes the number of units in the queue of a producer.
+        """
+        self._unshare("queues")
+        self.queues[producer_id] += delta
+
+    def _change_stock(self, producer_id, product, delta):
+        """
+        Changes the number of available units of a product.
+        """
+        self._unshare("stock")
+        self._unshare("producer_stock")
+        count = self.stock.get(product, 0)
+        self.stock[product] = count + delta
+        # The catalog only follows the products running out or coming back
+        if self.catalog is not None:
+            if count == 0 and delta > 0:
+                self.catalog.add(product)
+            elif count > 0 and count + delta == 0:
+                self.catalog.remove(product)
+        if producer_id not in self.owned_producers:
+            self.producer_stock[producer_id] = dict(self.producer_stock[producer_id])
+            self.owned_producers.add(producer_id)
+        _change_count(self.producer_stock[producer_id], product, delta)
+
+    def _change_cart(self, cart_id, product, delta):
+        """
+        Changes the number of units of a product held in a cart.
+        """
+        self._unshare("cart_holdings")
+        if cart_id not in self.owned_carts:
+            self.cart_holdings[cart_id] = dict(self.cart_holdings.get(cart_id, ()))
+            self.owned_carts.add(cart_id)
+        holdings = self.cart_holdings[cart_id]
+        _change_count(holdings, product, delta)
+        # An emptied cart (ordered, cleared or emptied by its consumer) is dropped
+        if not holdings:
+            del self.cart_holdings[cart_id]
+            self.owned_carts.discard(cart_id)
+
+
+def _change_count(counts, key, delta):
+    """
+    Adds delta to counts[key], removing the key when it reaches 0.
+    """
+    count = counts.get(key, 0) + delta
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
+
+
+class TestInventoryStats(unittest.TestCase):
+    """
+    Unit testing class for InventoryStats functionalities.
+    """
+
+    def setUp(self):
+        """
+        Set up method for tests.
+        Prod0 publishes 2 x product0 and 1 x product1, prod1 publishes 1 x product2,
+        and cart0 takes a product0 and the product1.
+        """
+        self.stats = InventoryStats()
+        self.product0 = Coffee(name="Indonezia", acidity="5.05", roast_level="MEDIUM", price=1)
+        self.product1 = Tea(name="Linden", type="Herbal", price=9)
+        self.product2 = Coffee(name="Ethiopia", acidity="5.09", roast_level="MEDIUM", price=10)
+        for producer_id in ("prod0", "prod1"):
+            self.stats.register_producer(producer_id)
+        for product in (self.product0, self.product0, self.product1):
+            self.stats.published("prod0", product)
+        self.stats.published("prod1", self.product2)
+        self.stats.taken(0, self.product0, "prod0")
+        self.stats.taken(0, self.product1, "prod0")
+
+    def test_snapshot(self):
+        """
+        Tests that snapshots describe the inventory and don't change afterwards.
+        """
+        snapshot = self.stats.snapshot()
+        self.assertIs(self.stats.snapshot(), snapshot,
+                      'Unchanged inventory should give the same snapshot!')
+        self.assertEqual(snapshot.stock, {self.product0: 1, self.product1: 0, self.product2: 1},
+                         'Wrong stock in snapshot!')
+        self.assertEqual(snapshot.producer_stock['prod0'], {self.product0: 1},
+                         'Wrong stock of prod0 in snapshot!')
+        self.assertEqual(snapshot.cart_holdings[0], {self.product0: 1, self.product1: 1},
+                         'Wrong content of cart0 in snapshot!')
+        self.stats.ordered(0, [{"product": self.product0, "producer_id": "prod0"},
+                               {"product": self.product1, "producer_id": "prod0"}])
+        self.assertEqual(snapshot.queues, {'prod0': 3, 'prod1': 1},
+                         'Snapshot should not see later orders!')
+        self.assertEqual(snapshot.cart_holdings[0], {self.product0: 1, self.product1: 1},
+                         'Snapshot should not see later orders!')
+        later = self.stats.snapshot()
+        self.assertEqual(later.queues, {'prod0': 1, 'prod1': 1}, 'Wrong queues in snapshot!')
+        self.assertNotIn(0, later.cart_holdings, 'The ordered cart0 should be dropped!')
+        # A publish copies the tables it changes, not the carts
+        self.stats.published('prod1', self.product0)
+        self.assertIs(self.stats.snapshot().cart_holdings, later.cart_holdings,
+                      'The carts should still be shared!')
+
+    def test_describe_queues(self):
+        """
+        Tests the counters read without a snapshot.
+        """
+        self.assertEqual(self.stats.stock_of([self.product1, self.product2]),
+                         {self.product1: 0, self.product2: 1}, 'Wrong stock!')
+        self.assertEqual(self.stats.describe_queues(lambda producer_id: 5),
+                         ["Producer queues:",
+                          "  prod0: 3/5 units", "    {0} x 1".format(self.product0),
+                          "  prod1: 1/5 units", "    {0} x 1".format(self.product2),
+                          "Units in carts:",
+                          "  {0} x 1".format(self.product0), "  {0} x 1".format(self.product1)],
+                         'Wrong description of the queues!')
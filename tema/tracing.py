@@ -0,0 +1,286 @@
+"""
+This module records spans (timed intervals) of the producers, the consumers and the
+Marketplace and writes them in the Chrome trace-event format (chrome://tracing, Perfetto).
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import os
+import random
+import threading
+from time import perf_counter_ns
+import unittest
+
+# Maximum number of events kept by default, the next ones are dropped
+DEFAULT_MAX_EVENTS = 1000000
+
+
+class Span:
+    """
+    A sampled interval of a thread. Its args are shown in the trace viewer.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = perf_counter_ns()
+        self.thread_id = threading.get_ident()
+        # Nanoseconds spent waiting for the locks of the Marketplace
+        self.lock_wait = 0
+
+
+class Tracer:
+    """
+    Collects the spans. Each root span (a cart, a production cycle) is sampled with
+    the given probability and the spans started inside it are recorded only if it
+    was sampled, so tracing can stay on in long runs.
+    """
+
+    def __init__(self, sample_rate=1.0, seed=None, max_events=DEFAULT_MAX_EVENTS):
+        """
+        Constructor
+
+        :type sample_rate: Float
+        :param sample_rate: the probability that a root span is recorded
+
+        :type seed: Int
+        :param seed: the seed of the sampling (None for a random seed)
+
+        :type max_events: Int
+        :param max_events: the maximum number of events kept in memory
+        """
+        self.sample_rate = sample_rate
+        self.rng = random.Random(seed)
+        self.max_events = max_events
+        self.start = perf_counter_ns()
+        self.events = []
+        self.dropped_events = 0
+        # Dictionary with key: thread ident, value: thread name
+        self.thread_names = {}
+        # Dictionary with key: cart_id, value: the span of the cart (None if not sampled)
+        self.cart_spans = {}
+        # Spans of each thread, innermost last (None for the spans that are not sampled)
+        self.local = threading.local()
+        # Lock used to avoid race condition between threads that record events
+        self.lock = threading.Lock()
+
+    def current(self):
+        """
+        :returns the innermost span of the calling thread (None if there is none
+        or if it's not sampled)
+        """
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def start_span(self, name, category, cart_id=None, **args):
+        """
+        Starts a span. It's a child of the innermost span of the calling thread, else of
+        the span of the given cart, else it's a root span and it's sampled.
+
+        :returns the Span, or None if it's not recorded
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            sampled = stack[-1] is not None
+        elif cart_id is not None and cart_id in self.cart_spans:
+            sampled = self.cart_spans[cart_id] is not None
+        else:
+            with self.lock:
+                sampled = self.rng.random() < self.sample_rate
+        return Span(name, category, args) if sampled else None
+
+    def finish_span(self, span, **args):
+        """
+        Records a span (does nothing if span is None).
+        """
+        if span is None:
+            return
+        end = perf_counter_ns()
+        span.args.update(args)
+        if span.lock_wait:
+            span.args["lock_wait_us"] = span.lock_wait / 1000
+        event = {"name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(),
+                 "tid": span.thread_id, "ts": (span.start - self.start) / 1000,
+                 "dur": (end - span.start) / 1000, "args": span.args}
+        with self.lock:
+            if span.thread_id not in self.thread_names:
+                self.thread_names[span.thread_id] = threading.current_thread().name
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            else:
+                self.dropped_events += 1
+
+    @contextmanager
+    def span(self, name, category, cart_id=None, **args):
+        """
+        Records the code run inside a with block as a span, the innermost one of
+        the thread meanwhile.
+
+        :returns (as the with target) the Span, or None if it's not recorded
+        """
+        span = self.start_span(name, category, cart_id, **args)
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        self.local.stack.append(span)
+        try:
+            yield span
+        finally:
+            self.local.stack.pop()
+            self.finish_span(span)
+
+    def begin_cart(self, cart_id):
+        """
+        Starts the span of a cart, which lasts until end_cart().
+        """
+        self.cart_spans[cart_id] = self.start_span("cart {0}".format(cart_id), "cart")
+
+    def end_cart(self, cart_id, **args):
+        """
+        Records the span of a cart.
+        """
+        self.finish_span(self.cart_spans.pop(cart_id, None), **args)
+
+    def count(self, span, counter, value=1):
+        """
+        Adds value to a counter from the args of a span (if it's recorded).
+        """
+        if span is not None:
+            span.args[counter] = span.args.get(counter, 0) + value
+
+    def write(self, path):
+        """
+        Writes the recorded spans in the Chrome trace-event JSON format.
+        """
+        with self.lock:
+            events = list(self.events)
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                         "args": {"name": name}} for tid, name in self.thread_names.items()]
+            dropped_events = self.dropped_events
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms",
+                       "otherData": {"sample_rate": self.sample_rate,
+                                     "dropped_events": dropped_events}}, trace_file)
+
+
+class TracedLock:
+    """
+    A Lock that adds the time its owners waited for it to their innermost span.
+    """
+
+    def __init__(self, tracer):
+        self.lock = threading.Lock()
+        self.tracer = tracer
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        See Lock.acquire().
+        """
+        # pylint: disable=consider-using-with
+        if self.lock.acquire(False):
+            return True
+        span = self.tracer.current()
+        start = perf_counter_ns()
+        acquired = self.lock.acquire(blocking, timeout)
+        if span is not None:
+            span.lock_wait += perf_counter_ns() - start
+        return acquired
+
+    def release(self):
+        """
+        See Lock.release().
+        """
+        self.lock.release()
+
+    def locked(self):
+        """
+        See Lock.locked().
+        """
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def traced(cart_method=False, ends_cart=False):
+    """
+    Decorator of the Marketplace methods: each call is recorded as a span when the
+    Marketplace has a tracer.
+
+    :type cart_method: Bool
+    :param cart_method: True if the first argument is a cart_id; the call is then a
+    child of the cart's span and its failures are counted there
+
+    :type ends_cart: Bool
+    :param ends_cart: True if the span of the cart ends with the call
+    """
+    def decorator(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(marketplace, *args, **kwargs):
+            tracer = marketplace.tracer
+            if tracer is None:
+                return method(marketplace, *args, **kwargs)
+            cart_id = args[0] if cart_method and args else None
+            with tracer.span(name, "marketplace", cart_id) as span:
+                result = method(marketplace, *args, **kwargs)
+                if span is not None and isinstance(result, bool):
+                    span.args["result"] = result
+            if cart_method and result is False:
+                tracer.count(tracer.cart_spans.get(cart_id), "failed_" + name)
+            if ends_cart:
+                tracer.end_cart(cart_id)
+            return result
+        return wrapper
+    return decorator
+
+
+class TestTracer(unittest.TestCase):
+    """
+    Unit testing class for Tracer functionalities.
+    """
+
+    def test_sampling(self):
+        """
+        Tests that the children of a root span follow its sampling decision.
+        """
+        tracer = Tracer(sample_rate=0.5, seed=1)
+        recorded = 0
+        for _ in range(100):
+            with tracer.span("root", "test") as root:
+                with tracer.span("child", "test") as child:
+                    self.assertEqual(root is None, child is None, 'Child sampled differently!')
+                recorded += root is not None
+        self.assertTrue(20 < recorded < 80, 'About half of the roots should be recorded!')
+        self.assertEqual(len(tracer.events), 2 * recorded, 'Wrong number of events!')
+
+    def test_cart_spans(self):
+        """
+        Tests that the calls on a cart are children of the cart and that the lock waits
+        and the failures are recorded.
+        """
+        tracer = Tracer()
+        lock = TracedLock(tracer)
+        tracer.begin_cart(0)
+        with tracer.span("add_to_cart", "marketplace", cart_id=0) as span:
+            lock.acquire()
+            timer = threading.Timer(0.01, lock.release)
+            timer.start()
+            with lock:
+                pass
+        tracer.count(tracer.cart_spans[0], "failed_add_to_cart")
+        tracer.end_cart(0)
+        self.assertGreater(span.lock_wait, 0, 'Lock wait not recorded!')
+        self.assertEqual([event["name"] for event in tracer.events], ["add_to_cart", "cart 0"],
+                         'Wrong events!')
+        self.assertEqual(tracer.events[1]["args"], {"failed_add_to_cart": 1}, 'Wrong args!')
@@ -0,0 +1,234 @@
+"""
+Generates very large tests (millions of carts) for the homework.
+
+Unlike the default mode of test_generator.py, everything is drawn in NumPy batches
+from a seeded generator, the consumers are processed in chunks and the input and
+reference output files are written while generating, without building the whole
+configuration in memory and without reading it back from the JSON file.
+"""
+from json import dumps
+
+import numpy as np
+
+from tema.product import Coffee, Tea
+from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
+
+
+def generate_bulk_test(arguments):
+    """
+    Generates the input and reference output files of a test.
+
+    :param arguments: the command line arguments of test_generator.py
+    :return: nothing
+    """
+    rng = np.random.default_rng(arguments[ARG_SEED])
+    basic_test = arguments[ARG_IS_BASIC]
+
+    products = generate_bulk_products(rng, arguments[ARG_PRODUCTS])
+    producers, produced = generate_bulk_producers(rng, arguments[ARG_PRODUCERS],
+                                                  len(products), basic_test)
+    # only the produced products are kept, with their ids
+    product_ids = [PRODUCT_PREFIX + str(i + 1) for i in produced]
+    products = [products[i] for i in produced]
+
+    with open(f'{TESTS_DIR}/{arguments[ARG_TEST_NAME]}.in', 'w') as input_file, \
+            open(f'{TESTS_DIR}/{arguments[ARG_TEST_NAME]}.ref.out', 'w') as output_file:
+        # the consumers are written at the end, while they are generated
+        header = {ARG_PRODUCTS: dict(zip(product_ids, products)),
+                  ARG_PRODUCERS: [{"name": PRODUCER_NAME_PREFIX + str(i + 1),
+                                   ARG_PRODUCTS: [[PRODUCT_PREFIX + str(product + 1),
+                                                   quantity, production_time]
+                                                  for product, quantity, production_time
+                                                  in producer_products],
+                                   "republish_wait_time": republish_wait_time}
+                                  for i, (producer_products, republish_wait_time)
+                                  in enumerate(producers)],
+                  "marketplace": {"queue_size_per_producer": arguments[ARG_MARKETPLACE_Q]}}
+        input_file.write(dumps(header)[:-1] + ', "' + ARG_CONSUMERS + '": [\n')
+
+        # every line of the reference output is sorted: consumers by name, then products
+        # by their representation, so the consumers are generated in the order of their names
+        bought = [" bought " + repr(to_product(product)) + "\n" for product in products]
+        products_order = np.array(sorted(range(len(products)), key=lambda i: bought[i]))
+        consumer_numbers = sorted(range(1, arguments[ARG_CONSUMERS] + 1), key=str)
+
+        chunk_size = arguments[ARG_CHUNK_SIZE]
+        for start in range(0, len(consumer_numbers), chunk_size):
+            chunk = consumer_numbers[start:start + chunk_size]
+            generate_bulk_consumers(rng, arguments, chunk, product_ids, products_order,
+                                    bought, input_file, output_file, start == 0)
+
+        input_file.write("\n]}\n")
+
+
+def generate_bulk_products(rng, count):
+    """
+    Generates the products (half coffee, half tea), without the ids.
+    :param rng: the random generator
+    :param count: the number of products to generate
+    :return: a list of product dicts
+    """
+    coffee_count = min((count + 1) // 2, len(COFFEE_NAMES))
+    tea_count = min(count - coffee_count, len(TEA_NAMES_TYPES))
+    coffee_names = rng.choice(COFFEE_NAMES, size=coffee_count, replace=False)
+    acidities = rng.uniform(MIN_ACIDITY, MAX_ACIDITY, size=coffee_count)
+    roast_levels = rng.choice(ROAST_LEVEL, size=coffee_count)
+    tea_names = rng.choice(list(TEA_NAMES_TYPES), size=tea_count, replace=False)
+    prices = rng.integers(1, 11, size=coffee_count + tea_count)
+
+    products = [{"product_type": "Coffee", "name": str(name), "acidity": round(acidity, 2),
+                 "roast_level": str(roast_level), "price": int(price)}
+                for name, acidity, roast_level, price
+                in zip(coffee_names, acidities.tolist(), roast_levels, prices[:coffee_count])]
+    products += [{"product_type": "Tea", "name": str(name), "type": TEA_NAMES_TYPES[name],
+                  "price": int(price)}
+                 for name, price in zip(tea_names, prices[coffee_count:])]
+    return products
+
+
+def generate_bulk_producers(rng, count, num_products, basic_test):
+    """
+    Generates the producers.
+    :param rng: the random generator
+    :param count: the number of producers
+    :param num_products: the number of products
+    :param basic_test: True if it's a simple test, False otherwise
+    :return: a tuple (list of (list of [product index, quantity, production time],
+             republish wait time), sorted list of the produced product indexes)
+    """
+    # see generate_producers() in test_generator.py for the deadlock scenario
+    max_quantity = 3 if basic_test else 5
+
+    num_products_per_producer = rng.integers(1, num_products + 1, size=count)
+    # a random permutation of the products for each producer, keep the first ones
+    chosen = np.argsort(rng.random((count, num_products)), axis=1)
+    selected = np.arange(num_products) < num_products_per_producer[:, None]
+    quantities = rng.integers(1, max_quantity + 1, size=(count, num_products))
+    production_times = rng.uniform(0.05, 0.4, size=(count, num_products))
+    republish_wait_times = rng.uniform(0.05, 0.4, size=count)
+
+    producers = []
+    for i in range(count):
+        row = num_products_per_producer[i]
+        producers.append(([[product, quantity, round(production_time, 2)]
+                           for product, quantity, production_time
+                           in zip(chosen[i, :row].tolist(), quantities[i, :row].tolist(),
+                                  production_times[i, :row].tolist())],
+                          round(republish_wait_times[i].item(), 2)))
+    return producers, np.unique(chosen[selected]).tolist()
+
+
+def generate_bulk_consumers(rng, arguments, consumer_numbers, product_ids, products_order,
+                            bought, input_file, output_file, is_first_chunk):
+    """
+    Generates a chunk of consumers, appends them to the input file and their expected
+    purchases to the reference output file.
+
+    :param rng: the random generator
+    :param arguments: the command line arguments of test_generator.py
+    :param consumer_numbers: the numbers of the consumers, in the order of their names
+    :param product_ids: the ids of the produced products
+    :param products_order: the product indexes, in the order of their representation
+    :param bought: the end of the reference output line, for each product
+    :param input_file: the .in file
+    :param output_file: the .ref.out file
+    :param is_first_chunk: True if no consumer was written before
+    :return: nothing
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    basic_test = arguments[ARG_IS_BASIC]
+    max_operations_per_cart = 3 if basic_test else 10
+    max_quantity = 5 if basic_test else 10
+    num_products = len(product_ids)
+    num_consumers = len(consumer_numbers)
+
+    retry_wait_times = rng.uniform(0.05, 0.4, size=num_consumers)
+    num_carts = rng.integers(arguments[ARG_MIN_CARTS], arguments[ARG_MAX_CARTS] + 1,
+                             size=num_consumers)
+    cart_owner = np.repeat(np.arange(num_consumers), num_carts)
+    total_carts = len(cart_owner)
+
+    # each cart adds distinct products (the first num_operations of a random permutation)
+    num_operations = np.minimum(rng.integers(1, max_operations_per_cart + 1, size=total_carts),
+                                num_products)
+    cart_products = np.argsort(rng.random((total_carts, num_products)), axis=1)
+    is_added = np.arange(num_products) < num_operations[:, None]
+    quantities = np.where(is_added, rng.integers(1, max_quantity + 1,
+                                                 size=(total_carts, num_products)), 0)
+
+    # 0 or 1 removal of a product added by the cart (the last one is chosen twice as often,
+    # like the index -1 in test_generator.py)
+    has_removal = np.zeros(total_carts, dtype=bool)
+    if arguments[ARG_SUPPORTS_REMOVAL]:
+        has_removal = rng.integers(0, 2, size=total_carts) > 0
+    removed = rng.integers(0, num_operations + 1) - 1
+    removed[removed < 0] = num_operations[removed < 0] - 1
+    removed_available = quantities[np.arange(total_carts), removed]
+    removed_quantity = np.where(has_removal,
+                                np.floor(rng.random(total_carts) * removed_available) + 1,
+                                0).astype(np.int64)
+
+    # expected units bought by each consumer, for each product
+    expected = quantities.copy()
+    expected[np.arange(total_carts), removed] -= removed_quantity
+    totals = np.zeros((num_consumers, num_products), dtype=np.int64)
+    np.add.at(totals, (np.repeat(cart_owner, num_products), cart_products.ravel()),
+              expected.ravel())
+
+    write_bulk_consumers(consumer_numbers, retry_wait_times, num_carts, num_operations,
+                         cart_products, quantities, has_removal, removed, removed_quantity,
+                         product_ids, input_file, is_first_chunk)
+
+    names = [CONSUMER_NAME_PREFIX + str(number) for number in consumer_numbers]
+    totals = totals[:, products_order]
+    lines = []
+    for consumer, product_position in zip(*np.nonzero(totals)):
+        lines.append((names[consumer] + bought[products_order[product_position]])
+                     * int(totals[consumer, product_position]))
+    output_file.write("".join(lines))
+
+
+def write_bulk_consumers(consumer_numbers, retry_wait_times, num_carts, num_operations,
+                         cart_products, quantities, has_removal, removed, removed_quantity,
+                         product_ids, input_file, is_first_chunk):
+    """
+    Appends a chunk of consumers to the input file, in the format read by test.py.
+    :return: nothing
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    add_operations = ['{"type": "' + ADD_TO_CART_OP + '", "product": "' + product_id
+                      + '", "quantity": ' for product_id in product_ids]
+    remove_operations = ['{"type": "' + REMOVE_FROM_CART_OP + '", "product": "' + product_id
+                         + '", "quantity": ' for product_id in product_ids]
+    first_cart = 0
+    consumers = []
+    for number, retry_wait_time, consumer_carts in zip(consumer_numbers,
+                                                       retry_wait_times.tolist(),
+                                                       num_carts.tolist()):
+        carts = []
+        for cart in range(first_cart, first_cart + consumer_carts):
+            operations = [add_operations[product] + str(quantity) + "}"
+                          for product, quantity
+                          in zip(cart_products[cart, :num_operations[cart]].tolist(),
+                                 quantities[cart, :num_operations[cart]].tolist())]
+            if has_removal[cart]:
+                operations.append(remove_operations[cart_products[cart, removed[cart]]]
+                                  + str(removed_quantity[cart]) + "}")
+            carts.append("[" + ", ".join(operations) + "]")
+        first_cart += consumer_carts
+        consumers.append('{"name": "' + CONSUMER_NAME_PREFIX + str(number)
+                         + '", "retry_wait_time": ' + repr(round(retry_wait_time, 2))
+                         + ', "carts": [' + ", ".join(carts) + "]}")
+    if not is_first_chunk:
+        input_file.write(",\n")
+    input_file.write(",\n".join(consumers))
+
+
+def to_product(product):
+    """
+    Builds the Product described by a product dict.
+    :param product: the product dict
+    :return: a Coffee or a Tea
+    """
+    params = {k: v for k, v in product.items() if k != 'product_type'}
+    return {"Coffee": Coffee, "Tea": Tea}[product['product_type']](**params)
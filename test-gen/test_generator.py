@@ -11,6 +11,9 @@ Script input
     - max number of carts per consumer
     - is basic test
     - should have removal operations
+    - --bulk: vectorised generation for huge tests (see bulk_generator.py)
+    - --seed: the seed of the random generator
+    - --chunk_size: the number of consumers generated at once in bulk mode
 """
 import argparse
 import random
@@ -26,13 +29,19 @@ def generate_test():
 
     :return: nothing
     """
-    random.seed(0)
-
     cmdline_arguments = parse_input()
     if not sanitize_inputs(cmdline_arguments):
         print("Invalid arguments")
     print(cmdline_arguments)
 
+    if cmdline_arguments[ARG_BULK]:
+        # Only the bulk mode needs NumPy
+        from bulk_generator import generate_bulk_test  # pylint: disable=import-outside-toplevel
+        generate_bulk_test(cmdline_arguments)
+        return
+
+    random.seed(cmdline_arguments[ARG_SEED])
+
     products = generate_products(cmdline_arguments[ARG_PRODUCTS])
     producers = generate_producers(cmdline_arguments[ARG_PRODUCERS],
                                    products, cmdline_arguments[ARG_IS_BASIC])
@@ -93,6 +102,12 @@ def parse_input():
                         help="True if it is a simple test, False otherwise")
     parser.add_argument(ARG_SUPPORTS_REMOVAL, type=bool, nargs='?', default=True,
                         help="True if the consumer can remove products from cart, False otherwise")
+    parser.add_argument("--" + ARG_BULK, action="store_true",
+                        help="generate the test with NumPy, in chunks (for huge tests)")
+    parser.add_argument("--" + ARG_SEED, type=int, default=DEFAULT_SEED,
+                        help="seed of the random generator")
+    parser.add_argument("--" + ARG_CHUNK_SIZE, type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="number of consumers generated at once in bulk mode")
 
     return parser.parse_args().__dict__
 
@@ -52,3 +52,10 @@ ARG_MAX_CARTS = "max_carts"
 ARG_MARKETPLACE_Q = "marketplace_q"
 ARG_IS_BASIC = "is_basic"
 ARG_SUPPORTS_REMOVAL = "supports_removal"
+ARG_BULK = "bulk"
+ARG_SEED = "seed"
+ARG_CHUNK_SIZE = "chunk_size"
+
+# Bulk generation related constants
+DEFAULT_SEED = 0
+DEFAULT_CHUNK_SIZE = 20000
@@ -6,13 +6,18 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import json
 import sys
-from json import loads
+from threading import Event
 
-from tema.producer import Producer
+from tema.config import load_market_config
+from tema.producer import CYCLE_MODE, DEMAND_MODE, Producer
+from tema.profiling import CpuProfiler, MemoryProfiler, write_report
 from tema.consumer import Consumer
 from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.recorder import RecordingMarketplace
+from tema.tracing import Tracer
 
 
 def main():
@@ -20,48 +25,86 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
-
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="market configuration (.in file)")
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON file of the run")
+    parser.add_argument("--trace-sample", type=float, default=1.0,
+                        help="probability that a cart or a production cycle is traced")
+    parser.add_argument("--record", help="record the Marketplace calls in a file, "
+                                         "for replay.py")
+    parser.add_argument("--adaptive-capacity", action="store_true",
+                        help="share the capacity of the producers according to the demand")
+    parser.add_argument("--producer-mode", choices=[CYCLE_MODE, DEMAND_MODE],
+                        help="production mode of all the producers (default: the mode "
+                             "from the file, else cycle)")
+    parser.add_argument("--priority-stats", action="store_true",
+                        help="print the latency of the carts of each priority class on stderr")
+    parser.add_argument("--profile", choices=["cpu", "mem"],
+                        help="profile the CPU time of the producer and consumer threads, "
+                             "or the memory allocated in each phase of the run")
+    parser.add_argument("--profile-output",
+                        help="JSON file of the profile (default: profile-cpu.json or "
+                             "profile-mem.json)")
+    args = parser.parse_args()
+
+    cpu_profiler = CpuProfiler() if args.profile == "cpu" else None
+    mem_profiler = MemoryProfiler() if args.profile == "mem" else None
+    if mem_profiler is not None:
+        mem_profiler.start()
+
+    market_config = load_market_config(args.filename)
+    # the options override the configuration file
+    if args.adaptive_capacity:
+        market_config['marketplace']['adaptive_capacity'] = True
+    if args.producer_mode:
+        for p_market_config in market_config['producers']:
+            p_market_config['mode'] = args.producer_mode
+    if mem_profiler is not None:
+        mem_profiler.snapshot("config_loaded")
+
+    run_market(market_config, args, cpu_profiler, mem_profiler)
+
+    if mem_profiler is not None:
+        mem_profiler.snapshot("end")
+        mem_profiler.stop()
+    profiler = cpu_profiler or mem_profiler
+    if profiler is not None:
+        write_report(profiler.report(),
+                     args.profile_output or "profile-{0}.json".format(args.profile))
+
+
+def run_market(market_config, args, cpu_profiler, mem_profiler):
+    """
+        Builds the Marketplace, runs the producers and the consumers until every
+        consumer is done and writes the requested outputs.
+    """
+    tracer = Tracer(args.trace_sample) if args.trace else None
 
     # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
-
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
+    marketplace = Marketplace(**market_config['marketplace'], tracer=tracer)
+    priority_latencies = marketplace.priority_latencies
+    if args.record:
+        marketplace = RecordingMarketplace(marketplace, args.record)
+
+    # build the producers
+    stop_event = Event()
+    producers = [Producer(**p_market_config, marketplace=marketplace, tracer=tracer,
+                          stop_event=stop_event, daemon=True)
                  for p_market_config in market_config['producers']]
 
+    # build the consumers
+    consumers = [Consumer(**c_market_config, marketplace=marketplace)
+                 for c_market_config in market_config['consumers']]
+
+    if cpu_profiler is not None:
+        for thread in producers + consumers:
+            cpu_profiler.wrap(thread)
+
     for producer in producers:
         producer.start()
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
+    if mem_profiler is not None:
+        mem_profiler.snapshot("producers_started")
 
     for consumer in consumers:
         consumer.start()
@@ -69,6 +112,17 @@ def main():
     for consumer in consumers:
         consumer.join()
 
+    # stop the producers, they are not needed anymore
+    stop_event.set()
+    for producer in producers:
+        producer.join()
+
+    if tracer is not None:
+        tracer.write(args.trace)
+    if args.record:
+        marketplace.close()
+    if args.priority_stats:
+        print(json.dumps(priority_latencies(), indent=4), file=sys.stderr)
 
 if __name__ == '__main__':
     main()